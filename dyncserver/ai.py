@@ -3,10 +3,35 @@ import numpy as np
 import euclid3
 import random
 import logging
+import weakref
+import time
+from combat import CombatModel
 
 logger = logging.getLogger('general')
 
 
+def get_forces_key(game_map):
+    # Number of groups and units of both coalitions in every occupied node. Enough to tell apart any two boards that
+    # the AI would see differently, and much smaller than the board itself.
+    forces = []
+    for node_id in sorted(game_map.groups_in_nodes):
+        red_groups, red_units, blue_groups, blue_units = 0, 0, 0, 0
+        for group in game_map.groups_in_nodes[node_id].values():
+            if group.coalition == "red":
+                red_groups += 1
+                red_units += group.num_units()
+            elif group.coalition == "blue":
+                blue_groups += 1
+                blue_units += group.num_units()
+        forces.append((int(node_id), red_groups, red_units, blue_groups, blue_units))
+    return tuple(forces)
+
+
+def get_infantry_key(game_map):
+    return tuple(sorted((int(node_id), infantry["coalition"], infantry["number"])
+                        for node_id, infantry in game_map.infantry_in_nodes.items()))
+
+
 def decide_move(group, game_map):
 
     if group.category != "vehicle":
@@ -30,6 +55,74 @@ def decide_move(group, game_map):
     else:
         correct_goal = game_map.blue_goal_node
 
+    choices, node_is_backtrack = get_move_choices(node_id, correct_goal, game_map)
+
+    if len(choices) == 0:
+        logger.warning("No path to goal found for group %s" % group.name)
+        return None
+
+    if node_is_backtrack is None:
+        return int(choices[0])
+
+    decision = np.random.choice(choices)
+    extra_info = ""
+    if node_is_backtrack[decision] is True:
+        extra_info = " (which is backtracking)"
+
+    logger.debug("Final decision for %s: move to node %d.%s" % (group.name, decision, extra_info))
+
+    if decision is None:
+        return None
+    else:
+        return int(decision)
+
+
+# Like the shortest paths in classes.py, move choices only depend on the graph. Key is (node, goal).
+move_choices_caches = weakref.WeakKeyDictionary()
+
+
+def get_move_choices(node_id, correct_goal, game_map):
+
+    # Returns the sensible nodes to move to from node_id, when heading for correct_goal, and a dictionary that tells
+    # for each of them whether moving there is backtracking. If the move is forced (the goal is next to us, or there is
+    # only one way to go), the dictionary is None and the list has that one node. If there is no way to the goal, the
+    # list is empty.
+    if node_id is None or correct_goal is None:
+        return compute_move_choices(node_id, correct_goal, game_map)
+    cache = move_choices_caches.get(game_map.graph)
+    if cache is None:
+        cache = {}
+        move_choices_caches[game_map.graph] = cache
+    key = (int(node_id), int(correct_goal))
+    if key not in cache:
+        cache[key] = compute_move_choices(node_id, correct_goal, game_map)
+    choices, node_is_backtrack = cache[key]
+    # Copies, so that the caller may change them
+    if node_is_backtrack is not None:
+        node_is_backtrack = dict(node_is_backtrack)
+    return list(choices), node_is_backtrack
+
+
+def precompute_move_choices(game_map, node_ids):
+    # Fills the caches above for groups in the given nodes, heading for either goal, and the caches of the map that
+    # processjson reads the most: the coordinates of the nodes, and the distances from the goals that
+    # find_greatest_threat_node needs. The server does this while a mission is being played, so that the next turn
+    # finds everything it needs already there. Returns the number of nodes.
+    game_map.get_all_node_coords()
+    for goal in (game_map.red_goal_node, game_map.blue_goal_node):
+        if goal is not None:
+            game_map.get_path_lengths(goal)
+    for node_id in node_ids:
+        for goal in (game_map.red_goal_node, game_map.blue_goal_node):
+            if goal is None:
+                continue
+            get_move_choices(node_id, goal, game_map)
+            game_map.get_shortest_path(node_id, goal)
+    return len(node_ids)
+
+
+def compute_move_choices(node_id, correct_goal, game_map):
+
     origin_coords = game_map.get_node_coords(node_id)
     origin_coords = euclid3.Point2(origin_coords[0], origin_coords[1])
     goal_coords = game_map.get_node_coords(correct_goal)
@@ -40,7 +133,7 @@ def decide_move(group, game_map):
 
     for neighbor in game_map.graph[node_id]:
         if neighbor == correct_goal:
-            return int(correct_goal)
+            return [int(correct_goal)], None
         shortest_path_to_goal = game_map.get_shortest_path(neighbor, correct_goal)
 
         # Ignore paths that return to the node we are in
@@ -48,11 +141,10 @@ def decide_move(group, game_map):
             neighbor_paths.append(shortest_path_to_goal)
 
     if len(neighbor_paths) == 0:
-        logger.warning("No path to goal found for group %s" % group.name)
-        return None
+        return [], None
 
     if len(neighbor_paths) == 1:
-        return int(neighbor_paths[0][0])
+        return [int(neighbor_paths[0][0])], None
 
     # We try to identify the REALLY stupid choices before we randomize our actual choice
     forbidden_nodes = []
@@ -117,17 +209,7 @@ def decide_move(group, game_map):
     if allow_backtrack is False:
         choices = [node for node in choices if node_is_backtrack[node] is False]
 
-    decision = np.random.choice(choices)
-    extra_info = ""
-    if node_is_backtrack[decision] is True:
-        extra_info = " (which is backtracking)"
-
-    logger.debug("Final decision for %s: move to node %d.%s" % (group.name, decision, extra_info))
-
-    if decision is None:
-        return None
-    else:
-        return int(decision)
+    return choices, node_is_backtrack
 
 
 def find_aa_target_node(group, game_map):
@@ -185,92 +267,14 @@ def decide_aa_move(group, game_map):
     else:
         enemy_coalition = "red"
 
-    origin_coords = game_map.get_node_coords(node_id)
-    origin_coords = euclid3.Point2(origin_coords[0], origin_coords[1])
-    goal_coords = game_map.get_node_coords(correct_goal)
-    goal_coords = euclid3.Point2(goal_coords[0], goal_coords[1])
-
-    neighbor_paths = []
-    path_pairs = []
-
-    for neighbor in game_map.graph[node_id]:
-        if neighbor == correct_goal:
-            return int(correct_goal)
-        shortest_path_to_goal = game_map.get_shortest_path(neighbor, correct_goal)
-
-        # Ignore paths that return to the node we are in
-        if shortest_path_to_goal is not None and node_id not in shortest_path_to_goal:
-            neighbor_paths.append(shortest_path_to_goal)
+    choices, node_is_backtrack = get_move_choices(node_id, correct_goal, game_map)
 
-    if len(neighbor_paths) == 0:
-        logger.warning("No path to goal found for group %s" % str(group))
+    if len(choices) == 0:
+        logger.warning("No path to goal found for group %s" % group.name)
         return None
 
-    if len(neighbor_paths) == 1:
-        return int(neighbor_paths[0][0])
-
-    # We try to identify the REALLY stupid choices before we randomize our actual choice
-    forbidden_nodes = []
-
-    length = len(neighbor_paths)
-
-    # A bit complicated algorithm. Creates a list of all possible pairs of different paths and truncates them to the
-    # nearest common node. The i and j -parts of the for loops are the traditional way to compare pairs with least
-    # amount of work. (Don't compare item with itself, and don't compare a to b, and then b to a.
-    for i in range(length - 1):
-        for j in range(i + 1, length):
-
-            # The previous two loops compared paths. The next two loops compare nodes in paths.
-            found_intersection = False
-            for k in range(0, len(neighbor_paths[i])):
-                for l in range(0, len(neighbor_paths[j])):
-                    if neighbor_paths[i][k] == neighbor_paths[j][l]:
-                        path_pairs.append((neighbor_paths[i][:k+1], neighbor_paths[j][:l+1]))
-                        found_intersection = True
-                        break
-                if found_intersection:
-                    break
-
-    # Compares all the pairs, and forbids all nodes where there is such a pair that the divergent part is one third
-    # longer for the to-be-forbidden path, than the shorter path. This prevents any dumb detours from happening.
-    for pair in path_pairs:
-
-        # This allows us to trivially calculate the path length
-        tmpgraph1 = game_map.graph.subgraph(pair[0])
-        tmpgraph2 = game_map.graph.subgraph(pair[1])
-        size1 = tmpgraph1.size(weight='weight')
-        size2 = tmpgraph2.size(weight='weight')
-
-        if size1 >= 1.33 * size2:
-            # Found a dumb detour. Forbid.
-            if pair[0][0] not in forbidden_nodes:
-                forbidden_nodes.append(pair[0][0])
-        elif size2 >= 1.33 * size1:
-            # ditto
-            if pair[1][0] not in forbidden_nodes:
-                forbidden_nodes.append(pair[1][0])
-
-    node_is_backtrack = {}
-    choices = []
-    allow_backtrack = True
-
-    for path in neighbor_paths:
-        if path[0] not in forbidden_nodes:
-            is_backtrack = False
-            dest_coords = game_map.get_node_coords(path[0])
-            dest_coords = euclid3.Point2(dest_coords[0], dest_coords[1])
-
-            if dest_coords.distance(goal_coords) > origin_coords.distance(goal_coords):
-                # Making this move would mean backtracking
-                is_backtrack = True
-            else:
-                # We found at least one node which doesn't constitute backtracking. Hence we disallow all moves that do
-                allow_backtrack = False
-            node_is_backtrack[path[0]] = is_backtrack
-            choices.append(path[0])
-
-    if allow_backtrack is False:
-        choices = [node for node in choices if node_is_backtrack[node] is False]
+    if node_is_backtrack is None:
+        return int(choices[0])
 
     max_advantage = -999
     node_with_max_advantage = None
@@ -458,5 +462,154 @@ def decide_support_move(current_node, coalition, game_map, max_infantry_in_node)
     return None
 
 
+class TurnPlanner:
+
+    # Plans the moves of the vehicle groups for one turn within a time budget. First every group gets the move that the
+    # basic rules give it (decide_move). That is cheap, and always finishes no matter the budget. What is left of the
+    # budget is spent refining those moves with more expensive evaluation, one group at a time, the most threatened
+    # groups first. When the budget runs out, the groups that didn't get their turn yet simply keep their basic move.
+    # Refinement only ever picks between the moves that the basic rules consider sensible, so it can't make the AI do
+    # anything stupid; it only makes it less random where there is a reason to.
+    #
+    # If a LookaheadPlanner and the campaign are given, whatever time is left after that goes to Monte Carlo lookahead
+    # (see lookahead.py), split evenly between the coalitions.
+
+    def __init__(self, game_map, time_budget=0.0, combat_model=None, lookahead=None, campaign=None):
+        self.game_map = game_map
+        self.lookahead = lookahead
+        self.campaign = campaign
+        self.time_budget = time_budget
+        if combat_model is None:
+            combat_model = CombatModel()
+        self.combat_model = combat_model
+        # Functions of the form f(group, moves, deadline) that return a better move for the group, or the same one.
+        # They are run in this order, for every group, as long as there is time.
+        self.refiners = [self.refine_by_threat]
+        self.metrics = {}
+
+    def plan(self, groups):
+        start = time.perf_counter()
+        deadline = start + self.time_budget
+
+        moves = {}
+        for group in groups:
+            moves[group.name] = decide_move(group, self.game_map)
+        baseline_time = time.perf_counter() - start
+
+        num_refined = 0
+        num_changed = 0
+        if self.time_budget > 0:
+            for group in self.order_by_threat(groups):
+                if time.perf_counter() >= deadline:
+                    break
+                if moves[group.name] is None:
+                    continue
+                original_move = moves[group.name]
+                for refiner in self.refiners:
+                    if time.perf_counter() >= deadline:
+                        break
+                    moves[group.name] = refiner(group, moves, deadline)
+                num_refined += 1
+                if moves[group.name] != original_move:
+                    num_changed += 1
+
+        num_lookahead_changed = 0
+        if self.time_budget > 0 and self.lookahead is not None and self.campaign is not None:
+            coalitions = ["red", "blue"]
+            for i, coalition in enumerate(coalitions):
+                now = time.perf_counter()
+                if now >= deadline:
+                    break
+                coalition_deadline = now + (deadline - now) / (len(coalitions) - i)
+                coalition_groups = [group for group in groups if group.coalition == coalition and
+                                    moves[group.name] is not None]
+                new_moves = self.lookahead.improve(self.campaign, self.combat_model, coalition, coalition_groups,
+                                                   moves, coalition_deadline)
+                for group in coalition_groups:
+                    if new_moves[group.name] != moves[group.name]:
+                        num_lookahead_changed += 1
+                moves = new_moves
+
+        total_time = time.perf_counter() - start
+        budget_used = 0.0
+        if self.time_budget > 0:
+            budget_used = min(total_time / self.time_budget, 1.0)
+        self.metrics = {"groups": len(groups), "refined": num_refined, "changed": num_changed,
+                        "lookahead_changed": num_lookahead_changed,
+                        "baseline_ms": baseline_time * 1000.0, "total_ms": total_time * 1000.0,
+                        "budget_ms": self.time_budget * 1000.0, "budget_used": budget_used}
+        logger.info("AI planning took %.1f ms (basic moves %.1f ms). Refined %d of %d groups and changed %d moves, "
+                    "lookahead changed %d, using %d%% of the %.0f ms budget." %
+                    (total_time * 1000.0, baseline_time * 1000.0, num_refined, len(groups), num_changed,
+                     num_lookahead_changed, int(round(budget_used * 100)), self.time_budget * 1000.0))
+        return moves
+
+    def order_by_threat(self, groups):
+        # Groups with the most enemy units next to them go first, because they have the most to gain from refinement.
+        threat = {}
+        for group in groups:
+            node_id = self.game_map.find_group_node(group)
+            enemy_coalition = "blue" if group.coalition == "red" else "red"
+            num_enemies = 0
+            if node_id is not None:
+                num_enemies += self.game_map.get_num_units_in_node(enemy_coalition, node_id)
+                for neighbor in self.game_map.graph[node_id]:
+                    num_enemies += self.game_map.get_num_units_in_node(enemy_coalition, neighbor)
+            threat[group.name] = num_enemies
+        return sorted(groups, key=lambda g: -threat[g.name])
+
+    def refine_by_threat(self, group, moves, deadline):
+        # Looks at every sensible move, and at who the group would end up fighting after it. The rules for that are
+        # the same as in processjson: A battle happens where groups of both sides end up in the same node, or where
+        # two groups swap nodes and meet halfway. The outcome of each fight is estimated with the combat model, and
+        # the move with the best trade of enemy units destroyed against own units lost wins. Ties keep the basic move.
+        node_id = self.game_map.find_group_node(group)
+        choices, node_is_backtrack = get_move_choices(node_id, self.game_map.get_coalition_goal(group.coalition),
+                                                      self.game_map)
+        if node_is_backtrack is None or len(choices) < 2:
+            return moves[group.name]
+
+        own_units = [CombatModel.get_unit_key(unit) for unit in group.units.values()]
+        own_forces = []
+        enemy_forces = []
+
+        for choice in choices:
+            own = list(own_units)
+            enemy = []
+            for node_id2 in self.game_map.groups_in_nodes:
+                for group_name2, group2 in self.game_map.groups_in_nodes[node_id2].items():
+                    if group_name2 == group.name or group2.category != "vehicle":
+                        continue
+                    destination = moves.get(group_name2)
+                    if destination is None:
+                        destination = node_id2
+                    if group2.coalition == group.coalition:
+                        if destination == choice:
+                            own.extend(CombatModel.get_unit_key(unit) for unit in group2.units.values())
+                    elif destination == choice or (node_id2 == choice and destination == node_id):
+                        enemy.extend(CombatModel.get_unit_key(unit) for unit in group2.units.values())
+            own_forces.append(own)
+            enemy_forces.append(enemy)
+
+        num_own = np.array([len(own) for own in own_forces], dtype=float)
+        num_enemy = np.array([len(enemy) for enemy in enemy_forces], dtype=float)
+        own_effectiveness = np.array([self.combat_model.get_effectiveness(own) for own in own_forces])
+        enemy_effectiveness = np.array([self.combat_model.get_effectiveness(enemy) for enemy in enemy_forces])
+        own_survivors, enemy_survivors = CombatModel.resolve(num_own, own_effectiveness, num_enemy,
+                                                             enemy_effectiveness)
+        # Where there is nobody to fight, there are no losses either.
+        own_survivors = np.where(num_enemy > 0, own_survivors, num_own)
+        scores = (num_enemy - enemy_survivors) - (num_own - own_survivors)
+
+        current_index = choices.index(moves[group.name]) if moves[group.name] in choices else None
+        best_index = int(np.argmax(scores))
+        if current_index is not None and scores[current_index] >= scores[best_index] - 1e-9:
+            return moves[group.name]
+
+        logger.debug("Refined the move of %s from node %s to node %d" %
+                     (group.name, repr(moves[group.name]), int(choices[best_index])))
+        return int(choices[best_index])
+
+
 def get_mission_start_teleport():
     pass
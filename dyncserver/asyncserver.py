@@ -0,0 +1,185 @@
+import asyncio
+import json
+import logging
+from http import HTTPStatus
+from threading import Thread
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+from compression import decompress_body, compress_body, decompress_errors, max_body_size, BodyTooLarge
+
+logger = logging.getLogger('general')
+
+# An alternative to the werkzeug server, on asyncio. One thread with an event loop handles every connection, so a slow
+# client costs nothing but a socket. The event loop itself only ever does the quick things: parsing, compression, and
+# answering from the campaign snapshot. Every RPC that touches the campaign, which includes planning the turn and
+# drawing the map, runs in a pool of threads, and messages to Discord are sent in the background after the answer has
+# already gone to DCS.
+#
+# This is a small HTTP/1.1 server of our own rather than a web framework, so that it needs nothing that isn't in the
+# standard library already. It understands exactly what DCS and pollers of the snapshot send: GET, and POST with a
+# Content-Length.
+
+
+class AsyncRPCServer:
+
+    def __init__(self, dync_server, dispatcher, executor, snapshot_methods):
+        self.dync_server = dync_server
+        self.dispatcher = dispatcher
+        self.executor = executor
+        # These are answered from the snapshot right on the event loop
+        self.snapshot_methods = set(snapshot_methods)
+        self.loop = None
+        self.servers = []
+
+    async def start(self, addresses):
+        self.loop = asyncio.get_running_loop()
+        for host, port in addresses:
+            try:
+                server = await asyncio.start_server(self.handle_connection, host, port)
+            except OSError:
+                logger.error("Could not listen on %s:%d" % (host, port), exc_info=True)
+                continue
+            logger.info("Listening on %s:%d (asyncio)" % (host, port))
+            self.servers.append(server)
+
+    async def serve_forever(self, addresses):
+        await self.start(addresses)
+        await asyncio.gather(*[server.serve_forever() for server in self.servers])
+
+    def post_in_background(self, function, *args):
+        # For side effects that nobody waits for, like webhooks. May be called from any thread.
+        if self.loop is None:
+            function(*args)
+            return
+
+        async def run():
+            # noinspection PyBroadException
+            try:
+                await self.loop.run_in_executor(None, function, *args)
+            except Exception:
+                logger.exception("Exception in background task", exc_info=True)
+        asyncio.run_coroutine_threadsafe(run(), self.loop)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                request_line = lines[0].split(" ")
+                if len(request_line) != 3:
+                    await self.write_response(writer, HTTPStatus.BAD_REQUEST, {}, b"Bad request", False)
+                    break
+                method, path, version = request_line
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+
+                keep_alive = version == "HTTP/1.1" and "close" not in headers.get("connection", "").lower()
+                if "chunked" in headers.get("transfer-encoding", "").lower():
+                    await self.write_response(writer, HTTPStatus.LENGTH_REQUIRED, {}, b"Length required", False)
+                    break
+                length = int(headers.get("content-length", "0"))
+                if length > max_body_size:
+                    await self.write_response(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {}, b"Too large", False)
+                    break
+                body = b""
+                if length > 0:
+                    body = await reader.readexactly(length)
+
+                status, response_headers, response_body = await self.handle_request(method, path, headers, body)
+                await self.write_response(writer, status, response_headers, response_body, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            logger.exception("Exception while serving a connection", exc_info=True)
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def write_response(writer, status, headers, body, keep_alive):
+        lines = ["HTTP/1.1 %d %s" % (status, status.phrase)]
+        headers = dict(headers)
+        headers["Content-Length"] = "%d" % len(body)
+        headers["Connection"] = "keep-alive" if keep_alive else "close"
+        for name in headers:
+            lines.append("%s: %s" % (name, headers[name]))
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    async def handle_request(self, method, path, headers, body):
+        if method == "GET" and path == "/metrics":
+            return (HTTPStatus.OK, {"Content-Type": self.dync_server.metrics.content_type},
+                    self.dync_server.metrics.render().encode("utf-8"))
+        if method == "GET":
+            if path.strip("/") == "map.png" or path.startswith("/tiles/"):
+                # Drawing or encoding the map is slow, so not on the event loop
+                document = await self.loop.run_in_executor(self.executor, self.dync_server.get_document_for_path, path)
+            else:
+                document = self.dync_server.snapshot.get_document_for_path(path)
+            return self.get_document_response(document, headers)
+        if method != "POST":
+            return HTTPStatus.METHOD_NOT_ALLOWED, {"Allow": "GET, POST"}, b"Method not allowed"
+
+        try:
+            data = decompress_body(body, headers.get("content-encoding"))
+        except BodyTooLarge:
+            logger.warning("A request was too large to decompress")
+            return HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"Content-Type": "text/plain"}, b"Too large"
+        except decompress_errors:
+            logger.warning("Could not decompress a request with Content-Encoding %s" % headers.get("content-encoding"))
+            return HTTPStatus.BAD_REQUEST, {"Content-Type": "text/plain"}, b"Could not decompress request"
+
+        if self.is_snapshot_request(data):
+            response_json = self.handle_rpc(data)
+        else:
+            response_json = await self.loop.run_in_executor(self.executor, self.handle_rpc, data)
+
+        response_body, encoding = compress_body(response_json.encode("utf-8"),
+                                                parse_accept_header(headers.get("accept-encoding")),
+                                                self.dync_server.compression_min_size)
+        response_headers = {"Content-Type": "application/json", "Vary": "Accept-Encoding"}
+        if encoding is not None:
+            response_headers["Content-Encoding"] = encoding
+        return HTTPStatus.OK, response_headers, response_body
+
+    def is_snapshot_request(self, data):
+        # Only small requests can be for the snapshot. Parsing a whole processjson here would hold up the event loop.
+        if len(data) > 1024:
+            return False
+        # noinspection PyBroadException
+        try:
+            request = json.loads(data)
+        except Exception:
+            return False
+        return isinstance(request, dict) and request.get("method") in self.snapshot_methods
+
+    def handle_rpc(self, data):
+        return self.dync_server.handle_rpc(data, self.dispatcher)
+
+    @staticmethod
+    def get_document_response(document, headers):
+        body, etag, mimetype = document
+        if body is None:
+            return HTTPStatus.NOT_FOUND, {"Content-Type": "text/plain"}, b"Not found"
+        response_headers = {"ETag": quote_etag(etag), "Cache-Control": "no-cache"}
+        if parse_etags(headers.get("if-none-match")).contains(etag):
+            return HTTPStatus.NOT_MODIFIED, response_headers, b""
+        response_headers["Content-Type"] = mimetype
+        return HTTPStatus.OK, response_headers, body
+
+
+class AsyncServerThread(Thread):
+    # The event loop gets a thread of its own, because the main thread belongs to the window.
+    def __init__(self, async_server, addresses):
+        Thread.__init__(self)
+        self.async_server = async_server
+        self.addresses = addresses
+
+    def run(self):
+        asyncio.run(self.async_server.serve_forever(self.addresses))
@@ -1,11 +1,20 @@
 import networkx as nx
 import euclid3
 import logging
+import weakref
 import common
 import constants
 
 logger = logging.getLogger('general')
 
+# Shortest paths only depend on the graph, which never changes in place, so they are remembered per graph and shared by
+# every fork of the map. Key is (source, target), and the value is the path, or None if there is none.
+shortest_path_caches = weakref.WeakKeyDictionary()
+# The same goes for the coordinates of the nodes, and for the lengths of the shortest paths from one node to all others,
+# which are kept by source node.
+node_coords_caches = weakref.WeakKeyDictionary()
+path_length_caches = weakref.WeakKeyDictionary()
+
 
 class Unit:
 
@@ -30,6 +39,9 @@ class Unit:
         self.unit_type = unit_type
         self.skill = skill
 
+    def copy(self):
+        return Unit(name=self.name, position=self.position, unit_type=self.unit_type, skill=self.skill)
+
     def set_position_by_str(self, point_str):
         split = point_str.split(",")
 
@@ -79,6 +91,15 @@ class Group:
         self.destination_node = None
         self.dynamic = dynamic
 
+    def copy(self):
+        units = {}
+        for unit_name in self.units:
+            units[unit_name] = self.units[unit_name].copy()
+        group = Group(name=self.name, group_category=self.category, coalition=self.coalition, units=units,
+                      dynamic=self.dynamic)
+        group.destination_node = self.destination_node
+        return group
+
     def get_type(self):
         if self.units is None or len(self.units) == 0:
             return None
@@ -304,6 +325,9 @@ class Map:
         self.blue_goal_node = blue_goal_node
         self.red_nodes_by_distance = {}
         self.blue_nodes_by_distance = {}
+        self.red_nodes_by_distance_no_reinforcements = {}
+        self.blue_nodes_by_distance_no_reinforcements = {}
+        self.frontline_nodes = None
         self.support_unit_nodes = None
         self.max_support_units_in_group = 7
         self.num_support_units = {"red": self.max_support_units_in_group, "blue": self.max_support_units_in_group}
@@ -313,6 +337,50 @@ class Map:
         self.blue_bullseye = None
         self.multipliers_for_red = None
 
+    def get_mutable_state(self):
+        # The part of the map that fork copies. Small enough to send to another process, where it can be combined with a
+        # map that the process already has, with fork(mutable_state).
+        return {"groups_in_nodes": self.groups_in_nodes, "infantry_in_nodes": self.infantry_in_nodes,
+                "support_unit_nodes": self.support_unit_nodes, "num_support_units": self.num_support_units}
+
+    def fork(self, mutable_state=None):
+        # Returns a new Map that can be changed without affecting this one, for simulations and what-if analysis. The
+        # graph, the distance rings computed from it and the markers never change after the map has been created, so
+        # the fork shares them with this map instead of rebuilding them like from_serializable would. Only the state
+        # that changes from turn to turn is copied. Groups and units are small, and get changed in place all over the
+        # code, so they are copied right away rather than on first write.
+        #
+        # Do not change the graph of a fork in place. If the graph must change, give the fork a new one and call
+        # update_nodes_by_distance.
+        #
+        # If mutable_state (see get_mutable_state) is given, the fork gets that state instead of the state of this map.
+        if mutable_state is None:
+            mutable_state = self.get_mutable_state()
+        new_map = Map(graph=self.graph, red_goal_node=self.red_goal_node, blue_goal_node=self.blue_goal_node)
+        new_map.red_nodes_by_distance = self.red_nodes_by_distance
+        new_map.blue_nodes_by_distance = self.blue_nodes_by_distance
+        new_map.red_nodes_by_distance_no_reinforcements = self.red_nodes_by_distance_no_reinforcements
+        new_map.blue_nodes_by_distance_no_reinforcements = self.blue_nodes_by_distance_no_reinforcements
+        new_map.mapmarkers = self.mapmarkers
+        new_map.cornermarkers = self.cornermarkers
+        new_map.red_bullseye = self.red_bullseye
+        new_map.blue_bullseye = self.blue_bullseye
+        new_map.multipliers_for_red = self.multipliers_for_red
+        new_map.max_support_units_in_group = self.max_support_units_in_group
+
+        groups_in_nodes = mutable_state["groups_in_nodes"]
+        for node_id in groups_in_nodes:
+            new_map.groups_in_nodes[node_id] = {}
+            for group_name in groups_in_nodes[node_id]:
+                new_map.groups_in_nodes[node_id][group_name] = groups_in_nodes[node_id][group_name].copy()
+        infantry_in_nodes = mutable_state["infantry_in_nodes"]
+        for node_id in infantry_in_nodes:
+            new_map.infantry_in_nodes[node_id] = dict(infantry_in_nodes[node_id])
+        if mutable_state["support_unit_nodes"] is not None:
+            new_map.support_unit_nodes = dict(mutable_state["support_unit_nodes"])
+        new_map.num_support_units = dict(mutable_state["num_support_units"])
+        return new_map
+
     def get_num_units_in_node(self, coalition, node_id):
         if coalition != "red" and coalition != "blue":
             logger.error("Cannot get number of units: Coalition must be either 'red' or 'blue'; was: '%s'" % coalition)
@@ -353,6 +421,8 @@ class Map:
         self.num_support_units[coalition] -= 1
 
     def update_nodes_by_distance(self):
+        self.red_nodes_by_distance = {}
+        self.blue_nodes_by_distance = {}
         for node_id in self.graph.nodes:
             try:
                 shortest_path_blue = nx.dijkstra_path(self.graph, self.red_goal_node, node_id)
@@ -375,6 +445,20 @@ class Map:
                     self.red_nodes_by_distance[distance] = []
                 self.red_nodes_by_distance[distance].append(int(node_id))
 
+        # The same rings without the reinforcement nodes. Distance keys that would only have reinforcement nodes are
+        # left out altogether. The AI asks for these many times per turn, so we don't want to filter them every time.
+        self.red_nodes_by_distance_no_reinforcements = self.filter_reinforcements(self.red_nodes_by_distance)
+        self.blue_nodes_by_distance_no_reinforcements = self.filter_reinforcements(self.blue_nodes_by_distance)
+
+    def filter_reinforcements(self, nodes_by_distance):
+        reinforcements = nx.get_node_attributes(self.graph, "coord")
+        filtered = {}
+        for distance in nodes_by_distance:
+            nodes = [node_id for node_id in nodes_by_distance[distance] if reinforcements[int(node_id)][2] is False]
+            if len(nodes) > 0:
+                filtered[distance] = nodes
+        return filtered
+
     def get_nodes_in_graphical_coords(self):
         nodes = self.graph.nodes(data='coord')
         positions = {}
@@ -589,12 +673,39 @@ class Map:
 
     def get_shortest_path(self, source_node_id, target_node_id):
 
-        try:
-            path = nx.dijkstra_path(self.graph, source_node_id, target_node_id)
-        except nx.NetworkXNoPath:
-            return None
+        cache = shortest_path_caches.get(self.graph)
+        if cache is None:
+            cache = {}
+            shortest_path_caches[self.graph] = cache
+        key = (source_node_id, target_node_id)
+        if key in cache:
+            path = cache[key]
+        else:
+            try:
+                path = nx.dijkstra_path(self.graph, source_node_id, target_node_id)
+            except nx.NetworkXNoPath:
+                path = None
+            cache[key] = path
 
-        return path
+        if path is None:
+            return None
+        # A copy, so that the caller may change it
+        return list(path)
+
+    def get_path_lengths(self, source_node_id):
+        # Number of nodes on the shortest path from source_node_id to every node that can be reached from it, counting
+        # both ends. These are the same paths that nx.dijkstra_path finds one at a time. The caller must not change the
+        # dictionary.
+        cache = path_length_caches.get(self.graph)
+        if cache is None:
+            cache = {}
+            path_length_caches[self.graph] = cache
+        lengths = cache.get(int(source_node_id))
+        if lengths is None:
+            paths = nx.single_source_dijkstra_path(self.graph, int(source_node_id))
+            lengths = {int(node_id): len(path) for node_id, path in paths.items()}
+            cache[int(source_node_id)] = lengths
+        return lengths
 
     def groups(self):
         groups_dict = {}
@@ -719,35 +830,33 @@ class Map:
             return
         self.support_unit_nodes[coalition] = int(node_id)
 
+    def get_all_node_coords(self):
+        # Node to (x, y, is_reinforcements). Asking networkx for one node's attribute builds this for the whole graph.
+        coords = node_coords_caches.get(self.graph)
+        if coords is None:
+            coords = nx.get_node_attributes(self.graph, "coord")
+            node_coords_caches[self.graph] = coords
+        return coords
+
     def get_node_coords(self, node_id):
-        coords = nx.get_node_attributes(self.graph, "coord")
-        coord = coords[int(node_id)]
+        coord = self.get_all_node_coords()[int(node_id)]
         node_coord = (coord[0], coord[1])
         return node_coord
 
     def is_node_reinforcements_path(self, node_id):
-        return nx.get_node_attributes(self.graph, "coord")[int(node_id)][2]
+        return self.get_all_node_coords()[int(node_id)][2]
 
     def get_longest_distance(self, coalition, include_reinforcement=True):
         if coalition == "red":
-            correct_dict = self.red_nodes_by_distance
+            if include_reinforcement:
+                correct_dict = self.red_nodes_by_distance
+            else:
+                correct_dict = self.red_nodes_by_distance_no_reinforcements
         else:
-            correct_dict = self.blue_nodes_by_distance
-        if include_reinforcement is False:
-            # We create this dictionary anew, so that it doesn't even have distance keys for node lists that only have
-            # reinforcement nodes.
-            temp_dict = {}
-            for distance in correct_dict:
-                has_key = False
-                for node_id in correct_dict[distance]:
-                    if self.is_node_reinforcements_path(node_id) is False:
-                        # Found at least one non-reinforcements node. Must add key.
-                        if not has_key:
-                            temp_dict[distance] = [node_id]
-                            has_key = True
-                        else:
-                            temp_dict[distance].append(node_id)
-            correct_dict = temp_dict
+            if include_reinforcement:
+                correct_dict = self.blue_nodes_by_distance
+            else:
+                correct_dict = self.blue_nodes_by_distance_no_reinforcements
 
         distances = list(correct_dict.keys())
         return int(max(distances))
@@ -765,31 +874,56 @@ class Map:
             correct_dict = self.blue_nodes_by_distance
 
         if include_reinforcement is False:
-            # We create this dictionary anew, so that it doesn't even have distance keys for node lists that only have
-            # reinforcement nodes.
-            temp_dict = {}
-            for distance_key in correct_dict:
-                has_key = False
-                for node_id in correct_dict[distance_key]:
-                    if self.is_node_reinforcements_path(node_id) is False:
-                        # Found at least one non-reinforcements node. Must add key.
-                        if not has_key:
-                            temp_dict[distance_key] = [node_id]
-                            has_key = True
-                        else:
-                            temp_dict[distance_key].append(node_id)
-            correct_dict = temp_dict
+            if coalition == "red":
+                correct_dict = self.red_nodes_by_distance_no_reinforcements
+            else:
+                correct_dict = self.blue_nodes_by_distance_no_reinforcements
+            if distance not in correct_dict:
+                return []
+            # Callers are free to shuffle the list they get, so they must not get the cached one.
+            return list(correct_dict[distance])
 
         if distance not in correct_dict:
             return []
         return correct_dict[distance]
 
+    def get_units_per_node(self, coalition):
+        # Number of units of the coalition in every node where it has any. One pass over the groups, instead of asking
+        # get_num_units_in_node for every node separately.
+        units_per_node = {}
+        for node_id in self.groups_in_nodes:
+            for group in self.groups_in_nodes[node_id].values():
+                if group.coalition == coalition and group.num_units() > 0:
+                    units_per_node[int(node_id)] = units_per_node.get(int(node_id), 0) + group.num_units()
+        return units_per_node
+
+    def update_frontlines(self):
+        # The frontline doesn't change while the AI makes its decisions for a turn, so it's calculated once for both
+        # coalitions, and find_furtherst_own_groups_nodes returns it from here until clear_frontlines is called.
+        self.frontline_nodes = None
+        frontline_nodes = {}
+        for coalition in ("red", "blue"):
+            frontline_nodes[coalition] = self.find_furtherst_own_groups_nodes(coalition)
+        self.frontline_nodes = frontline_nodes
+
+    def clear_frontlines(self):
+        self.frontline_nodes = None
+
     def find_furtherst_own_groups_nodes(self, coalition):
-        for distance in range(self.get_longest_distance(coalition, include_reinforcement=False), -1, -1):
-            nodes = []
-            for node_id in self.get_nodes_by_distance(coalition, distance, include_reinforcement=False):
-                if self.get_num_units_in_node(coalition, int(node_id)) > 0:
-                    nodes.append(int(node_id))
+        if self.frontline_nodes is not None and coalition in self.frontline_nodes:
+            if self.frontline_nodes[coalition] is None:
+                return None
+            # The caller may shuffle this list, so it gets a copy.
+            return list(self.frontline_nodes[coalition])
+
+        if coalition == "red":
+            rings = self.red_nodes_by_distance_no_reinforcements
+        else:
+            rings = self.blue_nodes_by_distance_no_reinforcements
+        units_per_node = self.get_units_per_node(coalition)
+
+        for distance in sorted(rings.keys(), reverse=True):
+            nodes = [int(node_id) for node_id in rings[distance] if int(node_id) in units_per_node]
             if len(nodes) == 0:
                 continue
             return nodes
@@ -800,6 +934,7 @@ class Map:
             this_coalition = "blue"
         else:
             this_coalition = "red"
+        path_lengths = self.get_path_lengths(enemy_objective_node_id)
         for node_id in self.groups_in_nodes:
             for group_name in self.groups_in_nodes[int(node_id)]:
                 group = self.groups_in_nodes[int(node_id)][group_name]
@@ -810,11 +945,9 @@ class Map:
                         potential_threats[int(node_id)] = [1, 0]
                     else:
                         potential_threats[int(node_id)][0] += 1
-                    try:
-                        path = nx.dijkstra_path(self.graph, enemy_objective_node_id, node_id)
-                    except nx.NetworkXNoPath:
+                    if int(node_id) not in path_lengths:
                         continue
-                    potential_threats[int(node_id)][1] = len(path)
+                    potential_threats[int(node_id)][1] = path_lengths[int(node_id)]
         if len(potential_threats) == 0:
             logger.info("No threats at all from the part of %s coalition" % enemy_coalition)
             return -1
@@ -959,6 +1092,37 @@ class Campaign:
         self.deaths = []
         self.group_data_mission_start = {}
 
+    def get_mutable_state(self):
+        # See Map.get_mutable_state. The per-mission records are left out, since simulations don't need them.
+        return {"map": self.map.get_mutable_state(), "stage": self.stage,
+                "destroyed_unit_names_and_groups": self.destroyed_unit_names_and_groups,
+                "resources_generic": self.resources_generic, "unit_movement_decisions": self.unit_movement_decisions,
+                "aa_unit_id_counter": self.aa_unit_id_counter, "extra_scores": self.extra_scores,
+                "early_battles": self.early_battles}
+
+    def fork(self, mutable_state=None):
+        # Returns a new Campaign that can be changed without affecting this one. See Map.fork for what is shared. The
+        # dictionaries inside destroyed_unit_names_and_groups, deaths and the like are always replaced, never changed,
+        # so copying the containers is enough.
+        with_records = mutable_state is None
+        if mutable_state is None:
+            mutable_state = self.get_mutable_state()
+        new_campaign = Campaign(game_map=self.map.fork(mutable_state["map"]), stage=mutable_state["stage"],
+                                destroyed_unit_names_and_groups=dict(mutable_state["destroyed_unit_names_and_groups"]),
+                                resources_generic=dict(mutable_state["resources_generic"]),
+                                unit_movement_decisions=dict(mutable_state["unit_movement_decisions"]),
+                                aa_unit_id_counter=mutable_state["aa_unit_id_counter"],
+                                allowed_aa_units=self.allowed_aa_units,
+                                extra_scores=dict(mutable_state["extra_scores"]),
+                                software_version=self.software_version)
+        new_campaign.max_infantry_in_node = self.max_infantry_in_node
+        new_campaign.early_battles = set(battle.copy() for battle in mutable_state["early_battles"])
+        if with_records:
+            new_campaign.engagements = list(self.engagements)
+            new_campaign.deaths = list(self.deaths)
+            new_campaign.group_data_mission_start = dict(self.group_data_mission_start)
+        return new_campaign
+
     # Argument previously_scheduled is a set or list of group_names that have already been moved away from this apparent
     # node, to halfway point between some two nodes. Hence they will not participate.
     def get_battles_due_to_same_node(self, previously_scheduled=None):
@@ -1007,6 +1171,24 @@ class Campaign:
         if found is False:
             self.early_battles.add(Battle(nodes=nodes, group_names={group_name}))
 
+    def destroy_unit(self, unit_name, group_name):
+        # Returns the group the unit belonged to, or None if there was no such group.
+        group = self.map.find_group_by_name(group_name)
+        if group is None:
+            return None
+
+        if unit_name not in self.destroyed_unit_names_and_groups:
+            self.destroyed_unit_names_and_groups[unit_name] = {"group": group_name}
+
+        if unit_name in group.units:
+            del group.units[unit_name]
+        if len(group.units) == 0:
+            logger.info("That was group's final unit, remove group")
+            if group_name in self.unit_movement_decisions:
+                del self.unit_movement_decisions[group_name]
+            self.map.remove_group(group)
+        return group
+
     def add_resources_generic(self, coalition, number):
         if coalition != "red" and coalition != "blue":
             logger.error("Cannot add generic resources: Coalition must be either 'red' or 'blue'; was: '%s'" %
@@ -1165,6 +1347,9 @@ class Battle:
         else:
             self.group_names = group_names
 
+    def copy(self):
+        return Battle(nodes=set(self.nodes), group_names=set(self.group_names))
+
     def __repr__(self):
         return "Battle(Nodes=%s, groups=%s)" % (repr(self.nodes), repr(self.group_names))
 
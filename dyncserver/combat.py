@@ -0,0 +1,225 @@
+import numpy as np
+import sqlite3
+import json
+import logging
+import constants
+
+logger = logging.getLogger('general')
+
+
+class CombatModel:
+
+    # Resolves battles without DCS World, with the Lanchester square law. Each side has a number of units and an
+    # effectiveness per unit, and both sides lose units at a rate proportional to the size and effectiveness of the
+    # other side. The law has a well known invariant: a * (R0^2 - R^2) = b * (B0^2 - B^2), where R and B are the number
+    # of red and blue units, and a and b their effectiveness. Integrated until one side is wiped out, this gives the
+    # number of survivors of the winning side in closed form, which is what makes resolving thousands of battles at
+    # once cheap.
+    #
+    # The effectiveness of a unit depends on its type and skill. We learn it from the battles that the server has
+    # already recorded to statistics.db: Every clean battle tells us, through the invariant above, the ratio between
+    # the effectiveness of the two sides. The effectiveness of a side is the geometric mean of its units, so the
+    # logarithm of that ratio is linear in the logarithms of the unit weights, and we can fit all of them at once with
+    # (regularized) least squares. Unit types and skills that we have never seen have a weight of 1.0.
+
+    num_skills = 4
+    default_skill = 1
+
+    # Makes sure a battle where one side took no losses doesn't give an infinite ratio
+    loss_smoothing = 0.5
+
+    def __init__(self, log_weights=None):
+        num_types = max(constants.unit_type_to_id.values()) + 1
+        if log_weights is None:
+            log_weights = np.zeros((num_types, CombatModel.num_skills))
+        self.log_weights = log_weights
+        self.num_battles = 0
+
+    @staticmethod
+    def from_sqlite(sqlite_path, regularization=1.0):
+        model = CombatModel()
+        try:
+            conn = sqlite3.connect(sqlite_path)
+            c = conn.cursor()
+            c.execute("SELECT conflicts FROM statistics")
+            rows = c.fetchall()
+            conn.close()
+        except sqlite3.Error:
+            logger.warning("Could not read battle statistics from %s. Combat model uses default weights." %
+                           sqlite_path, exc_info=True)
+            return model
+
+        battles = []
+        for row in rows:
+            battles.extend(json.loads(row[0]))
+        model.fit(battles, regularization=regularization)
+        return model
+
+    @staticmethod
+    def get_weight_index(type_id, skill):
+        if skill is None or skill < 0 or skill >= CombatModel.num_skills:
+            skill = CombatModel.default_skill
+        return int(type_id) * CombatModel.num_skills + int(skill)
+
+    def fit(self, battles, regularization=1.0):
+        # Battles are in the format of statistics.db: Dictionaries with lists "sr", "sb", "er" and "eb" (start red,
+        # start blue, end red, end blue) of [type id, skill] pairs.
+
+        rows = []
+        targets = []
+        columns = {}
+
+        for battle in battles:
+            num_red_start, num_blue_start = len(battle["sr"]), len(battle["sb"])
+            if num_red_start == 0 or num_blue_start == 0:
+                continue
+            num_red_end, num_blue_end = len(battle["er"]), len(battle["eb"])
+            red_losses = num_red_start ** 2 - num_red_end ** 2
+            blue_losses = num_blue_start ** 2 - num_blue_end ** 2
+            if red_losses <= 0 and blue_losses <= 0:
+                # Nothing happened, so there is nothing to learn.
+                continue
+
+            row = {}
+            for unit in battle["sr"]:
+                index = CombatModel.get_weight_index(unit[0], unit[1])
+                row[index] = row.get(index, 0.0) + 1.0 / num_red_start
+            for unit in battle["sb"]:
+                index = CombatModel.get_weight_index(unit[0], unit[1])
+                row[index] = row.get(index, 0.0) - 1.0 / num_blue_start
+            for index in row:
+                if index not in columns:
+                    columns[index] = len(columns)
+            rows.append(row)
+            targets.append(np.log((max(blue_losses, 0) + CombatModel.loss_smoothing) /
+                                  (max(red_losses, 0) + CombatModel.loss_smoothing)))
+
+        self.log_weights = np.zeros_like(self.log_weights)
+        self.num_battles = len(rows)
+        if len(rows) == 0:
+            logger.info("No usable battle statistics yet. Combat model uses default weights.")
+            return
+
+        design = np.zeros((len(rows), len(columns)))
+        for i, row in enumerate(rows):
+            for index, value in row.items():
+                design[i, columns[index]] = value
+
+        # Ridge regression. The regularization pulls everything we know little about towards the default weight, and
+        # also pins down the overall level, since only the ratios between the two sides can be observed.
+        lhs = design.T @ design + regularization * np.eye(len(columns))
+        rhs = design.T @ np.array(targets)
+        solution = np.linalg.solve(lhs, rhs)
+
+        flat_weights = self.log_weights.reshape(-1)
+        for index, column in columns.items():
+            flat_weights[index] = solution[column]
+        logger.info("Fitted combat model to %d battles and %d unit types and skills" % (len(rows), len(columns)))
+
+    @staticmethod
+    def get_unit_key(unit):
+        # The [type id, skill] pair of a Unit, as it is stored in the statistics.
+        type_id = constants.unit_type_to_id.get(unit.unit_type, 0)
+        skill = constants.skill_to_statistics_num.get(unit.skill, CombatModel.default_skill)
+        return type_id, skill
+
+    def get_effectiveness(self, units):
+        # Effectiveness of a side made of the given [type id, skill] pairs. Geometric mean, just like in the fit.
+        if len(units) == 0:
+            return 1.0
+        return float(np.exp(np.mean(self.get_unit_log_weights(units))))
+
+    def get_unit_log_weights(self, units):
+        # units is a list of [type id, skill] pairs. Returns the logarithm of the weight of each.
+        if len(units) == 0:
+            return np.zeros(0)
+        indices = [CombatModel.get_weight_index(unit[0], unit[1]) for unit in units]
+        return self.log_weights.reshape(-1)[indices]
+
+    @staticmethod
+    def resolve(num_red, red_effectiveness, num_blue, blue_effectiveness):
+        # All arguments are NumPy arrays with one item per battle. Returns the number of survivors for both sides, as
+        # floats. One side of every battle ends up with zero survivors, or both if they were equally matched.
+        num_red = np.asarray(num_red, dtype=float)
+        num_blue = np.asarray(num_blue, dtype=float)
+        red_effectiveness = np.asarray(red_effectiveness, dtype=float)
+        blue_effectiveness = np.asarray(blue_effectiveness, dtype=float)
+
+        red_power = red_effectiveness * num_red ** 2
+        blue_power = blue_effectiveness * num_blue ** 2
+        difference = red_power - blue_power
+
+        red_survivors = np.where(difference > 0, np.sqrt(np.maximum(difference, 0.0) / red_effectiveness), 0.0)
+        blue_survivors = np.where(difference < 0, np.sqrt(np.maximum(-difference, 0.0) / blue_effectiveness), 0.0)
+        return red_survivors, blue_survivors
+
+    def resolve_battles(self, campaign, battles, rng=None):
+        # Battles may be Battle objects (see Campaign.get_battles_due_to_same_node) or potential battles in the format
+        # of Campaign.find_potential_battles. Either way, only the group names matter. Returns a list of outcomes, one
+        # per battle that had both coalitions in it. Campaign is not modified; see apply_outcomes.
+        #
+        # If rng (a NumPy Generator) is given, fractional survivors are rounded randomly and the units that die are
+        # chosen randomly. Otherwise we round to nearest, and the least effective units die first.
+
+        battle_units = []
+        for battle in battles:
+            if isinstance(battle, dict):
+                group_names = set(battle.values())
+            else:
+                group_names = battle.group_names
+
+            units = {"red": [], "blue": []}
+            for group_name in sorted(group_names):
+                group = campaign.map.find_group_by_name(group_name)
+                if group is None or group.category != "vehicle" or group.coalition not in units:
+                    continue
+                for unit_name in group.units:
+                    type_id, skill = CombatModel.get_unit_key(group.units[unit_name])
+                    units[group.coalition].append((unit_name, group_name, type_id, skill))
+            if len(units["red"]) == 0 or len(units["blue"]) == 0:
+                continue
+            battle_units.append((group_names, units))
+
+        if len(battle_units) == 0:
+            return []
+
+        num_battles = len(battle_units)
+        num_units = {"red": np.zeros(num_battles), "blue": np.zeros(num_battles)}
+        effectiveness = {"red": np.zeros(num_battles), "blue": np.zeros(num_battles)}
+        unit_log_weights = []
+
+        for i, (group_names, units) in enumerate(battle_units):
+            log_weights = {}
+            for coalition in ("red", "blue"):
+                log_weights[coalition] = self.get_unit_log_weights([(unit[2], unit[3]) for unit in units[coalition]])
+                num_units[coalition][i] = len(units[coalition])
+                effectiveness[coalition][i] = np.exp(np.mean(log_weights[coalition]))
+            unit_log_weights.append(log_weights)
+
+        red_survivors, blue_survivors = CombatModel.resolve(num_units["red"], effectiveness["red"],
+                                                            num_units["blue"], effectiveness["blue"])
+        survivors = {"red": red_survivors, "blue": blue_survivors}
+
+        outcomes = []
+        for i, (group_names, units) in enumerate(battle_units):
+            destroyed = []
+            num_survivors = {}
+            for coalition in ("red", "blue"):
+                if rng is None:
+                    num_alive = int(np.round(survivors[coalition][i]))
+                    order = np.argsort(unit_log_weights[i][coalition], kind="stable")
+                else:
+                    num_alive = int(np.floor(survivors[coalition][i] + rng.random()))
+                    order = rng.permutation(len(units[coalition]))
+                num_alive = min(num_alive, len(units[coalition]))
+                num_survivors[coalition] = num_alive
+                for j in order[:len(units[coalition]) - num_alive]:
+                    destroyed.append((units[coalition][j][0], units[coalition][j][1]))
+            outcomes.append({"group_names": set(group_names), "survivors": num_survivors, "destroyed": destroyed})
+        return outcomes
+
+    @staticmethod
+    def apply_outcomes(campaign, outcomes):
+        for outcome in outcomes:
+            for unit_name, group_name in outcome["destroyed"]:
+                campaign.destroy_unit(unit_name, group_name)
@@ -0,0 +1,58 @@
+import gzip
+import zlib
+
+# Content-Encoding for the RPC bodies, shared by both kinds of server. Clients with a zlib library compress what they
+# send and say so in Content-Encoding, and tell us in Accept-Encoding whether they can read compressed answers.
+
+# The largest request body we accept, both as it is sent and after decompressing it. The processjson of a large
+# mission is a few MB, so this leaves plenty of room. A few hundred kB of compressed zeros would otherwise be enough to
+# make us fill all of the memory.
+max_body_size = 64 * 1024 * 1024
+
+# Errors that a broken compressed body can give
+decompress_errors = (OSError, EOFError, zlib.error)
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+def decompress_body(data, encoding, max_size=max_body_size):
+    # Raises BodyTooLarge if the body would be more than max_size bytes decompressed
+    if encoding is None:
+        return data
+    encoding = encoding.strip().lower()
+    if encoding == "gzip":
+        return inflate(data, 16 + zlib.MAX_WBITS, max_size)
+    if encoding == "deflate":
+        # Officially deflate means the zlib format, but some clients send raw deflate data. Accept both.
+        try:
+            return inflate(data, zlib.MAX_WBITS, max_size)
+        except zlib.error:
+            return inflate(data, -zlib.MAX_WBITS, max_size)
+    return data
+
+
+def inflate(data, wbits, max_size):
+    # Never more than max_size + 1 bytes of output, so we can tell a body that is exactly max_size from a larger one
+    decompressor = zlib.decompressobj(wbits)
+    body = decompressor.decompress(data, max_size + 1)
+    if len(body) > max_size:
+        raise BodyTooLarge("More than %d bytes decompressed" % max_size)
+    if not decompressor.eof:
+        raise EOFError("The compressed body ended before the end of its data")
+    return body
+
+
+def compress_body(body, accept_encodings, min_size):
+    # accept_encodings is a werkzeug Accept object. Returns the body and its Content-Encoding, or None if it was left
+    # as it is. We only compress when it's large enough to be worth it. Level 6 is the zlib default, and compresses our
+    # JSON almost as well as 9 in a fraction of the time.
+    encoding = None
+    if 0 < min_size <= len(body):
+        encoding = accept_encodings.best_match(["gzip", "deflate"])
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=6), encoding
+    if encoding == "deflate":
+        return zlib.compress(body, 6), encoding
+    return body, None
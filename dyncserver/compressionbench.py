@@ -0,0 +1,119 @@
+import argparse
+import gzip
+import json
+import sys
+import time
+import zlib
+
+from compression import decompress_body
+from recorder import read_recording
+
+# Measures what compressing the RPC bodies would do to the traffic of a recording made with RECORD_FILE (or --record),
+# for example of a large mission:
+#
+#   python compressionbench.py C:\dync-rpc.jsonl.gz --mbit 10
+#
+# Every recorded request and response is compressed like DCS and the server would do it, and decompressed again the
+# way the server does it. For every method, it reports the sizes, the time spent compressing and decompressing, and
+# how long the bodies take to send over a link of the given speed with and without compression. Bodies smaller than
+# --min-size are left as they are, like COMPRESSION_MIN_SIZE does.
+
+
+def time_call(function, *args, repeat=5):
+    # The best of a few tries, in ms. The first one would also measure the cache warming up.
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return result, 1000.0 * best
+
+
+def measure_body(body, encoding, min_size, level):
+    # Returns the compressed size, and the time to compress and decompress in ms
+    if len(body) < min_size:
+        return len(body), 0.0, 0.0
+    if encoding == "gzip":
+        compressed, compress_ms = time_call(gzip.compress, body, level)
+    else:
+        compressed, compress_ms = time_call(zlib.compress, body, level)
+    decompressed, decompress_ms = time_call(decompress_body, compressed, encoding)
+    if decompressed != body:
+        raise ValueError("A body did not decompress to what it was")
+    return len(compressed), compress_ms, decompress_ms
+
+
+def benchmark(recording_path, encoding="deflate", min_size=1024, level=6, mbit=10.0):
+    header, calls = read_recording(recording_path)
+    if header is None:
+        print("%s is not a recording: it has no header" % recording_path)
+        return 1
+    bytes_per_ms = mbit * 1000.0 / 8.0
+
+    results = {}
+    largest = None
+    for call in calls:
+        try:
+            method = json.loads(call["request"]).get("method", "?")
+        except (ValueError, AttributeError):
+            method = "?"
+        if method not in results:
+            results[method] = {"calls": 0, "size": 0, "compressed": 0, "compress_ms": 0.0, "decompress_ms": 0.0}
+        for body in (call["request"].encode("utf-8"), call["response"].encode("utf-8")):
+            compressed_size, compress_ms, decompress_ms = measure_body(body, encoding, min_size, level)
+            result = results[method]
+            result["size"] += len(body)
+            result["compressed"] += compressed_size
+            result["compress_ms"] += compress_ms
+            result["decompress_ms"] += decompress_ms
+            if largest is None or len(body) > largest[1]:
+                largest = (method, len(body), compressed_size, compress_ms, decompress_ms)
+        results[method]["calls"] += 1
+
+    print("%d calls from %s, %s at level %d, bodies of at least %d bytes, %.1f Mbit/s" %
+          (len(calls), recording_path, encoding, level, min_size, mbit))
+    print("%-18s %6s %12s %12s %6s %10s %10s %10s %10s" %
+          ("method", "calls", "bytes", "compressed", "ratio", "comp ms", "decomp ms", "plain ms", "sent ms"))
+    total_size = 0
+    total_compressed = 0
+    for method in sorted(results):
+        result = results[method]
+        calls_of_method = result["calls"]
+        # Per call: the time to send the bodies as they are, against the time to compress, send and decompress them
+        send_ms = result["size"] / bytes_per_ms / calls_of_method
+        compressed_ms = (result["compressed"] / bytes_per_ms + result["compress_ms"] + result["decompress_ms"]) / \
+            calls_of_method
+        print("%-18s %6d %12d %12d %6.2f %10.2f %10.2f %10.2f %10.2f" %
+              (method, calls_of_method, result["size"], result["compressed"],
+               result["compressed"] / max(result["size"], 1), result["compress_ms"] / calls_of_method,
+               result["decompress_ms"] / calls_of_method, send_ms, compressed_ms))
+        total_size += result["size"]
+        total_compressed += result["compressed"]
+    print("All bodies: %d bytes, %d compressed (%.2f)" %
+          (total_size, total_compressed, total_compressed / max(total_size, 1)))
+    if largest is not None:
+        method, size, compressed_size, compress_ms, decompress_ms = largest
+        print("Largest body, of %s: %d bytes, %d compressed in %.2f ms, decompressed in %.2f ms" %
+              (method, size, compressed_size, compress_ms, decompress_ms))
+        print("At %.1f Mbit/s it takes %.1f ms to send as it is, and %.1f ms compressed" %
+              (mbit, size / bytes_per_ms, compressed_size / bytes_per_ms + compress_ms + decompress_ms))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure compression of the RPC bodies in a recording.")
+    parser.add_argument("recording", help="File made with RECORD_FILE or dyncserver.py --record")
+    parser.add_argument("--encoding", choices=["deflate", "gzip"], default="deflate",
+                        help="Content-Encoding to measure. DynC.lua sends deflate.")
+    parser.add_argument("--min-size", type=int, default=1024, help="Bodies smaller than this are not compressed")
+    parser.add_argument("--level", type=int, default=6, help="zlib compression level")
+    parser.add_argument("--mbit", type=float, default=10.0, help="Speed of the link between DCS and the server")
+    args = parser.parse_args()
+    return benchmark(args.recording, encoding=args.encoding, min_size=args.min_size, level=args.level,
+                     mbit=args.mbit)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,6 +4,14 @@
 app_version = "0.1.9.1"
 backwards_compatibility_min_version = "0.1.9"
 
+# Skill levels as they are stored in the battle statistics
+skill_to_statistics_num = {
+    "Average": 0,
+    "Good": 1,
+    "High": 2,
+    "Excellent": 3,
+}
+
 unit_type_to_id = {
     "VINSON": 1,
     "PERRY": 2,
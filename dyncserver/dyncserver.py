@@ -1,29 +1,48 @@
 from werkzeug.wrappers import Request, Response
-from werkzeug.serving import run_simple
+from werkzeug.serving import BaseWSGIServer
 import json
-from jsonrpc import JSONRPCResponseManager, dispatcher
+import random
+import hashlib
+from jsonrpc import dispatcher
 import os.path
 from os.path import expanduser
-from threading import Thread
+from threading import Thread, RLock
+from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
 from configparser import ConfigParser
 from pathlib import Path
 import socket
+import time
+import argparse
+import multiprocessing
 import sqlite3
 import datetime
 
 from ai import *
 from classes import *
-from gui import *
-from graphics import GfxHelper
+from combat import CombatModel
+from lookahead import SimulationPool, LookaheadPlanner
+from forecast import Forecaster
+from snapshot import CampaignSnapshot, empty_snapshot, get_etag
+from compression import decompress_body, compress_body, decompress_errors, max_body_size, BodyTooLarge
+from asyncserver import AsyncRPCServer, AsyncServerThread
+from headless import HeadlessWindow
+from metrics import ServerMetrics
+from recorder import RPCRecorder
+from renderqueue import RenderQueue
 from windowloghandler import WindowLogHandler
 from message_service_discord import MessageService
 
 server_obj = None
-server_thread = None
+server_threads = []
 
 
 class DynCServer:
 
+    # RPC methods that older servers don't have. processjson tells DCS about them, so that the mission script can use
+    # them when they are there, and fall back to the old ones when they are not.
+    capabilities = ["unitsdestroyed", "delta"]
+
     cfg_default_content = \
         '[campaign]\nMAX_INFANTRY = 4\n\n' \
         '# USA AA types: "Vulcan" "M1097 Avenger" "M48 Chaparral" "Hawk cwar" "Hawk ln" "Hawk pcp"\n' \
@@ -57,9 +76,47 @@ class DynCServer:
         'PLAYER_EJECT_SCORE = 50.0\n' \
         'PLAYER_DEATH_SCORE = 100.0\n' \
         'AI_EJECT_SCORE = 5.0\n' \
-        'AI_DEATH_SCORE = 10.0\n'
-
-    def __init__(self, campaign_json, conf_file, mapbg, sqlite_path, stat_txt_path):
+        'AI_DEATH_SCORE = 10.0\n\n' \
+        '[ai]\n\n' \
+        '# Seconds per turn that the AI may spend improving its moves, after it has decided the basic ones. 0 = off\n' \
+        'TURN_TIME_BUDGET = 0\n\n' \
+        '# Set LOOKAHEAD = 1 to spend the budget also on simulating a few turns ahead, in separate processes.\n' \
+        '# SIMULATION_PROCESSES = 0 means one process per CPU core.\n' \
+        'LOOKAHEAD = 0\n' \
+        'SIMULATION_PROCESSES = 0\n' \
+        'LOOKAHEAD_TURNS = 3\n' \
+        'LOOKAHEAD_CANDIDATES = 8\n' \
+        'LOOKAHEAD_ROLLOUTS = 4\n\n' \
+        '# Default number of turns and random runs of a forecast of where the front will be\n' \
+        'FORECAST_TURNS = 3\n' \
+        'FORECAST_RUNS = 64\n\n' \
+        '[server]\n\n' \
+        '# REMOTE_PORT listens on the network address of this computer. Set it to 0 to listen only locally.\n' \
+        '# WORKERS is the number of requests that can be handled at the same time.\n' \
+        'LOCAL_PORT = 44444\n' \
+        'REMOTE_PORT = 44445\n' \
+        'WORKERS = 8\n\n' \
+        '# SERVER = asyncio serves all requests from one event loop instead of a thread per request. Slow\n' \
+        '# side effects like Discord messages then no longer hold up the answer to DCS.\n' \
+        'SERVER = threaded\n\n' \
+        '# HEADLESS = 1 runs the server without a window, for example on a dedicated host without a display. The\n' \
+        '# map is then drawn only when someone asks for /map.png, or after every turn if MAP_FILE is set.\n' \
+        'HEADLESS = 0\n' \
+        '# MAP_FILE = C:\\dync-map.png\n\n' \
+        '# Responses of at least COMPRESSION_MIN_SIZE bytes are compressed for clients that ask for it. 0 = never.\n' \
+        'COMPRESSION_MIN_SIZE = 1024\n\n' \
+        '# PIPELINE_MISSIONEND = 1 answers DCS at the end of a mission right away, and resolves the turn in the\n' \
+        '# background. The next call that changes the campaign waits for it for at most\n' \
+        '# MISSION_END_TIMEOUT seconds.\n' \
+        'PIPELINE_MISSIONEND = 1\n' \
+        'MISSION_END_TIMEOUT = 120\n\n' \
+        '[debug]\n\n' \
+        '# RECORD_FILE records every RPC call to the file, to be played again with replay.py. End the name with .gz\n' \
+        '# to compress it. RNG_SEED makes the AI decide the same way every time, which a replay also needs.\n' \
+        '# RECORD_FILE = C:\\dync-rpc.jsonl.gz\n' \
+        '# RNG_SEED = 1\n'
+
+    def __init__(self, campaign_json, conf_file, mapbg, sqlite_path, stat_txt_path, headless=False):
         self.logger = logging.getLogger('general')
         self.logger.setLevel(logging.DEBUG)
         self.log_file_handler = None
@@ -86,12 +143,59 @@ class DynCServer:
         self.player_death_score = 100.0
         self.ai_eject_score = 5.0
         self.ai_death_score = 10.0
+        self.turn_time_budget = 0.0
+        self.simulation_pool = None
+        self.lookahead_planner = None
+        self.forecaster = None
+        self.forecast_turns = 3
+        self.forecast_runs = 64
+        self.mission_in_progress = False
+        self.last_planning_metrics = {}
+        self.local_port = 44444
+        self.remote_port = 44445
+        self.num_server_workers = 8
+        self.compression_min_size = 1024
+        self.server_mode = "threaded"
+        self.headless = headless
+        self.map_file = None
+        self.async_server = None
+        # The last full processjson request, and its hash. See apply_delta.
+        self.known_request = None
+        self.known_maphash = None
+        self.snapshot = empty_snapshot
+        self.metrics = ServerMetrics()
+        self.recorder = None
+        self.record_file = None
+        self.rng_seed = None
+        self.rendered_map = None
+        # What the current map is drawn from, for drawing its tiles. See get_map_tile.
+        self.map_drawing = None
+        # The end of the last mission, being resolved in the background. See missionend.
+        self.pipeline_missionend = True
+        self.mission_end_timeout = 120.0
+        self.mission_end_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="missionend")
+        self.mission_end_future = None
+        self.ended_campaign_result = None
+        # Maps are drawn here, after the answer to DCS. The map number goes up with every change to the campaign, so
+        # that a map that was drawn for an older campaign is never shown after a newer one.
+        self.render_queue = RenderQueue(self.metrics.renders_dropped)
+        self.map_number = 0
+        # Works ahead on the next turn while a mission is being played. See precompute_next_turn.
+        self.precompute_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="precompute")
+
+        # Requests are served by several threads at once. Everything that changes the campaign holds this lock, so
+        # that for example a unitdestroyed can't land in the middle of a processjson. It's reentrant, because some of
+        # those functions call each other.
+        self.campaign_lock = RLock()
 
         if os.path.isfile(self.conf_file) is False:
             with open(self.conf_file, 'w') as f:
                 f.write(DynCServer.cfg_default_content)
         self.init_campaign()
         self.read_config(self.conf_file)
+        if self.rng_seed is not None:
+            random.seed(self.rng_seed)
+            np.random.seed(self.rng_seed)
         self.sqlite_path = sqlite_path
         self.stat_txt_path = stat_txt_path
 
@@ -100,6 +204,8 @@ class DynCServer:
             self.init_sqlite(conn)
             conn.close()
 
+        self.combat_model = CombatModel.from_sqlite(self.sqlite_path)
+
     @staticmethod
     def init_sqlite(conn):
         c = conn.cursor()
@@ -129,8 +235,52 @@ class DynCServer:
                     self.campaign = Campaign(stage=0, game_map=game_map, software_version=constants.app_version)
 
     def post_init(self):
-        if self.campaign.stage > 0:
-            self.campaign_changed()
+        with self.campaign_lock:
+            if self.campaign.stage > 0:
+                self.campaign_changed()
+                self.precompute_next_turn()
+            self.publish_snapshot()
+
+    def precompute_next_turn(self):
+        # Must be called with the campaign lock held. Between the start and the end of a mission, the server has nothing
+        # to do for an hour or more, and the next processjson plans the turn from the nodes that the groups were just
+        # sent to. So we find out the moves that make sense from those nodes, and their neighbors, already now, along
+        # with the distances from the goals that find_greatest_threat_node uses and the coordinates of the nodes.
+        #
+        # That is as far ahead as we can work. The plans themselves can't be made yet: processjson first moves every
+        # group by the decisions of the previous turn and sets up the battles, and missionend before that puts the
+        # groups where DCS saw them, so the board that the AI plans on only exists in processjson. For the same reason,
+        # what kill reports change isn't patched here. The counts of units and threats per node (get_units_per_node
+        # and find_greatest_threat_node) are read from the groups in one pass over them, once the groups have moved,
+        # which costs less than checking a precomputed copy would. What is slow in them, the paths, only depends on
+        # the graph. This all matters most for the first turn after the server starts, when the caches are empty.
+        if self.campaign is None or self.campaign.map is None or self.campaign.map.graph is None:
+            return
+        game_map = self.campaign.map
+        node_ids = set()
+        for group in game_map.groups().values():
+            if group.category != "vehicle":
+                continue
+            node_id = game_map.find_group_node(group)
+            if node_id is not None:
+                node_ids.add(int(node_id))
+        for node_id in self.campaign.get_movement_decisions().values():
+            if node_id is not None:
+                node_ids.add(int(node_id))
+        for node_id in list(node_ids):
+            node_ids.update(int(neighbor) for neighbor in game_map.graph[node_id])
+        # The graph never changes in place, and nothing else of the map is needed, so the work is done on a fork
+        self.precompute_executor.submit(self.run_precompute, game_map.fork(), sorted(node_ids))
+
+    def run_precompute(self, game_map, node_ids):
+        # noinspection PyBroadException
+        try:
+            start = time.perf_counter()
+            num_nodes = precompute_move_choices(game_map, node_ids)
+            self.logger.debug("Precomputed the moves from %d nodes for the next turn in %.1f ms" %
+                              (num_nodes, 1000.0 * (time.perf_counter() - start)))
+        except Exception:
+            self.logger.exception("Exception while precomputing the next turn", exc_info=True)
 
     def read_config(self, conf_file):
         # Note that logging is not completely set up in this function yet. You can partially log, but not to the window.
@@ -170,6 +320,45 @@ class DynCServer:
             self.ai_eject_score = float(self.config.get("scoring", "AI_EJECT_SCORE"))
         if self.config.has_option("scoring", "AI_DEATH_SCORE"):
             self.ai_death_score = float(self.config.get("scoring", "AI_DEATH_SCORE"))
+        if self.config.has_option("ai", "TURN_TIME_BUDGET"):
+            self.turn_time_budget = float(self.config.get("ai", "TURN_TIME_BUDGET"))
+        if self.config.has_option("server", "LOCAL_PORT"):
+            self.local_port = int(self.config.get("server", "LOCAL_PORT"))
+        if self.config.has_option("server", "REMOTE_PORT"):
+            self.remote_port = int(self.config.get("server", "REMOTE_PORT"))
+        if self.config.has_option("server", "WORKERS"):
+            self.num_server_workers = int(self.config.get("server", "WORKERS"))
+        if self.config.has_option("server", "HEADLESS") and int(self.config.get("server", "HEADLESS")) != 0:
+            self.headless = True
+        if self.config.has_option("server", "MAP_FILE"):
+            self.map_file = Path(self.config.get("server", "MAP_FILE"))
+        if self.config.has_option("server", "SERVER"):
+            self.server_mode = self.config.get("server", "SERVER").strip().lower()
+        if self.config.has_option("server", "COMPRESSION_MIN_SIZE"):
+            self.compression_min_size = int(self.config.get("server", "COMPRESSION_MIN_SIZE"))
+        if self.config.has_option("server", "PIPELINE_MISSIONEND"):
+            self.pipeline_missionend = self.config.get("server", "PIPELINE_MISSIONEND").strip() == "1"
+        if self.config.has_option("server", "MISSION_END_TIMEOUT"):
+            self.mission_end_timeout = float(self.config.get("server", "MISSION_END_TIMEOUT"))
+        if self.config.has_option("debug", "RECORD_FILE"):
+            self.record_file = Path(self.config.get("debug", "RECORD_FILE"))
+        if self.config.has_option("debug", "RNG_SEED"):
+            self.rng_seed = int(self.config.get("debug", "RNG_SEED"))
+        if self.config.has_option("ai", "FORECAST_TURNS"):
+            self.forecast_turns = int(self.config.get("ai", "FORECAST_TURNS"))
+        if self.config.has_option("ai", "FORECAST_RUNS"):
+            self.forecast_runs = int(self.config.get("ai", "FORECAST_RUNS"))
+        if self.simulation_pool is not None:
+            self.simulation_pool.close()
+        self.simulation_pool = SimulationPool(int(self.config.get("ai", "SIMULATION_PROCESSES", fallback="0")))
+        self.forecaster = Forecaster(self.simulation_pool)
+        self.lookahead_planner = None
+        if self.config.has_option("ai", "LOOKAHEAD") and int(self.config.get("ai", "LOOKAHEAD")) != 0:
+            self.lookahead_planner = \
+                LookaheadPlanner(self.simulation_pool,
+                                 num_turns=int(self.config.get("ai", "LOOKAHEAD_TURNS", fallback="3")),
+                                 num_candidates=int(self.config.get("ai", "LOOKAHEAD_CANDIDATES", fallback="8")),
+                                 num_rollouts=int(self.config.get("ai", "LOOKAHEAD_ROLLOUTS", fallback="4")))
 
         self.log_file_handler.setLevel(log_file_level)
         self.log_file_handler.setFormatter(self.log_file_formatter)
@@ -179,7 +368,8 @@ class DynCServer:
         self.log_window_handler.setFormatter(self.log_window_formatter)
         self.logger.addHandler(self.log_file_handler)
         self.logger.addHandler(self.log_console_handler)
-        self.logger.addHandler(self.log_window_handler)
+        if not self.headless:
+            self.logger.addHandler(self.log_window_handler)
 
         # From here on, you can log to console and file, but not to the window log yet.
 
@@ -222,21 +412,158 @@ class DynCServer:
                 '# Add the line below to [comms] with correct URL to have the server post to a Discord channel. The\n' \
                 '# "user" field already there is the username of the Discord bot doing the posting.\n' \
                 '# url = https://discordapp.com/api/webhooks/SOMETHING\n#\n' \
+                '# Field "turn_time_budget" in [ai] is the number of seconds per turn that the AI may spend\n' \
+                '# improving its moves after it has decided the basic ones. Zero turns this off. With\n' \
+                '# "lookahead" = 1, part of the budget goes to simulating "lookahead_turns" turns ahead in\n' \
+                '# "simulation_processes" processes (0 = one per CPU core). Forecasts use the same processes.\n#\n' \
+                '# In [server], "remote_port" = 0 means that the server only listens on "local_port" of localhost.\n' \
+                '# Changes to [server] take effect when the server is restarted.\n#\n' \
                 '# Please note that if you comment something out of this config, the comment will disappear the\n' \
                 '# next time that the software re-writes the config.\n\n'
             fp.write(comments)
             self.config.write(fp)
 
     def reset_campaign(self):
-        self.delete_campaign()
-        self.init_campaign()
-        self.window.erase_window()
-        self.read_config(self.conf_file)
+        with self.campaign_lock:
+            self.delete_campaign()
+            self.init_campaign()
+            self.map_number += 1
+            self.render_queue.submit(self.window.erase_window)
+            self.read_config(self.conf_file)
+            self.rendered_map = None
+            self.map_drawing = None
+            self.publish_snapshot()
+
+    def with_campaign_lock(self, function):
+        # Every change is followed by a new snapshot, before anyone else gets the lock.
+        def locked_function(*args, **kwargs):
+            # A mission end that is still being resolved comes before anything else
+            if self.wait_for_mission_end() is False:
+                return '{"code": "1", "error": "The previous mission is still being resolved. Try again later."}'
+            with self.campaign_lock:
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.publish_snapshot()
+        return locked_function
+
+    def wait_for_mission_end(self):
+        # Returns False if the previous mission end did not finish in MISSION_END_TIMEOUT seconds.
+        future = self.mission_end_future
+        if future is None or future.done():
+            return True
+        start = time.perf_counter()
+        try:
+            future.result(timeout=self.mission_end_timeout)
+        except concurrent.futures.TimeoutError:
+            self.logger.warning("The previous mission end took over %d seconds to resolve" % self.mission_end_timeout)
+            return False
+        finally:
+            self.metrics.mission_end_wait_duration.observe(time.perf_counter() - start)
+        return True
+
+    def finish_mission_end(self):
+        # At exit, so that the turn is resolved and saved, and its map drawn, before we go
+        self.mission_end_executor.shutdown(wait=True)
+        self.render_queue.wait()
+
+    def handle_rpc(self, data, rpc_dispatcher):
+        # Both kinds of server come here with the decompressed body of a request. Returns the response as a string.
+        start = time.perf_counter()
+        response_json = self.metrics.handle_rpc(data, rpc_dispatcher)
+        if self.recorder is not None:
+            self.recorder.record(data, response_json, time.perf_counter() - start)
+        return response_json
+
+    def start_recording(self, path):
+        # The header has what replay.py needs to start from the same state: the campaign as it is now, and the seed. A
+        # mission end that is still being resolved belongs to the campaign in the header.
+        self.wait_for_mission_end()
+        with self.campaign_lock:
+            campaign = None
+            if self.campaign is not None and self.campaign.map is not None and self.campaign.map.graph is not None:
+                campaign = self.campaign.to_serializable()
+            header = {"app_version": constants.app_version, "rng_seed": self.rng_seed,
+                      "started": datetime.datetime.now().isoformat(), "campaign": campaign}
+            # The random numbers must be the same from here on as they will be in the replay, which starts with a
+            # freshly seeded server.
+            if self.rng_seed is not None:
+                random.seed(self.rng_seed)
+                np.random.seed(self.rng_seed)
+            self.recorder = RPCRecorder(path, header)
+        self.logger.info("Recording RPC calls to %s" % path)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def publish_snapshot(self):
+        # Must be called with the campaign lock held. See snapshot.py.
+        # noinspection PyBroadException
+        try:
+            version = self.snapshot.version + 1
+            if self.campaign is None or self.campaign.map is None or self.campaign.map.graph is None:
+                self.snapshot = CampaignSnapshot(version, {"status": {"campaign": False}})
+                return
+
+            game_map = self.campaign.map
+            decisions = self.campaign.get_movement_decisions()
+            groups_dict = game_map.groups()
+            groups = []
+            num_units = {"red": 0, "blue": 0}
+            num_groups = {"red": 0, "blue": 0}
+            for group_name in sorted(groups_dict):
+                group = groups_dict[group_name]
+                node_id = game_map.find_group_node(group)
+                coords = game_map.get_node_coords(node_id)
+                destination = decisions.get(group_name)
+                groups.append({"name": group_name, "coalition": group.coalition, "category": group.category,
+                               "type": group.get_type(), "units": group.num_units(), "node": int(node_id),
+                               "pos": "%f,%f" % (coords[0], coords[1]),
+                               "destination": int(destination) if destination is not None else None})
+                if group.coalition in num_units and group.category == "vehicle":
+                    num_units[group.coalition] += group.num_units()
+                    num_groups[group.coalition] += 1
+
+            score_red, score_blue = self.get_scores()
+            self.metrics.stage.set(self.campaign.stage)
+            self.metrics.nodes.set(game_map.graph.number_of_nodes())
+            for coalition in ("red", "blue"):
+                self.metrics.groups.set(num_groups[coalition], coalition)
+                self.metrics.units.set(num_units[coalition], coalition)
+            status = {"campaign": True, "stage": self.campaign.stage, "version": constants.app_version,
+                      "mission_in_progress": self.mission_in_progress, "groups": num_groups, "units": num_units,
+                      "resources": dict(self.campaign.resources_generic),
+                      "support": {"red": game_map.get_num_support_units("red"),
+                                  "blue": game_map.get_num_support_units("blue")}}
+            self.snapshot = CampaignSnapshot(version, {
+                "status": status,
+                "groups": {"stage": self.campaign.stage, "groups": groups},
+                "scores": {"stage": self.campaign.stage, "red": score_red, "blue": score_blue,
+                           "extra": dict(self.campaign.extra_scores)}}, rendered_map=self.rendered_map)
+        except Exception:
+            # The old snapshot stays. Better a little out of date than a failed request that had already done its job.
+            self.logger.exception("Exception while publishing campaign snapshot", exc_info=True)
+
+    def get_status(self):
+        return self.snapshot.get_json("status")
+
+    def get_groups(self):
+        return self.snapshot.get_json("groups")
+
+    def get_score_document(self):
+        return self.snapshot.get_json("scores")
+
+    def get_graph_image(self, heat=None):
+        return self.draw_map_drawing(self.get_map_drawing(heat=heat))
 
-    def get_graph_image(self):
+    def get_map_drawing(self, heat=None):
+        # Everything that GfxHelper.draw_map needs, taken from the campaign. Must be called with the campaign lock held,
+        # but the drawing itself can then be done without it. Returns None if there is nothing to draw.
         if self.campaign.map is None or self.campaign.map.graph is None:
             self.logger.warning("Cannot draw graph because some information is missing")
-            return
+            return None
         coords, bbox = self.campaign.map.get_nodes_in_graphical_coords()
 
         groups_dict = self.campaign.map.groups()
@@ -322,12 +649,22 @@ class DynCServer:
         #     added_score = (1.0 + multiplier) * group.num_units() * self.unit_base_score
         #     score[group.coalition] += added_score
 
-        return GfxHelper.draw_map(graph=self.campaign.map.graph, coords=coords, bbox=bbox,
-                                  red_goal=self.campaign.map.red_goal_node, blue_goal=self.campaign.map.blue_goal_node,
-                                  groups=passed_groups_dict, movement_decisions=movement_list,
-                                  paths=self.display_map_paths, mapmarkers=graphical_coord_mapmarkers,
-                                  cornermarkers=graphical_coord_cornermarkers, bullseyes=bullseyes, mapbg=param_mapbg,
-                                  score=None)
+        # The graph is never changed in place, only replaced, so the drawing can keep using this one.
+        return {"graph": self.campaign.map.graph, "coords": coords, "bbox": bbox,
+                "red_goal": self.campaign.map.red_goal_node, "blue_goal": self.campaign.map.blue_goal_node,
+                "groups": passed_groups_dict, "movement_decisions": movement_list, "paths": self.display_map_paths,
+                "mapmarkers": graphical_coord_mapmarkers, "heat": heat, "cornermarkers": graphical_coord_cornermarkers,
+                "bullseyes": bullseyes, "mapbg": param_mapbg, "score": None}
+
+    def draw_map_drawing(self, drawing):
+        if drawing is None:
+            return None
+        # Imported here, so that a headless server that nobody asks for a map never loads the drawing code
+        from graphics import GfxHelper
+        start = time.perf_counter()
+        rendered_map = GfxHelper.draw_map(**drawing)
+        self.metrics.render_duration.observe(time.perf_counter() - start)
+        return rendered_map
 
     # Red first, then blue
     def get_scores(self):
@@ -380,18 +717,46 @@ class DynCServer:
 
     @staticmethod
     def skill_string_to_statistics_num(skill_str):
-        num = -1
-        if skill_str == "Average":
-            num = 0
-        elif skill_str == "Good":
-            num = 1
-        elif skill_str == "High":
-            num = 2
-        elif skill_str == "Excellent":
-            num = 3
-        return num
+        if skill_str in constants.skill_to_statistics_num:
+            return constants.skill_to_statistics_num[skill_str]
+        return -1
 
     def missionend(self, param):
+        # DCS is closing the mission while it waits for this answer, so by default we only check the request here, and
+        # resolve the turn on a worker of its own. Everything that changes the campaign waits for that to finish first,
+        # in with_campaign_lock, so it's as if it had happened right here.
+        # noinspection PyBroadException
+        try:
+            if self.campaign is None:
+                return ""
+            obj = json.loads(param)
+            for key in ["shot", "time", "starttime"]:
+                if key not in obj:
+                    self.logger.error("Missing %s in missionend" % key)
+                    return '{"code": "1", "error": "Invalid request: missing %s"}' % key
+        except Exception:
+            self.logger.exception("Exception in missionend", exc_info=True)
+            return '{"code": "1", "error": "Internal Server Error. See server logs for more information."}'
+
+        if self.pipeline_missionend is False:
+            return self.resolve_mission_end(obj)
+        self.mission_end_future = self.mission_end_executor.submit(self.resolve_mission_end_in_background, obj)
+        return '{"code": "0", "event": "queued"}'
+
+    def resolve_mission_end_in_background(self, obj):
+        start = time.perf_counter()
+        with self.campaign_lock:
+            try:
+                result = self.resolve_mission_end(obj)
+            finally:
+                self.publish_snapshot()
+        self.metrics.mission_end_duration.observe(time.perf_counter() - start)
+        # DCS didn't get to hear that the campaign ended, so it's told in the answer to the next processjson.
+        if '"event": "end"' in result:
+            self.ended_campaign_result = json.loads(result)["result"]
+        return result
+
+    def resolve_mission_end(self, obj):
         # noinspection PyBroadException
         try:
             if self.campaign is None:
@@ -401,7 +766,8 @@ class DynCServer:
             victory_red = False
             victory_blue = False
 
-            obj = json.loads(param)
+            # The battles of this mission have now been fought in DCS, so forecasts must not play them again.
+            self.mission_in_progress = False
             shot_groups = obj["shot"]
             mission_time = obj["time"]
             start_time = obj["starttime"]
@@ -704,8 +1070,7 @@ class DynCServer:
 
             self.campaign.stage += 1
 
-            with open(self.campaign_json, 'w') as f:
-                json.dump(self.campaign.to_serializable(), f)
+            self.save_campaign()
 
             return '{"code": "0", "event": "continue"}'
         except Exception:
@@ -769,6 +1134,9 @@ class DynCServer:
         conn.commit()
         conn.close()
 
+        # New battles to learn from. Fitting is quick compared to the rest of the mission end, so we just redo it.
+        self.combat_model = CombatModel.from_sqlite(self.sqlite_path)
+
     @staticmethod
     def get_type_string_from_int(sought_key):
         for key, value in constants.unit_type_to_id.items():
@@ -896,6 +1264,10 @@ class DynCServer:
 
     def post_message_if_necessary(self, message):
         if self.messages_user is not None:
+            if self.async_server is not None:
+                self.async_server.post_in_background(MessageService.hook_post_message, self.messages_user, message,
+                                                     self.messages_url)
+                return
             MessageService.hook_post_message(username=self.messages_user, url=self.messages_url,
                                              message=message)
 
@@ -936,49 +1308,130 @@ class DynCServer:
             return
 
         self.logger.info("--Changed score: red %s, blue %s--" % (repr(scores[0]), repr(scores[1])))
-        self.window.update_score(scores)
+        self.render_queue.submit_latest("score", self.window.update_score, scores)
+
+    def save_campaign(self):
+        start = time.perf_counter()
+        campaign_str = json.dumps(self.campaign.to_serializable())
+        with open(self.campaign_json, 'w') as f:
+            f.write(campaign_str)
+        self.metrics.save_duration.observe(time.perf_counter() - start)
+        self.metrics.save_bytes.set(len(campaign_str))
+
+    def apply_unit_destroyed(self, unitname, groupname, time, starttime):
+        # Returns False if there was no such group.
+        group = self.campaign.map.find_group_by_name(groupname)
+
+        if group is None:
+            self.logger.warning("Unit %s in group %s supposed to be destroyed, but was not found" %
+                                (unitname, groupname))
+            return False
+
+        self.campaign.deaths.append({"time": time - starttime, "unitname": unitname, "groupname": groupname,
+                                     "type": group.get_type()})
+        self.campaign.destroy_unit(unitname, groupname)
+        return True
 
     def unitdestroyed(self, unitname, groupname, time, starttime):
 
         # noinspection PyBroadException
         try:
-            group = self.campaign.map.find_group_by_name(groupname)
-
-            if group is None:
-                self.logger.warning("Unit %s in group %s supposed to be destroyed, but was not found" %
-                                    (unitname, groupname))
+            if self.apply_unit_destroyed(unitname, groupname, time, starttime) is False:
                 return ""
 
-            if unitname not in self.campaign.destroyed_unit_names_and_groups:
-                self.campaign.destroyed_unit_names_and_groups[unitname] = {"group": groupname}
+            self.save_campaign()
+
+            return "ok"
+        except Exception:
+            self.logger.exception("Exception in unitdestroyed", exc_info=True)
+            return '{"code": "1", "error": "Internal Server Error. See server logs for more information."}'
 
-            self.campaign.deaths.append({"time": time - starttime, "unitname": unitname, "groupname": groupname,
-                                         "type": group.get_type()})
+    def unitsdestroyed(self, units):
+        # Same as unitdestroyed, for many units at once, and with only one save at the end. DCS uses this at mission
+        # end, where a large battle can leave dozens of units to report. units is a list of [unitname, groupname, time,
+        # starttime] lists.
 
-            for dict_unit_name in group.units:
-                if dict_unit_name == unitname:
-                    # print("__unit destroyed of name %s skill %s" %
-                    #       (dict_unit_name, group.units[dict_unit_name].skill))
-                    del group.units[dict_unit_name]
-                    break
-            if len(group.units) == 0:
-                self.logger.info("That was group's final unit, remove group")
-                if groupname in self.campaign.unit_movement_decisions:
-                    del self.campaign.unit_movement_decisions[groupname]
-                self.campaign.map.remove_group(group)
+        # noinspection PyBroadException
+        try:
+            num_destroyed = 0
+            for unit_data in units:
+                if self.apply_unit_destroyed(unit_data[0], unit_data[1], unit_data[2], unit_data[3]):
+                    num_destroyed += 1
 
-            with open(self.campaign_json, 'w') as f:
-                json.dump(self.campaign.to_serializable(), f)
+            if num_destroyed > 0:
+                self.save_campaign()
 
+            self.logger.info("Received %d destroyed units in one batch" % len(units))
             return "ok"
         except Exception:
-            self.logger.exception("Exception in unitdestroyed", exc_info=True)
+            self.logger.exception("Exception in unitsdestroyed", exc_info=True)
+            return '{"code": "1", "error": "Internal Server Error. See server logs for more information."}'
+
+    def autoresolve(self):
+        # Resolves the battles of the current mission with the combat model, instead of flying the mission. The
+        # casualties are applied as if DCS had reported them, so after this the mission can be ended normally.
+        # noinspection PyBroadException
+        try:
+            if self.campaign is None or self.campaign.map.graph is None:
+                return '{"code": "1", "error": "No campaign in progress"}'
+
+            outcomes = self.combat_model.resolve_battles(self.campaign, self.campaign.early_battles)
+            results = []
+            for outcome in outcomes:
+                for unit_name, group_name in outcome["destroyed"]:
+                    group = self.campaign.map.find_group_by_name(group_name)
+                    if group is None:
+                        continue
+                    # There is no mission time for these deaths, so they all happen at the very start.
+                    self.campaign.deaths.append({"time": 0.0, "unitname": unit_name, "groupname": group_name,
+                                                 "type": group.get_type()})
+                    self.campaign.destroy_unit(unit_name, group_name)
+                self.logger.info("Auto-resolved battle between %s: %d red and %d blue units survived" %
+                                 (", ".join(sorted(outcome["group_names"])), outcome["survivors"]["red"],
+                                  outcome["survivors"]["blue"]))
+                results.append({"groups": sorted(outcome["group_names"]), "survivors": outcome["survivors"],
+                                "destroyed": [unit_name for unit_name, _ in outcome["destroyed"]]})
+
+            self.save_campaign()
+
+            return json.dumps({"code": "0", "battles": results})
+        except Exception:
+            self.logger.exception("Exception in autoresolve", exc_info=True)
             return '{"code": "1", "error": "Internal Server Error. See server logs for more information."}'
 
+    @staticmethod
+    def get_maphash(obj):
+        return hashlib.sha1(json.dumps(obj, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def apply_delta(self, obj):
+        # Protocol 2. Routes, goals, markers and bullseyes never change during a campaign, and neither do the units in
+        # the mission file, so after the first mission DCS sends only the hash that we gave it last time, and the units
+        # that differ from the ones it sent then. We rebuild the full request from the one we remember. Returns None if
+        # we don't remember the request that the hash is for, for example because the server was restarted. Then DCS
+        # has to send everything.
+        if self.known_request is None or obj["maphash"] != self.known_maphash:
+            return None
+        full_obj = dict(self.known_request)
+        units = dict(self.known_request["units"])
+        # An empty Lua table becomes an empty JSON list
+        if isinstance(obj.get("units"), dict):
+            units.update(obj["units"])
+        for unit_name in obj.get("removedunits", []):
+            units.pop(unit_name, None)
+        full_obj["units"] = units
+        self.logger.info("Received %d changed and %d removed units with map hash %s" %
+                         (len(obj.get("units", [])), len(obj.get("removedunits", [])), obj["maphash"]))
+        return full_obj
+
     def processjson(self, jsondata):
         # noinspection PyBroadException
         try:
             obj = json.loads(jsondata)
+            if obj.get("protocol", 1) >= 2 and "maphash" in obj:
+                obj = self.apply_delta(obj)
+                if obj is None:
+                    self.logger.info("Map hash from DCS is unknown. Asking for the full mission.")
+                    return '{"code": "2", "error": "Unknown map hash. Send the full mission."}'
             routes = obj["routes"]
             units = obj["units"]
             goals = obj["goals"]
@@ -1326,7 +1779,25 @@ class DynCServer:
             # print("__eb: %s" % repr(self.campaign.early_battles))
 
             # Positions done, if this was not stage 0. In all stages, also decide destinations.
-            # Do not make decisions for aa-groups yet, that will happen in a loop after this.
+            # Do not make decisions for aa-groups yet, that will happen in a loop after this. The groups that are free
+            # to move are planned together first, so that the planner can use its time budget on them as a whole.
+            movable_groups = []
+            for group_name in groups:
+                group = groups[group_name]
+                if group is None or group.category != "vehicle" or "__sg__" in group_name or "__spaa__" in group_name:
+                    continue
+                enemy_coalition = "blue" if group.coalition == "red" else "red"
+                origin_node = self.campaign.map.find_group_node(group)
+                if self.campaign.map.get_num_coalition_infantry_in_node(enemy_coalition, origin_node) == 0:
+                    movable_groups.append(group)
+
+            if self.lookahead_planner is not None and self.turn_time_budget > 0:
+                self.simulation_pool.prepare(self.campaign)
+            planner = TurnPlanner(self.campaign.map, self.turn_time_budget, self.combat_model,
+                                  lookahead=self.lookahead_planner, campaign=self.campaign)
+            planned_moves = planner.plan(movable_groups)
+            self.last_planning_metrics = planner.metrics
+
             for group_name in groups:
                 group = groups[group_name]
 
@@ -1345,7 +1816,7 @@ class DynCServer:
                     self.campaign.map.get_num_coalition_infantry_in_node(enemy_coalition, origin_node)
 
                 if num_enemy_infantry == 0:
-                    node_id = decide_move(group, self.campaign.map)
+                    node_id = planned_moves[group_name]
 
                     if node_id is not None:
 
@@ -1416,7 +1887,9 @@ class DynCServer:
             # Dynamic groups may have been added, so re-reading groups.
             groups = self.campaign.map.groups()
 
-            # Now deciding aa-groups, since we know where normal groups have moved.
+            # Now deciding aa-groups, since we know where normal groups have moved. Every AA group heads for the
+            # frontline, so it's worked out once for both coalitions instead of once per group.
+            self.campaign.map.update_frontlines()
             for group_name in groups:
                 group = groups[group_name]
 
@@ -1434,6 +1907,7 @@ class DynCServer:
                     coords = self.campaign.map.get_node_coords(node_id)
                     groups_dest[group_name] = "%f,%f" % (coords[0], coords[1])
                     self.campaign.set_movement_decision(group, node_id)
+            self.campaign.map.clear_frontlines()
 
             # Returns -1 if there are no threats at all
             threat_for_blue = self.campaign.map.find_greatest_threat_node(self.campaign.map.red_goal_node, "red")
@@ -1472,44 +1946,213 @@ class DynCServer:
                           "supportnum": {"red": "%d" % self.campaign.map.get_num_support_units("red"),
                                          "blue": "%d" % self.campaign.map.get_num_support_units("blue")},
                           "infantrypos": {"red": infantry_pos_dict["red"], "blue": infantry_pos_dict["blue"]},
-                          "dyngroups": self.campaign.get_all_dynamic_groups()}
+                          "dyngroups": self.campaign.get_all_dynamic_groups(),
+                          "capabilities": DynCServer.capabilities}
 
-            with open(self.campaign_json, 'w') as f:
-                # Upon saving, we always update the version number of the campaign file to the present version, since
-                # this app version is now fully its creator.
-                self.campaign.software_version = constants.app_version
-                json.dump(self.campaign.to_serializable(), f)
+            # Covers everything since the start of the previous mission
+            self.logger.info("Server timings before stage %d: %s" % (self.campaign.stage, self.metrics.summarize()))
 
+            self.known_request = obj
+            self.known_maphash = DynCServer.get_maphash(obj)
+            returndata["maphash"] = self.known_maphash
+            if self.ended_campaign_result is not None:
+                returndata["campaignended"] = self.ended_campaign_result
+                self.ended_campaign_result = None
+
+            # Upon saving, we always update the version number of the campaign file to the present version, since this
+            # app version is now fully its creator.
+            self.campaign.software_version = constants.app_version
+            self.save_campaign()
+
+            self.mission_in_progress = True
             self.campaign_changed()
+            self.precompute_next_turn()
 
             return json.dumps(returndata)
         except Exception as e:
             self.logger.exception("Exception in processjson", exc_info=True)
             raise e
 
+    def forecast(self, turns=None, runs=None):
+        # What-if: where will the front be after the given number of turns? Nothing in the campaign changes. Returns
+        # the probability, for every node that anyone may occupy, that each coalition has vehicles there.
+        # noinspection PyBroadException
+        try:
+            if self.campaign is None or self.campaign.map is None or self.campaign.map.graph is None:
+                return '{"code": "1", "error": "No campaign in progress"}'
+            if turns is None:
+                turns = self.forecast_turns
+            if runs is None:
+                runs = self.forecast_runs
+            if self.wait_for_mission_end() is False:
+                return '{"code": "1", "error": "The previous mission is still being resolved. Try again later."}'
+            # The forecast itself runs without the lock, on a fork, so that it doesn't hold up the game.
+            with self.campaign_lock:
+                campaign = self.campaign.fork()
+                mission_in_progress = self.mission_in_progress
+            result = self.forecaster.forecast(campaign, self.combat_model, int(turns), int(runs), mission_in_progress)
+            if result is None:
+                return '{"code": "1", "error": "Forecast did not finish in time"}'
+            returndata = {"code": "0", "stage": "%d" % result["stage"], "turns": result["turns"],
+                          "runs": result["runs"], "results": result["results"], "nodes": {}}
+            for node_id in result["nodes"]:
+                coords = self.campaign.map.get_node_coords(node_id)
+                returndata["nodes"]["%d" % node_id] = {"pos": "%f,%f" % (coords[0], coords[1]),
+                                                       "red": result["nodes"][node_id]["red"],
+                                                       "blue": result["nodes"][node_id]["blue"]}
+            return json.dumps(returndata)
+        except Exception:
+            self.logger.exception("Exception in forecast", exc_info=True)
+            return '{"code": "1", "error": "Internal Server Error. See server logs for more information."}'
+
+    def show_forecast(self):
+        # For the GUI. Draws the forecast over the map, until the campaign changes.
+        if self.campaign is None or self.campaign.map is None or self.campaign.map.graph is None:
+            self.logger.warning("Cannot forecast, because there is no campaign in progress")
+            return
+        self.wait_for_mission_end()
+        with self.campaign_lock:
+            campaign = self.campaign.fork()
+            mission_in_progress = self.mission_in_progress
+        result = self.forecaster.forecast(campaign, self.combat_model, self.forecast_turns, self.forecast_runs,
+                                          mission_in_progress)
+        if result is None:
+            return
+        self.logger.info("Forecast for %d turns: red wins %d, blue wins %d, draw %d, no result %d of %d runs" %
+                         (result["turns"], result["results"]["red"], result["results"]["blue"],
+                          result["results"]["draw"], result["results"]["none"], result["runs"]))
+        # The overlay is only for the picture that is now on the screen. The next change to the campaign draws the map
+        # without it.
+        with self.campaign_lock:
+            drawing = self.get_map_drawing(heat=result["nodes"])
+            map_number = self.map_number
+        self.render_queue.submit_latest("forecast", self.render_map, drawing, None, map_number, False)
+
+    def prepare_map_background(self):
+        # When a new background image is set. It is scaled on the render queue right away, even if the background is
+        # not visible, so that the maps drawn with it later only need to paste it.
+        if self.campaign is None or self.campaign.map is None or self.campaign.map.graph is None:
+            return
+        if self.headless and self.map_file is None:
+            return
+        with self.campaign_lock:
+            drawing = self.get_map_drawing()
+        if drawing is None or drawing["cornermarkers"] is None:
+            return
+        self.render_queue.submit(self.scale_map_background, drawing["bbox"], drawing["cornermarkers"])
+
+    def scale_map_background(self, bbox, cornermarkers):
+        from graphics import GfxHelper
+        GfxHelper.prepare_background(bbox, cornermarkers, self.mapbg)
+
     def campaign_changed(self):
+        self.map_drawing = None
         if self.campaign.map.graph is not None:
-            if isinstance(server_obj, DynCServer):
-                buf = server_obj.get_graph_image()
-            else:
+            if self.headless and self.map_file is None:
+                # Nobody is looking. The map is drawn if someone asks for it; see draw_snapshot_map.
+                self.rendered_map = None
+                return
+            if not isinstance(server_obj, DynCServer):
                 self.logger.warning("server_obj uninitialized in campaign_changed")
                 return
-            self.window.update_map(buf)
+            # Called with the lock held. We only take what the map needs from the campaign here; see render_map.
+            self.map_number += 1
             scores = self.get_scores()
             if scores[0] is None or scores[1] is None:
+                scores = None
+            self.map_drawing = self.get_map_drawing()
+            self.render_queue.submit_latest("map", self.render_map, self.map_drawing, scores, self.map_number, True)
+
+    def render_map(self, drawing, scores, map_number, for_snapshot):
+        # On the render queue. Snapshots keep the previous map until this one is ready.
+        if map_number != self.map_number:
+            # The campaign changed after this was submitted, so there's a newer map waiting in the queue
+            return
+        rendered_map = self.draw_map_drawing(drawing)
+        if rendered_map is None:
+            return
+        with self.campaign_lock:
+            if map_number != self.map_number:
+                # The campaign has changed again while we were drawing, and there's a newer map in the queue
                 return
+            if for_snapshot:
+                self.rendered_map = rendered_map
+                self.snapshot = self.snapshot.with_map(rendered_map)
+        self.window.update_map(rendered_map)
+        if scores is not None:
             self.window.update_score(scores)
 
+    def draw_snapshot_map(self):
+        # For a headless server, whose snapshots don't have a map until someone asks for one. The map stays in the
+        # snapshots until the next campaign_changed.
+        with self.campaign_lock:
+            if self.rendered_map is not None or self.campaign is None or self.campaign.map is None or \
+                    self.campaign.map.graph is None:
+                return
+            rendered_map = self.get_graph_image()
+            if rendered_map is not None:
+                self.rendered_map = rendered_map
+                self.publish_snapshot()
+
+    def get_current_map_drawing(self):
+        with self.campaign_lock:
+            if self.map_drawing is None and self.campaign is not None and self.campaign.map is not None and \
+                    self.campaign.map.graph is not None:
+                self.map_drawing = self.get_map_drawing()
+            return self.map_drawing
+
+    def get_map_tile(self, zoom, tile_x, tile_y):
+        # One tile of the current map (see GfxHelper.get_tile), or None. Tiles are drawn when they are asked for, by
+        # whoever asks, so that zooming in on one corner of a large map doesn't draw all of it.
+        drawing = self.get_current_map_drawing()
+        if drawing is None:
+            return None
+        from graphics import GfxHelper
+        return GfxHelper.get_tile(zoom, tile_x, tile_y, **drawing)
+
+    def get_map_view(self, zoom, left, top, size):
+        # For the window, when it's zoomed in. See GfxHelper.draw_view.
+        drawing = self.get_current_map_drawing()
+        if drawing is None:
+            return None
+        from graphics import GfxHelper
+        return GfxHelper.draw_view(zoom, left, top, size, **drawing)
+
+    def get_tile_document(self, path):
+        # GET /tiles/<zoom>/<x>/<y>.png. Returns the PNG, its ETag and its MIME type, or None, None, None.
+        parts = path.strip("/").split("/")
+        if len(parts) != 4 or parts[0] != "tiles" or not parts[3].endswith(".png"):
+            return None, None, None
+        try:
+            zoom, tile_x, tile_y = int(parts[1]), int(parts[2]), int(parts[3][:-len(".png")])
+        except ValueError:
+            return None, None, None
+        rendered_tile = self.get_map_tile(zoom, tile_x, tile_y)
+        if rendered_tile is None:
+            return None, None, None
+        png = rendered_tile.get_png()
+        return png, get_etag(png), "image/png"
+
+    def get_document_for_path(self, path):
+        # For plain HTTP GET. See CampaignSnapshot.get_document_for_path, and get_tile_document.
+        if path.startswith("/tiles/"):
+            return self.get_tile_document(path)
+        return self.get_snapshot_for_path(path).get_document_for_path(path)
+
+    def get_snapshot_for_path(self, path):
+        snapshot = self.snapshot
+        if self.headless and path.strip("/") == "map.png" and snapshot.rendered_map is None:
+            self.draw_snapshot_map()
+            snapshot = self.snapshot
+        return snapshot
+
     def save_image(self):
 
-        if self.window.old_image_buffer is not None:
-            self.window.old_image_buffer.seek(0)
-            img = self.window.old_image_buffer.read()
-            # Just to be sure, return file pointer to beginning in case some other code forgets to do it first.
-            self.window.old_image_buffer.seek(0)
+        rendered_map = self.window.rendered_map
+        if rendered_map is not None:
             path = os.path.join(Path(expanduser('~/DCS-DynC/')), "map.png")
             with open(path, 'wb') as file:
-                file.write(img)
+                file.write(rendered_map.get_png())
         else:
             self.logger.warning("No map has been received yet")
 
@@ -1560,39 +2203,168 @@ class DynCServer:
         return app_num, comp_num
 
 
-@Request.application
+# Methods that only read the latest snapshot. They never wait for the lock.
+snapshot_methods = ["status", "groups", "scores"]
+
+
+def fill_dispatcher(dync_server):
+    # Dispatcher is dictionary {<method_name>: callable}. Requests are served in parallel, so the methods that change
+    # the campaign must take turns. Every method is timed for the metrics.
+    methods = {"processjson": dync_server.with_campaign_lock(dync_server.processjson),
+               "unitdestroyed": dync_server.with_campaign_lock(dync_server.unitdestroyed),
+               "unitsdestroyed": dync_server.with_campaign_lock(dync_server.unitsdestroyed),
+               "missionend": dync_server.with_campaign_lock(dync_server.missionend),
+               "supportdestroyed": dync_server.with_campaign_lock(dync_server.supportdestroyed),
+               "changescore": dync_server.with_campaign_lock(dync_server.changescore),
+               "autoresolve": dync_server.with_campaign_lock(dync_server.autoresolve),
+               "forecast": dync_server.forecast,
+               "status": dync_server.get_status,
+               "groups": dync_server.get_groups,
+               "scores": dync_server.get_score_document}
+    for method_name in methods:
+        dispatcher[method_name] = dync_server.metrics.instrument(method_name, methods[method_name])
+    return dispatcher
+
+
+class RPCRequest(Request):
+    # Werkzeug answers 413 by itself when a body is larger than this, before reading any of it
+    max_content_length = max_body_size
+
+
+@RPCRequest.application
 def application(request):
     global server_obj
     if isinstance(server_obj, DynCServer):
+        if request.method == "GET" and request.path == "/metrics":
+            return Response(server_obj.metrics.render(), content_type=ServerMetrics.content_type)
+        if request.method == "GET":
+            return get_document_response(request, *server_obj.get_document_for_path(request.path))
 
-        # Dispatcher is dictionary {<method_name>: callable}
-        dispatcher["processjson"] = server_obj.processjson
-        dispatcher["unitdestroyed"] = server_obj.unitdestroyed
-        dispatcher["missionend"] = server_obj.missionend
-        dispatcher["supportdestroyed"] = server_obj.supportdestroyed
-        dispatcher["changescore"] = server_obj.changescore
-
-        response = JSONRPCResponseManager.handle(
-            request.data, dispatcher)
-        return Response(response.json, mimetype='application/json')
+        try:
+            request_data = decompress_body(request.get_data(), request.headers.get("Content-Encoding"))
+        except BodyTooLarge:
+            server_obj.logger.warning("A request was too large to decompress")
+            return Response("Too large", status=413, mimetype='text/plain')
+        except decompress_errors:
+            server_obj.logger.warning("Could not decompress a request with Content-Encoding %s" %
+                                      request.headers.get("Content-Encoding"))
+            return Response("Could not decompress request", status=400, mimetype='text/plain')
+
+        response_json = server_obj.handle_rpc(request_data, dispatcher)
+        return encode_response(request, response_json.encode("utf-8"), 'application/json',
+                               server_obj.compression_min_size)
     else:
         # Uninitialized server. Should never happen.
         return None
 
 
+def encode_response(request, body, mimetype, min_size):
+    body, encoding = compress_body(body, request.accept_encodings, min_size)
+    response = Response(body, mimetype=mimetype)
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def get_document_response(request, body, etag, mimetype):
+    # Plain HTTP GET for pollers: /status, /groups, /scores, /map.png and the map tiles. With If-None-Match, an
+    # unchanged document is just a 304.
+    if body is None:
+        return Response("Not found", status=404, mimetype='text/plain')
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+
+class PooledWSGIServer(BaseWSGIServer):
+
+    # Werkzeug's server, except that every request is handled in a thread of a shared, bounded pool. Werkzeug's own
+    # threaded server starts a new thread for every request with no upper limit, and the plain one handles one request
+    # at a time, which would make a long processjson block everything else.
+
+    def __init__(self, host, port, app, executor):
+        BaseWSGIServer.__init__(self, host, port, app)
+        self.executor = executor
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        # noinspection PyBroadException
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
 class ServerThread(Thread):
-    def __init__(self):
+    def __init__(self, wsgi_server):
         Thread.__init__(self)
+        self.wsgi_server = wsgi_server
 
     def run(self):
-        run_simple('localhost', 44444, application)
-        run_simple(socket.gethostbyname(socket.gethostname()), 44445, application)
+        self.wsgi_server.serve_forever()
+
+
+def get_server_addresses(dync_server):
+    addresses = [('localhost', dync_server.local_port)]
+    if dync_server.remote_port != 0:
+        try:
+            addresses.append((socket.gethostbyname(socket.gethostname()), dync_server.remote_port))
+        except OSError:
+            dync_server.logger.error("Could not find the network address of this computer. Listening only locally.")
+    return addresses
+
+
+def start_servers(dync_server):
+    # One server, and one thread accepting connections, per address. They all share the same pool of workers.
+    executor = ThreadPoolExecutor(max_workers=dync_server.num_server_workers, thread_name_prefix="rpc")
+    addresses = get_server_addresses(dync_server)
+    # Filled once, before the first request, and only read after that
+    rpc_dispatcher = fill_dispatcher(dync_server)
+
+    if dync_server.server_mode == "asyncio":
+        # One event loop for all addresses, and the pool only for the RPCs that do real work
+        dync_server.async_server = AsyncRPCServer(dync_server, rpc_dispatcher, executor, snapshot_methods)
+        thread = AsyncServerThread(dync_server.async_server, addresses)
+        thread.daemon = True
+        thread.start()
+        return [thread]
+    if dync_server.server_mode != "threaded":
+        dync_server.logger.warning("Unknown server mode %s. Using threaded." % dync_server.server_mode)
+
+    threads = []
+    for host, port in addresses:
+        try:
+            wsgi_server = PooledWSGIServer(host, port, application, executor)
+        except OSError:
+            dync_server.logger.error("Could not listen on %s:%d" % (host, port), exc_info=True)
+            continue
+        dync_server.logger.info("Listening on %s:%d" % (host, port))
+        thread = ServerThread(wsgi_server)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    return threads
 
 
 def main():
-    global server_thread
+    global server_threads
     global server_obj
 
+    parser = argparse.ArgumentParser(description="DynC Server")
+    parser.add_argument("--server", choices=["threaded", "asyncio"],
+                        help="How to serve requests. Overrides SERVER in setup.cfg.")
+    parser.add_argument("--headless", action="store_true",
+                        help="Run without a window. Same as HEADLESS = 1 in setup.cfg.")
+    parser.add_argument("--record", metavar="FILE",
+                        help="Record every RPC call to FILE, for replay.py. Same as RECORD_FILE in setup.cfg.")
+    args = parser.parse_args()
+
     user_directory = Path(expanduser('~/DCS-DynC/'))
     try:
         os.mkdir(user_directory)
@@ -1603,9 +2375,37 @@ def main():
                             conf_file=os.path.join(user_directory, "setup.cfg"),
                             mapbg=os.path.join(user_directory, "map-bg.dat"),
                             sqlite_path=os.path.join(user_directory, "statistics.db"),
-                            stat_txt_path=os.path.join(user_directory, "statistics.txt"))
-    server_thread = ServerThread()
-    server_thread.daemon = True
+                            stat_txt_path=os.path.join(user_directory, "statistics.txt"),
+                            headless=args.headless)
+    if args.server is not None:
+        server_obj.server_mode = args.server
+    if args.record is not None:
+        server_obj.record_file = Path(args.record)
+
+    if server_obj.headless:
+        server_obj.window = HeadlessWindow(server_obj.map_file)
+        server_obj.post_init()
+        if server_obj.record_file is not None:
+            server_obj.start_recording(server_obj.record_file)
+        server_threads = start_servers(server_obj)
+        server_obj.logger.info("Running headless. Press Ctrl-C to stop.")
+        try:
+            # Joining with a timeout, so that Ctrl-C gets through on Windows too
+            while any(thread.is_alive() for thread in server_threads):
+                for thread in server_threads:
+                    thread.join(1.0)
+        except KeyboardInterrupt:
+            pass
+        server_obj.finish_mission_end()
+        server_obj.stop_recording()
+        if server_obj.simulation_pool is not None:
+            server_obj.simulation_pool.close()
+        return
+
+    # Only now, so that a headless server never loads wx
+    import wx
+    from gui import DyncCFrame
+
     app = wx.App()
     frm = DyncCFrame(None, title="DynC Server", server=server_obj)
     server_obj.log_window_handler.set_window(frm)
@@ -1614,19 +2414,27 @@ def main():
     frm.Centre()
     frm.Show()
     server_obj.post_init()
+    if server_obj.record_file is not None:
+        server_obj.start_recording(server_obj.record_file)
 
     # Remember: In CPython, threads are not genuinely parallel due to GIL. As long as everything the software does is
     # IO-bound, threads are your best option due to small memory overhead. But if you ever start doing CPU-bound things
     # here, you'll need to switch to multiprocessing. Remember: Every process will then have the entire memory footprint
     # of the software. In other words, as long as you only ever need the processing power of just one CPU core, use
-    # threading.
-    server_thread.start()
-
-    socket.gethostbyname(socket.gethostname())
+    # threading. (The AI lookahead and forecasts are the CPU-bound part, and they do use separate processes; see
+    # lookahead.py.)
+    server_threads = start_servers(server_obj)
 
     # Start the event loop.
     app.MainLoop()
 
+    server_obj.finish_mission_end()
+    server_obj.stop_recording()
+    if server_obj.simulation_pool is not None:
+        server_obj.simulation_pool.close()
+
 
 if __name__ == '__main__':
+    # Needed by the lookahead worker processes when we are frozen into an executable on Windows
+    multiprocessing.freeze_support()
     main()
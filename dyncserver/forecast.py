@@ -0,0 +1,113 @@
+import logging
+import multiprocessing
+import random
+import time
+from threading import Lock
+import numpy as np
+import lookahead
+from ai import get_forces_key, get_infantry_key
+from simulation import simulate
+
+logger = logging.getLogger('general')
+
+# "Where will the front be in three turns?" We play the campaign that many turns ahead with many different random
+# numbers, on the same worker processes as the lookahead, and count for every node how often each coalition had
+# vehicles in it at the end. Dividing by the number of runs gives the probability that the node is occupied.
+
+
+def run_forecast(mutable_state, log_weights, num_turns, seed, play_current_mission):
+    # Runs in a worker. Returns the nodes that have vehicles of each coalition at the end, and the result.
+    random.seed(seed)
+    np.random.seed(seed)
+    rng = np.random.default_rng(seed)
+    campaign = lookahead.worker_campaign.fork(mutable_state)
+    result, turns_played = simulate(campaign, lookahead.get_worker_combat_model(log_weights), num_turns, rng,
+                                    play_current_mission=play_current_mission)
+    occupied = {"red": set(), "blue": set()}
+    for node_id in campaign.map.groups_in_nodes:
+        for group in campaign.map.groups_in_nodes[node_id].values():
+            if group.category == "vehicle" and group.coalition in occupied:
+                occupied[group.coalition].add(int(node_id))
+    return {"red": sorted(occupied["red"]), "blue": sorted(occupied["blue"]), "result": result}
+
+
+class Forecaster:
+
+    def __init__(self, simulation_pool):
+        self.simulation_pool = simulation_pool
+        # Key is the state of the campaign and the parameters of the forecast. Only forecasts of the current stage are
+        # kept, so this never grows beyond a handful of entries. Forecasts can run on several threads at once.
+        self.cache = {}
+        self.cache_stage = None
+        self.cache_lock = Lock()
+
+    @staticmethod
+    def get_cache_key(campaign, num_turns, num_runs, play_current_mission):
+        # Everything that a forecast depends on. The state changes within a stage too, when units are destroyed.
+        game_map = campaign.map
+        return (campaign.stage, num_turns, num_runs, play_current_mission,
+                tuple(sorted(campaign.get_movement_decisions().items())), get_forces_key(game_map),
+                get_infantry_key(game_map), repr(game_map.support_unit_nodes),
+                repr(sorted(game_map.num_support_units.items())), repr(sorted(campaign.resources_generic.items())))
+
+    def forecast(self, campaign, combat_model, num_turns, num_runs, play_current_mission, timeout=60.0):
+        key = Forecaster.get_cache_key(campaign, num_turns, num_runs, play_current_mission)
+        with self.cache_lock:
+            if self.cache_stage != campaign.stage:
+                self.cache = {}
+                self.cache_stage = campaign.stage
+            if key in self.cache:
+                return self.cache[key]
+
+        start = time.perf_counter()
+        pool = self.simulation_pool.acquire(campaign)
+        try:
+            runs = Forecaster.play(pool, campaign, combat_model, num_turns, num_runs, play_current_mission,
+                                   start + timeout)
+        finally:
+            self.simulation_pool.release(pool)
+
+        num_done = len(runs)
+        if num_done == 0:
+            return None
+
+        counts = {}
+        results = {"red": 0, "blue": 0, "draw": 0, "none": 0}
+        for run in runs:
+            results[run["result"] if run["result"] is not None else "none"] += 1
+            for coalition in ("red", "blue"):
+                for node_id in run[coalition]:
+                    if node_id not in counts:
+                        counts[node_id] = {"red": 0, "blue": 0}
+                    counts[node_id][coalition] += 1
+
+        nodes = {}
+        for node_id in counts:
+            nodes[node_id] = {"red": counts[node_id]["red"] / num_done, "blue": counts[node_id]["blue"] / num_done}
+        forecast = {"stage": campaign.stage, "turns": num_turns, "runs": num_done, "nodes": nodes, "results": results}
+        logger.info("Forecast of %d turns with %d runs took %.2f s" %
+                    (num_turns, num_done, time.perf_counter() - start))
+
+        # A forecast that timed out is not cached, so that asking again can give the full one.
+        if num_done == num_runs:
+            with self.cache_lock:
+                if self.cache_stage == campaign.stage:
+                    self.cache[key] = forecast
+        return forecast
+
+    @staticmethod
+    def play(pool, campaign, combat_model, num_turns, num_runs, play_current_mission, deadline):
+        # Returns the runs that finished before the deadline, in time.perf_counter() seconds
+        mutable_state = campaign.get_mutable_state()
+        rng = np.random.default_rng()
+        tasks = [pool.apply_async(run_forecast, (mutable_state, combat_model.log_weights, num_turns,
+                                                 int(rng.integers(2 ** 32)), play_current_mission))
+                 for _ in range(num_runs)]
+        runs = []
+        for task in tasks:
+            try:
+                runs.append(task.get(timeout=max(deadline - time.perf_counter(), 0.0)))
+            except multiprocessing.TimeoutError:
+                logger.warning("Forecast timed out after %d of %d runs" % (len(runs), num_runs))
+                break
+        return runs
@@ -1,22 +1,93 @@
-import matplotlib
-import matplotlib.pyplot as plt
 from io import BytesIO
-from PIL import Image, ImageDraw, ImageFont
-import networkx as nx
+from PIL import Image, ImageDraw, ImageFont, PngImagePlugin
 import logging
 import math
 import os.path
+import weakref
+from collections import OrderedDict
+from threading import Lock
 
-matplotlib.use('Agg')
 logger = logging.getLogger('general')
 
 
+class RenderedMap:
+
+    # A map as it was drawn, in full size. The window only needs it scaled down, and the PNG is only needed when the map
+    # is saved or someone asks for it over HTTP, so neither is made before it is needed. The image itself never changes,
+    # so any thread may ask for either.
+
+    def __init__(self, image):
+        self.image = image
+        self.png = None
+        self.png_lock = Lock()
+
+    def get_png(self):
+        with self.png_lock:
+            if self.png is None:
+                buf = BytesIO()
+                self.image.save(buf, format="png")
+                self.png = buf.getvalue()
+            return self.png
+
+    def get_rgb(self, size):
+        # The map scaled to size x size, as bytes of RGB that wx.Bitmap.FromBuffer can use as they are
+        if self.image.size == (size, size):
+            return self.image.tobytes()
+        resized = self.image.resize((size, size), Image.LANCZOS)
+        rgb = resized.tobytes()
+        resized.close()
+        return rgb
+
+
 class GfxHelper:
 
     image_size = 1500
 
+    # Base layers of the map (see get_base_layer), per graph. The value is an OrderedDict from everything else that the
+    # layer depends on, to the image. Only the last few are kept, so that toggling the background doesn't redraw.
+    base_layer_caches = weakref.WeakKeyDictionary()
+    base_layer_lock = Lock()
+    max_base_layers = 4
+
+    # Background images scaled to the size they are drawn in. See get_scaled_background.
+    scaled_backgrounds = OrderedDict()
+    max_scaled_backgrounds = 2
+
+    # The map can also be drawn in square tiles of tile_size pixels, for zooming in. At zoom level z, the whole map is
+    # 2 ** z tiles across. Only the tiles that someone looks at are drawn, and only the last max_tiles of them are kept,
+    # per graph, so the memory they take depends on how much of the map is looked at, not on how large it is.
+    tile_size = 256
+    max_tile_zoom = 7
+    tile_caches = weakref.WeakKeyDictionary()
+    tile_lock = Lock()
+    max_tiles = 256
+    # The background image in its original size, for drawing its parts in the tiles. Only the latest one is kept.
+    background_source = None
+
+    # How the graph is drawn, in pixels of the final map. See draw_graph.
+    graph_supersample = 4
+    graph_edge_width = 3.0
+    graph_edge_color = "#505050"
+    graph_node_radius = 2.7
+    graph_node_color = "#80e080"
+
+    # Verdana comes with Windows. Elsewhere, for example on a headless Linux server, we take what there is.
+    font_names = ['verdana.ttf', 'DejaVuSans.ttf']
+
+    @staticmethod
+    def get_font(size):
+        for font_name in GfxHelper.font_names:
+            try:
+                return ImageFont.truetype(font_name, size=size)
+            except OSError:
+                continue
+        return ImageFont.load_default()
+
     @staticmethod
-    def map_coords_to_image_coords(map_coords, bbox, img_side_len):
+    def map_coords_to_image_coords(map_coords, bbox, img_side_len, view=None):
+        # view is None for the whole map at image_size, or for a part of a larger map (see get_tile_view), a tuple of
+        # the size of the whole map and the image coordinates of the top left corner of the part.
+        #
         # Remember that in image coordinates, origin is at top left, but in graph coordinates the lowest number is found
         # at bottom left. This is why the y-coordinates are of the form "1.0 - (ratio in graph coordinates)"
         x = (map_coords[0] - bbox[0]) / img_side_len
@@ -24,21 +95,19 @@ class GfxHelper:
 
         # We know our image is given number of  pixels, so we simply multiply it with the ratio and get the pixel
         # coordinates of the correct node in the image.
-        x, y = GfxHelper.image_size * x, GfxHelper.image_size * y
+        if view is None:
+            x, y = GfxHelper.image_size * x, GfxHelper.image_size * y
+        else:
+            x, y = view[0] * x - view[1], view[0] * y - view[2]
         return x, y
 
     @staticmethod
-    def draw_map(graph, coords, bbox, red_goal, blue_goal, groups, movement_decisions, paths=False, mapmarkers=None,
-                 cornermarkers=None, bullseyes=None, mapbg=None, score=None):
+    def get_map_square(bbox, cornermarkers):
+        # The square of map coordinates that the image covers, its side length, and the rectangle of the corner
+        # markers, if there are any.
 
-        if mapmarkers is None:
-            mapmarkers = []
-        if bullseyes is None:
-            bullseyes = {"red": None, "blue": None}
-
-        if mapmarkers is None:
-            mapmarkers = []
-        plt.figure(figsize=(GfxHelper.image_size/100.0, GfxHelper.image_size/100.0), dpi=100)
+        # The caller may use the bounding box again, and we pad it below
+        bbox = list(bbox)
 
         # Bounding box numbers are listed in this order: min-x, max-x, min-y, max-y. NetworkX expects to get them in
         # this order in a list.
@@ -94,94 +163,19 @@ class GfxHelper:
                 if min_x is None or min_x > pos[0]:
                     min_x = pos[0]
             corner_rectangle = [min_x, max_y, max_x, min_y]
+        return bbox, square_side_len, corner_rectangle
 
-        # This draws the node graph as nx supports drawing it. Then we will start drawing over that file.
-        nx.drawing.nx_pylab.draw(graph, coords, node_size=6, node_color="#80e080", edge_color="#505050")
-
-        # Axes to bounding box
-        plt.axis(bbox)
-
-        # Save the graph to this buffer
-        buf = BytesIO()
-        plt.savefig(buf, format="png", dpi=100, transparent=True)
-        plt.close()
-        buf.seek(0)
-        # Now the graph itself is drawn, and we can start drawing over it with Pillow. We load the original buffer, save
-        # to another buffer from Pillow, and close the original. Then return the other one to caller.
-
-        # Note: Pillow has a strange quirk that is not well documented. In case to draw over an existing bitmap using
-        # Any alpha values, the image to which we are drawing must be RGB, not RGBA. If it is the latter, the alphas
-        # will not blend between the image and the drawing. Since NetworkX saved the graph as RGBA we need to open it,
-        # and paste it into a new RGB image. This will allow us to use alpha in the expected way.
-
-        graph_image = Image.open(buf)
-        final_image = Image.new(mode="RGB", size=(GfxHelper.image_size, GfxHelper.image_size))
-
-        if mapbg is not None and corner_rectangle is not None and os.path.isfile(mapbg) is True:
-
-            # We want to draw a background image. Now things get really awkward with the alpha values. First, we create
-            # a square version with solid white background, that acts as the ultimate white background of anywhere that
-            # doesn't have the map background image. Pasting images without alpha over anything is fast and simple, and
-            # you don't have to think about the alpha of the underlying image.
-            square_bg_image = Image.new(mode="RGB", size=(GfxHelper.image_size, GfxHelper.image_size), color="#ffffff")
+    @staticmethod
+    def draw_map(graph, coords, bbox, red_goal, blue_goal, groups, movement_decisions, paths=False, mapmarkers=None,
+                 cornermarkers=None, bullseyes=None, mapbg=None, score=None, heat=None):
 
-            with open(mapbg, 'rb') as file:
+        bbox, square_side_len, corner_rectangle = GfxHelper.get_map_square(bbox, cornermarkers)
 
-                # This is the map in its original size, which is almost certainly wrong. We find out the proper
-                # rectangle where to put it in the square image. It is found in map coordinates in the corner_rectangle
-                # list. It has to be converted to image coordinates first.
-                bgimg = Image.open(file)
-                x1, y1 = GfxHelper.map_coords_to_image_coords((corner_rectangle[0], corner_rectangle[1]), bbox,
-                                                              square_side_len)
-                x2, y2 = GfxHelper.map_coords_to_image_coords((corner_rectangle[2], corner_rectangle[3]), bbox,
-                                                              square_side_len)
-                # Now we have all the image coordinates, which we turn to integers.
-                x1, x2, y1, y2 = int(round(x1)), int(round(x2)), int(round(y1)), int(round(y2))
-                height = y2 - y1
-                width = x2 - x1
-
-                # Now we know the size of the resized map, and its top left corner. First we resize.
-                bgimg_resized = bgimg.resize((width, height), Image.LANCZOS)
-                bgimg.close()
-                # Now we paste the resized background image over the non-alpha square image. Since it's non-alpha, we
-                # can be sure the resulting image doesn't have any alpha. Variables x1, y1 represent top left.
-                square_bg_image.paste(bgimg_resized, box=(x1, y1))
-                bgimg_resized.close()
-
-                # Only the non-alpha square image remains open now.
-
-            # Now the awkward part starts. We have to composite a new image from the alpha-enabled graph image, and the
-            # square background already created, which is non-alpha. First, we have to now give the square background an
-            # alpha channel, though we know that no pixel actually has anything but 1.0 alpha yet. (Since it came from a
-            # non-alpha image)
-            composited_image = Image.new("RGBA", size=(GfxHelper.image_size, GfxHelper.image_size))
-
-            # Since both of these images only have fully opaque pixels, we can simply paste without worry.
-            composited_image.paste(square_bg_image)
-            square_bg_image.close()
-
-            # But now comes the complex and slower part. We have to composite the graph and the background together.
-            # Simple paste will not suffice anymore.
-            composited_image = Image.alpha_composite(composited_image, graph_image)
-            graph_image.close()
-            buf.close()
-
-            # And ultimately, we want to convert everything back to a non-alpha image, due to the ImageDraw quirk that
-            # was already mentioned.
-            final_image.paste(composited_image)
-
-            composited_image.close()
-        else:
-            # Since we didn't want the map background, now things are really simple. We simply paste the graph image,
-            # and it loses its alpha channel because it's pasted over a non-alpha image. All transparency is converted
-            # to white, just like we wanted.
-            final_image.paste(graph_image)
-            graph_image.close()
+        final_image = GfxHelper.get_base_layer(graph, coords, bbox, square_side_len, mapbg, corner_rectangle)
 
-        # Ok, now we are through with the alpha channel unpleasantness, and can start drawing.
+        # Everything else changes from turn to turn, and is drawn over a copy of the base layer.
         draw = ImageDraw.Draw(final_image, mode="RGBA")
 
-        GfxHelper.draw_legend(draw_surface=draw)
         if score is not None:
             GfxHelper.draw_score(draw_surface=draw, score=score)
 
@@ -191,11 +185,24 @@ class GfxHelper:
                 y = cornermarker["pos"][1]
                 draw.ellipse([x - 10, y - 10, x + 10, y + 10], outline="#000000", fill="#000000")
 
-        font = ImageFont.truetype('verdana.ttf', size=24)
+        GfxHelper.draw_overlay(draw, coords, bbox, square_side_len, red_goal, blue_goal, groups, movement_decisions,
+                               paths, mapmarkers, bullseyes, heat)
+        return RenderedMap(final_image)
+
+    @staticmethod
+    def draw_overlay(draw, coords, bbox, square_side_len, red_goal, blue_goal, groups, movement_decisions, paths,
+                     mapmarkers, bullseyes, heat, view=None):
+        # Everything on the map that changes from turn to turn, apart from the score
+        if mapmarkers is None:
+            mapmarkers = []
+        if bullseyes is None:
+            bullseyes = {"red": None, "blue": None}
+
+        font = GfxHelper.get_font(size=24)
 
         for mapmarker in mapmarkers:
             name = mapmarker["name"].replace("__mm__", "").replace("  ", " ")
-            x, y = GfxHelper.map_coords_to_image_coords(mapmarker["pos"], bbox, square_side_len)
+            x, y = GfxHelper.map_coords_to_image_coords(mapmarker["pos"], bbox, square_side_len, view)
             size = draw.textsize(name, font=font)
             x -= size[0] / 2
             y -= (size[1] / 2) + 6
@@ -204,13 +211,13 @@ class GfxHelper:
         line_spacing = 12
 
         if bullseyes["red"] is not None:
-            x, y = GfxHelper.map_coords_to_image_coords(bullseyes["red"], bbox, square_side_len)
+            x, y = GfxHelper.map_coords_to_image_coords(bullseyes["red"], bbox, square_side_len, view)
             GfxHelper.draw_diamond(draw, x, y, 12, '#ff000090')
         if bullseyes["blue"] is not None:
-            x, y = GfxHelper.map_coords_to_image_coords(bullseyes["blue"], bbox, square_side_len)
+            x, y = GfxHelper.map_coords_to_image_coords(bullseyes["blue"], bbox, square_side_len, view)
             GfxHelper.draw_diamond(draw, x, y, 12, '#0000ff90')
 
-        font = ImageFont.truetype('verdana.ttf', size=30)
+        font = GfxHelper.get_font(size=30)
 
         # red_goal and blue_goal contain node ID's. The dictionary coords maps these to graph node coordinates. They are
         # tuples of the form (x, y)
@@ -223,7 +230,7 @@ class GfxHelper:
         # We know our image is given number of  pixels, so we simply multiply it with the ratio and get the pixel
         # coordinates of the correct node in the image.
         # x, y = GfxHelper.image_size * ratio_red_goal_x, GfxHelper.image_size * ratio_red_goal_y
-        x, y = GfxHelper.map_coords_to_image_coords(red_goal_coords, bbox, square_side_len)
+        x, y = GfxHelper.map_coords_to_image_coords(red_goal_coords, bbox, square_side_len, view)
 
         message = "Red\nGoal"
         color = '#ff0000'
@@ -243,7 +250,7 @@ class GfxHelper:
         draw.text((x, y), message, fill=color, font=font, align="center", spacing=line_spacing)
 
         # Finally, we do the exact same thing for the other goal. Comments are not repeated here.
-        x, y = GfxHelper.map_coords_to_image_coords(blue_goal_coords, bbox, square_side_len)
+        x, y = GfxHelper.map_coords_to_image_coords(blue_goal_coords, bbox, square_side_len, view)
 
         # x, y = GfxHelper.image_size * ratio_blue_goal_x, GfxHelper.image_size * ratio_blue_goal_y
         message = "Blue\nGoal"
@@ -257,6 +264,9 @@ class GfxHelper:
 
         draw.text((x, y), message, fill=color, font=font, align="center", spacing=line_spacing)
 
+        if heat is not None:
+            GfxHelper.draw_heat(draw, heat, coords, bbox, square_side_len, view)
+
         for node_id in groups:
             group_node_list = groups[node_id]
             for group_data in group_node_list:
@@ -273,10 +283,7 @@ class GfxHelper:
                 if node_id not in coords:
                     logger.warning('While drawing map, node %d is not in the dictionary "coords"' % node_id)
                     continue
-                group_coords = coords[node_id]
-                ratio_x = (group_coords[0] - bbox[0]) / square_side_len
-                ratio_y = 1.0 - ((group_coords[1] - bbox[2]) / square_side_len)
-                x, y = GfxHelper.image_size * ratio_x, GfxHelper.image_size * ratio_y
+                x, y = GfxHelper.map_coords_to_image_coords(coords[node_id], bbox, square_side_len, view)
 
                 group_type = group_data["type"]
 
@@ -314,8 +321,8 @@ class GfxHelper:
                     continue
                 origin = coords[origin_node]
                 destination = coords[destination_node]
-                origin_x, origin_y = GfxHelper.map_coords_to_image_coords(origin, bbox, square_side_len)
-                dest_x, dest_y = GfxHelper.map_coords_to_image_coords(destination, bbox, square_side_len)
+                origin_x, origin_y = GfxHelper.map_coords_to_image_coords(origin, bbox, square_side_len, view)
+                dest_x, dest_y = GfxHelper.map_coords_to_image_coords(destination, bbox, square_side_len, view)
                 draw.line([(origin_x, origin_y), (dest_x, dest_y)], width=6, fill=color)
 
                 # Now we draw an arrowhead to the line. Since we're doing trigonometry, we have to switch to a standard
@@ -339,12 +346,318 @@ class GfxHelper:
                 # Finally we translate the result to image coordinates, and we're done. We draw the polygon.
                 arrow_end_coords = [(point[0], -1*point[1]) for point in arrow_end_coords]
                 draw.polygon(arrow_end_coords, outline=color, fill=color)
-        buf = BytesIO()
-        final_image.save(buf, format="png")
-        final_image.close()
-        buf.seek(0)
 
-        return buf
+    @staticmethod
+    def get_background_key(mapbg, corner_rectangle):
+        # Returns the background image to draw, or None if there isn't one, and something that changes when it does
+        if mapbg is None or corner_rectangle is None or os.path.isfile(mapbg) is False:
+            return None, None
+        # The background can be changed from the menu, and is then copied over the same file
+        stat = os.stat(mapbg)
+        return mapbg, (mapbg, stat.st_mtime, stat.st_size, tuple(corner_rectangle))
+
+    @staticmethod
+    def get_base_layer(graph, coords, bbox, square_side_len, mapbg, corner_rectangle):
+        # Returns a copy of the base layer of the map: the graph, the background image and the legend. They don't
+        # change during a campaign, so each is drawn once and kept until the graph goes away.
+        mapbg, background_key = GfxHelper.get_background_key(mapbg, corner_rectangle)
+        key = (tuple(bbox), square_side_len, background_key, GfxHelper.image_size)
+
+        with GfxHelper.base_layer_lock:
+            base_layers = GfxHelper.base_layer_caches.get(graph)
+            if base_layers is None:
+                base_layers = OrderedDict()
+                GfxHelper.base_layer_caches[graph] = base_layers
+            base_layer = base_layers.get(key)
+        if base_layer is None:
+            base_layer = GfxHelper.draw_base_layer(graph, coords, bbox, square_side_len, mapbg, corner_rectangle)
+            with GfxHelper.base_layer_lock:
+                base_layers[key] = base_layer
+                while len(base_layers) > GfxHelper.max_base_layers:
+                    base_layers.popitem(last=False)
+        return base_layer.copy()
+
+    @staticmethod
+    def draw_base_layer(graph, coords, bbox, square_side_len, mapbg, corner_rectangle):
+        # White, where there is no background image
+        final_image = Image.new(mode="RGB", size=(GfxHelper.image_size, GfxHelper.image_size), color="#ffffff")
+
+        if mapbg is not None:
+            # The background image goes in the rectangle between the corner markers. It has to be converted to image
+            # coordinates first.
+            x1, y1, x2, y2 = GfxHelper.get_background_rectangle(bbox, square_side_len, corner_rectangle)
+            final_image.paste(GfxHelper.get_scaled_background(mapbg, x2 - x1, y2 - y1), box=(x1, y1))
+
+        GfxHelper.draw_graph(final_image, graph, coords, bbox, square_side_len)
+
+        # Note: Pillow has a strange quirk that is not well documented. In case to draw over an existing bitmap using
+        # Any alpha values, the image to which we are drawing must be RGB, not RGBA. If it is the latter, the alphas
+        # will not blend between the image and the drawing. That's why all of the map is RGB.
+        draw = ImageDraw.Draw(final_image, mode="RGBA")
+        GfxHelper.draw_legend(draw_surface=draw)
+        return final_image
+
+    @staticmethod
+    def get_background_rectangle(bbox, square_side_len, corner_rectangle, view=None):
+        x1, y1 = GfxHelper.map_coords_to_image_coords((corner_rectangle[0], corner_rectangle[1]), bbox, square_side_len,
+                                                      view)
+        x2, y2 = GfxHelper.map_coords_to_image_coords((corner_rectangle[2], corner_rectangle[3]), bbox, square_side_len,
+                                                      view)
+        # Now we have all the image coordinates, which we turn to integers. x1, y1 is the top left.
+        return int(round(x1)), int(round(y1)), int(round(x2)), int(round(y2))
+
+    @staticmethod
+    def get_scaled_background_path(mapbg):
+        return os.path.splitext(mapbg)[0] + "-scaled.png"
+
+    @staticmethod
+    def get_scaled_background(mapbg, width, height):
+        # The background image in its original size is almost certainly wrong, and scaling a large image is slow. So
+        # each size is scaled only once, and kept both here and in a file next to the background, so that it also
+        # survives a restart of the server. The file remembers what it was scaled from, because the background can be
+        # changed from the menu, and is then copied over the same file.
+        stat = os.stat(mapbg)
+        key = (mapbg, stat.st_mtime, stat.st_size, width, height)
+        with GfxHelper.base_layer_lock:
+            scaled = GfxHelper.scaled_backgrounds.get(key)
+        if scaled is not None:
+            return scaled
+
+        cache_file = GfxHelper.get_scaled_background_path(mapbg)
+        cache_key = "%r %d %d %d" % (stat.st_mtime, stat.st_size, width, height)
+        scaled = GfxHelper.load_scaled_background(cache_file, cache_key)
+        if scaled is None:
+            with open(mapbg, 'rb') as file:
+                bgimg = Image.open(file)
+                scaled = bgimg.resize((width, height), Image.LANCZOS)
+                bgimg.close()
+            # The map is RGB, and pasting anything else over it would convert it anyway
+            if scaled.mode != "RGB":
+                scaled = scaled.convert("RGB")
+            png_info = PngImagePlugin.PngInfo()
+            png_info.add_text("dync-source", cache_key)
+            try:
+                scaled.save(cache_file, format="PNG", pnginfo=png_info, compress_level=1)
+            except OSError as e:
+                logger.warning("Could not save the scaled background image to %s: %s" % (cache_file, str(e)))
+
+        with GfxHelper.base_layer_lock:
+            GfxHelper.scaled_backgrounds[key] = scaled
+            while len(GfxHelper.scaled_backgrounds) > GfxHelper.max_scaled_backgrounds:
+                GfxHelper.scaled_backgrounds.popitem(last=False)
+        return scaled
+
+    @staticmethod
+    def load_scaled_background(cache_file, cache_key):
+        # Returns None, unless the file was scaled from the current background, to the size we want
+        if os.path.isfile(cache_file) is False:
+            return None
+        try:
+            with open(cache_file, 'rb') as file:
+                scaled = Image.open(file)
+                if scaled.info.get("dync-source") != cache_key or scaled.mode != "RGB":
+                    scaled.close()
+                    return None
+                scaled.load()
+        except OSError as e:
+            logger.warning("Could not read the scaled background image %s: %s" % (cache_file, str(e)))
+            return None
+        return scaled
+
+    @staticmethod
+    def prepare_background(bbox, cornermarkers, mapbg):
+        # Scales the background for a map of this campaign in advance, so that the next map only needs to paste it
+        bbox, square_side_len, corner_rectangle = GfxHelper.get_map_square(bbox, cornermarkers)
+        if corner_rectangle is None or os.path.isfile(mapbg) is False:
+            return
+        x1, y1, x2, y2 = GfxHelper.get_background_rectangle(bbox, square_side_len, corner_rectangle)
+        GfxHelper.get_scaled_background(mapbg, x2 - x1, y2 - y1)
+
+    @staticmethod
+    def get_tile_view(zoom, tile_x, tile_y):
+        # The view (see map_coords_to_image_coords) of one tile
+        return GfxHelper.tile_size * 2 ** zoom, tile_x * GfxHelper.tile_size, tile_y * GfxHelper.tile_size
+
+    @staticmethod
+    def get_tile(zoom, tile_x, tile_y, graph, coords, bbox, red_goal, blue_goal, groups, movement_decisions,
+                 paths=False, mapmarkers=None, cornermarkers=None, bullseyes=None, mapbg=None, score=None, heat=None):
+        # One tile of the map, as a RenderedMap, or None if there is no such tile. Takes the same arguments as draw_map,
+        # apart from the score, which isn't part of any tile. A tile is only drawn again if something on it has changed.
+        tiles_across = 2 ** zoom
+        if zoom < 0 or zoom > GfxHelper.max_tile_zoom or tile_x < 0 or tile_x >= tiles_across or tile_y < 0 or \
+                tile_y >= tiles_across:
+            return None
+        view = GfxHelper.get_tile_view(zoom, tile_x, tile_y)
+        bbox, square_side_len, corner_rectangle = GfxHelper.get_map_square(bbox, cornermarkers)
+        mapbg, background_key = GfxHelper.get_background_key(mapbg, corner_rectangle)
+        base_key = ("base", tuple(bbox), square_side_len, background_key, zoom, tile_x, tile_y)
+        overlay_key = GfxHelper.get_overlay_key(view, coords, bbox, square_side_len, red_goal, blue_goal, groups,
+                                                movement_decisions, paths, mapmarkers, bullseyes, heat)
+        tile_key = base_key + (overlay_key, )
+
+        with GfxHelper.tile_lock:
+            tiles = GfxHelper.tile_caches.get(graph)
+            if tiles is None:
+                tiles = OrderedDict()
+                GfxHelper.tile_caches[graph] = tiles
+            rendered_tile = tiles.get(tile_key)
+            base_tile = tiles.get(base_key)
+            for key in (tile_key, base_key):
+                if key in tiles:
+                    tiles.move_to_end(key)
+        if rendered_tile is not None:
+            return rendered_tile
+
+        if base_tile is None:
+            base_tile = GfxHelper.draw_base_tile(graph, coords, bbox, square_side_len, mapbg, corner_rectangle, view)
+        tile = base_tile.copy()
+        draw = ImageDraw.Draw(tile, mode="RGBA")
+        GfxHelper.draw_overlay(draw, coords, bbox, square_side_len, red_goal, blue_goal, groups, movement_decisions,
+                               paths, mapmarkers, bullseyes, heat, view)
+        rendered_tile = RenderedMap(tile)
+
+        with GfxHelper.tile_lock:
+            tiles[base_key] = base_tile
+            tiles[tile_key] = rendered_tile
+            while len(tiles) > GfxHelper.max_tiles:
+                tiles.popitem(last=False)
+        return rendered_tile
+
+    @staticmethod
+    def get_overlay_key(view, coords, bbox, square_side_len, red_goal, blue_goal, groups, movement_decisions, paths,
+                        mapmarkers, bullseyes, heat):
+        # Everything from draw_overlay that can reach into the tile in view, so that a tile is drawn again only when
+        # its part of the overlay changes. The margins are generous: a tile drawn again for nothing only costs time.
+        size = GfxHelper.tile_size
+
+        def reaches(x, y, margin_x, margin_y):
+            return -margin_x <= x <= size + margin_x and -margin_y <= y <= size + margin_y
+
+        def get_position(node_id):
+            return GfxHelper.map_coords_to_image_coords(coords[node_id], bbox, square_side_len, view)
+
+        key = []
+        if mapmarkers is not None:
+            for mapmarker in mapmarkers:
+                x, y = GfxHelper.map_coords_to_image_coords(mapmarker["pos"], bbox, square_side_len, view)
+                if reaches(x, y, 16 * len(mapmarker["name"]) + 20, 40):
+                    key.append(("mapmarker", mapmarker["name"], tuple(mapmarker["pos"])))
+        if bullseyes is not None:
+            for coalition in ("red", "blue"):
+                if bullseyes.get(coalition) is None:
+                    continue
+                x, y = GfxHelper.map_coords_to_image_coords(bullseyes[coalition], bbox, square_side_len, view)
+                if reaches(x, y, 20, 20):
+                    key.append(("bullseye", coalition, tuple(bullseyes[coalition])))
+        for coalition, node_id in (("red", red_goal), ("blue", blue_goal)):
+            x, y = get_position(node_id)
+            if reaches(x, y, 60, 80):
+                key.append(("goal", coalition, node_id))
+        if heat is not None:
+            for node_id in heat:
+                if node_id in coords and reaches(*get_position(node_id), 30, 30):
+                    key.append(("heat", node_id, tuple(sorted(heat[node_id].items()))))
+        for node_id in groups:
+            if node_id in coords and reaches(*get_position(node_id), 20, 20):
+                for group_data in groups[node_id]:
+                    key.append(("group", node_id, group_data["coalition"], group_data["type"]))
+        if paths is True:
+            for decision in movement_decisions:
+                origin_node = decision["origin_node"]
+                destination_node = decision["destination_node"]
+                if origin_node not in coords or destination_node not in coords:
+                    continue
+                origin_x, origin_y = get_position(origin_node)
+                dest_x, dest_y = get_position(destination_node)
+                if reaches((origin_x + dest_x) / 2, (origin_y + dest_y) / 2, abs(dest_x - origin_x) / 2 + 20,
+                           abs(dest_y - origin_y) / 2 + 20):
+                    key.append(("path", origin_node, destination_node, decision["coalition"]))
+        return tuple(key)
+
+    @staticmethod
+    def draw_base_tile(graph, coords, bbox, square_side_len, mapbg, corner_rectangle, view):
+        # Like draw_base_layer, but for one tile, and without the legend
+        tile = Image.new(mode="RGB", size=(GfxHelper.tile_size, GfxHelper.tile_size), color="#ffffff")
+
+        if mapbg is not None:
+            x1, y1, x2, y2 = GfxHelper.get_background_rectangle(bbox, square_side_len, corner_rectangle, view)
+            # The part of the background that is in this tile
+            left, top = max(x1, 0), max(y1, 0)
+            right, bottom = min(x2, GfxHelper.tile_size), min(y2, GfxHelper.tile_size)
+            if left < right and top < bottom:
+                source = GfxHelper.get_background_source(mapbg)
+                scale_x, scale_y = source.width / (x2 - x1), source.height / (y2 - y1)
+                box = ((left - x1) * scale_x, (top - y1) * scale_y, (right - x1) * scale_x, (bottom - y1) * scale_y)
+                part = source.resize((right - left, bottom - top), Image.LANCZOS, box=box)
+                tile.paste(part, box=(left, top))
+                part.close()
+
+        GfxHelper.draw_graph(tile, graph, coords, bbox, square_side_len, view)
+        return tile
+
+    @staticmethod
+    def get_background_source(mapbg):
+        stat = os.stat(mapbg)
+        key = (mapbg, stat.st_mtime, stat.st_size)
+        with GfxHelper.tile_lock:
+            if GfxHelper.background_source is not None and GfxHelper.background_source[0] == key:
+                return GfxHelper.background_source[1]
+        with open(mapbg, 'rb') as file:
+            source = Image.open(file)
+            source.load()
+        # The map is RGB, and pasting anything else over it would convert it anyway
+        if source.mode != "RGB":
+            source = source.convert("RGB")
+        with GfxHelper.tile_lock:
+            GfxHelper.background_source = (key, source)
+        return source
+
+    @staticmethod
+    def draw_view(zoom, left, top, size, **drawing):
+        # A size x size part of the map at a zoom level, with its top left corner at left, top in the image coordinates
+        # of the whole map. Put together from the tiles that it covers. Takes the rest of the arguments of get_tile.
+        image = Image.new(mode="RGB", size=(size, size), color="#ffffff")
+        tile_size = GfxHelper.tile_size
+        tiles_across = 2 ** zoom
+        for tile_y in range(max(top // tile_size, 0), min((top + size - 1) // tile_size + 1, tiles_across)):
+            for tile_x in range(max(left // tile_size, 0), min((left + size - 1) // tile_size + 1, tiles_across)):
+                rendered_tile = GfxHelper.get_tile(zoom, tile_x, tile_y, **drawing)
+                if rendered_tile is not None:
+                    image.paste(rendered_tile.image, box=(tile_x * tile_size - left, tile_y * tile_size - top))
+        return RenderedMap(image)
+
+    @staticmethod
+    def draw_graph(image, graph, coords, bbox, square_side_len, view=None):
+        # The edges and the nodes of the graph. Pillow doesn't smooth the lines it draws, so we draw them in black and
+        # white at graph_supersample times the size of the map, and scale that down. Every pixel then covers the line as
+        # much as the line covers the pixel, and the color is pasted through that.
+        scale = GfxHelper.graph_supersample
+        size = image.size
+        large_size = (size[0] * scale, size[1] * scale)
+        points = {}
+        for node_id in graph.nodes():
+            x, y = GfxHelper.map_coords_to_image_coords(coords[node_id], bbox, square_side_len, view)
+            # Pillow puts pixel centers at whole numbers, and we want them in the middle of the pixel
+            points[node_id] = ((x + 0.5) * scale, (y + 0.5) * scale)
+
+        edge_mask = Image.new(mode="L", size=large_size)
+        draw = ImageDraw.Draw(edge_mask)
+        line_width = max(int(round(GfxHelper.graph_edge_width * scale)), 1)
+        for node1, node2 in graph.edges():
+            draw.line([points[node1], points[node2]], fill=255, width=line_width)
+
+        node_mask = Image.new(mode="L", size=large_size)
+        draw = ImageDraw.Draw(node_mask)
+        radius = GfxHelper.graph_node_radius * scale
+        for node_id in points:
+            x, y = points[node_id]
+            draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill=255)
+
+        for mask, color in ((edge_mask, GfxHelper.graph_edge_color), (node_mask, GfxHelper.graph_node_color)):
+            small_mask = mask.resize(size, Image.BOX)
+            mask.close()
+            image.paste(color, box=(0, 0) + size, mask=small_mask)
+            small_mask.close()
 
     @staticmethod
     def draw_triangle(draw_surface, x, y, triangle_side_len, outline_color, fill_color):
@@ -360,9 +673,27 @@ class GfxHelper:
                           width=5)
         return
 
+    @staticmethod
+    def draw_heat(draw_surface, heat, coords, bbox, square_side_len, view=None):
+        # heat is a dictionary from node ID to {"red": probability, "blue": probability}, like the "nodes" of a
+        # forecast. Every node gets a disc per coalition, larger and more opaque the more likely that coalition is
+        # there. Red and blue blend to purple where the front is contested.
+        for node_id in heat:
+            if node_id not in coords:
+                continue
+            x, y = GfxHelper.map_coords_to_image_coords(coords[node_id], bbox, square_side_len, view)
+            for coalition, rgb in (("red", "ff0000"), ("blue", "0000ff")):
+                probability = heat[node_id].get(coalition, 0.0)
+                if probability <= 0.0:
+                    continue
+                radius = 8 + 22 * probability
+                alpha = int(round(40 + 120 * probability))
+                draw_surface.ellipse([x - radius, y - radius, x + radius, y + radius],
+                                     fill="#%s%02x" % (rgb, alpha))
+
     @staticmethod
     def draw_legend(draw_surface):
-        font = ImageFont.truetype('verdana.ttf', size=24)
+        font = GfxHelper.get_font(size=24)
         neutral_solid_color = "#505050ff"
         neutral_symbol_color = "#50505090"
         neutral_unimportant_symbol_color = "#50505050"
@@ -382,7 +713,7 @@ class GfxHelper:
 
     @staticmethod
     def draw_score(draw_surface, score):
-        font = ImageFont.truetype('verdana.ttf', size=24)
+        font = GfxHelper.get_font(size=24)
         draw_surface.text((5, 30), "%d" % score["red"], fill="#ff0000", font=font, align="left")
         size = draw_surface.textsize("%d" % score["red"], font=font)
         draw_surface.text((5+size[0]+5, 30), "-", fill="#000000", font=font, align="left")
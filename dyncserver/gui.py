@@ -1,9 +1,9 @@
 # noinspection PyPackageRequirements
 import wx
-from PIL import Image
-from io import BytesIO
 import constants
+from graphics import GfxHelper
 import shutil
+from threading import Thread
 import logging
 
 logger = logging.getLogger('general')
@@ -14,7 +14,12 @@ class DyncCFrame(wx.Frame):
 
     def __init__(self, *args, **kw):
         self.server = kw.pop("server")
-        self.old_image_buffer = None
+        self.rendered_map = None
+        # None when the whole map is shown. Otherwise a tuple of the zoom level (see GfxHelper.get_tile) and the point
+        # of the map in the middle of the window, as fractions of the width and height of the map.
+        self.view = None
+        self.map_bitmap = None
+        self.drag_start = None
         self.paths_menuitem = None
         self.bg_vis_menuitem = None
         # ensure the parent's __init__ is called
@@ -50,8 +55,16 @@ class DyncCFrame(wx.Frame):
         self.score.SetFont(font)
         vbox.Add(self.score, 0, wx.EXPAND)
 
-        self.map = wx.StaticBitmap(self.panel, -1, wx.NullBitmap, (0, 0), (DyncCFrame.window_image_size,
-                                                                           DyncCFrame.window_image_size))
+        # Scroll to zoom in and out, drag to move around, and double-click to see the whole map again
+        self.map = wx.Panel(self.panel, size=(DyncCFrame.window_image_size, DyncCFrame.window_image_size))
+        # We paint all of it ourselves, which keeps it from flickering when it's dragged
+        self.map.SetBackgroundStyle(wx.BG_STYLE_PAINT)
+        self.map.Bind(wx.EVT_PAINT, self.on_paint_map)
+        self.map.Bind(wx.EVT_MOUSEWHEEL, self.on_map_wheel)
+        self.map.Bind(wx.EVT_LEFT_DOWN, self.on_map_left_down)
+        self.map.Bind(wx.EVT_LEFT_UP, self.on_map_left_up)
+        self.map.Bind(wx.EVT_MOTION, self.on_map_motion)
+        self.map.Bind(wx.EVT_LEFT_DCLICK, self.on_map_double_click)
         vbox.Add(self.map, 1)
 
         self.log_control = wx.TextCtrl(self.panel, style=wx.TE_MULTILINE | wx.TE_READONLY)
@@ -61,32 +74,133 @@ class DyncCFrame(wx.Frame):
         self.panel.SetSizer(vbox)
         self.panel.Layout()
 
+    # Only the window's own thread may touch the window. Messages are logged from every thread of the server, and the
+    # server calls update_map, erase_window and update_score from its render thread. So they do what they can where
+    # they are, and hand the rest over with wx.CallAfter.
+
     def update_log(self, contents):
-        self.log_control.write(contents + "\n")
-
-    def update_map(self, img_buffer):
-        img_resized_buf = BytesIO()
-        img_buffer.seek(0)
-        img = Image.open(img_buffer)
-        img_buffer.seek(0)
-        img2 = img.resize((DyncCFrame.window_image_size, DyncCFrame.window_image_size), Image.LANCZOS)
-        img.close()
-        img = img2
-        img.save(img_resized_buf, format="png")
-        img_resized_buf.seek(0)
-        png = wx.Image(img_resized_buf, wx.BITMAP_TYPE_PNG).ConvertToBitmap()
-        img_resized_buf.close()
-
-        self.map.SetBitmap(png)
-        if self.old_image_buffer is not None:
-            self.old_image_buffer.close()
-        self.old_image_buffer = img_buffer
+        wx.CallAfter(self.log_control.write, contents + "\n")
+
+    def update_map(self, rendered_map):
+        self.rendered_map = rendered_map
+        self.render_view(self.view)
+
+    def render_view(self, view):
+        # On the render thread. Scaled to the window, or put together from tiles, here, and handed over as raw RGB, so
+        # that nothing is encoded or decoded on the way.
+        size = DyncCFrame.window_image_size
+        if view is None:
+            if self.rendered_map is None:
+                return
+            rgb = self.rendered_map.get_rgb(size)
+        else:
+            zoom = view[0]
+            left, top = DyncCFrame.get_view_corner(view)
+            rendered_view = self.server.get_map_view(zoom, left, top, size)
+            if rendered_view is None:
+                return
+            rgb = rendered_view.get_rgb(size)
+        wx.CallAfter(self.show_map, view, size, rgb)
+
+    def show_map(self, view, size, rgb):
+        if view != self.view:
+            # The view has changed again, and the new one is on its way
+            return
+        self.map_bitmap = wx.Bitmap.FromBuffer(size, size, rgb)
+        self.map.Refresh()
         self.panel.Layout()
 
+    def on_paint_map(self, _):
+        dc = wx.AutoBufferedPaintDC(self.map)
+        dc.SetBackground(wx.Brush(self.map.GetBackgroundColour()))
+        dc.Clear()
+        if self.map_bitmap is not None:
+            dc.DrawBitmap(self.map_bitmap, 0, 0)
+
+    def set_view(self, view):
+        self.view = view
+        self.server.render_queue.submit_latest("view", self.render_view, view)
+
+    @staticmethod
+    def get_view_corner(view):
+        # The top left corner of the window in the image coordinates of the whole map at the zoom level. The window
+        # never goes past the edges of the map.
+        zoom, center_x, center_y = view
+        size = DyncCFrame.window_image_size
+        map_size = GfxHelper.tile_size * 2 ** zoom
+        left = min(max(int(round(center_x * map_size - size / 2)), 0), max(map_size - size, 0))
+        top = min(max(int(round(center_y * map_size - size / 2)), 0), max(map_size - size, 0))
+        return left, top
+
+    @staticmethod
+    def get_min_zoom():
+        # The first zoom level at which the map is larger than the window
+        zoom = 0
+        while GfxHelper.tile_size * 2 ** zoom < DyncCFrame.window_image_size and zoom < GfxHelper.max_tile_zoom:
+            zoom += 1
+        return zoom
+
+    def on_map_wheel(self, event):
+        if self.rendered_map is None:
+            return
+        size = DyncCFrame.window_image_size
+        mouse_x, mouse_y = event.GetPosition()
+        # The point of the map under the mouse stays where it is
+        if self.view is None:
+            zoom = DyncCFrame.get_min_zoom() - 1
+            point_x, point_y = mouse_x / size, mouse_y / size
+        else:
+            zoom = self.view[0]
+            left, top = DyncCFrame.get_view_corner(self.view)
+            map_size = GfxHelper.tile_size * 2 ** zoom
+            point_x, point_y = (left + mouse_x) / map_size, (top + mouse_y) / map_size
+        if event.GetWheelRotation() > 0:
+            zoom = min(zoom + 1, GfxHelper.max_tile_zoom)
+        else:
+            zoom -= 1
+        if zoom < DyncCFrame.get_min_zoom():
+            self.set_view(None)
+            return
+        map_size = GfxHelper.tile_size * 2 ** zoom
+        center_x = point_x + (size / 2 - mouse_x) / map_size
+        center_y = point_y + (size / 2 - mouse_y) / map_size
+        self.set_view((zoom, center_x, center_y))
+
+    def on_map_left_down(self, event):
+        self.drag_start = (event.GetPosition(), self.view)
+        event.Skip()
+
+    def on_map_left_up(self, event):
+        self.drag_start = None
+        event.Skip()
+
+    def on_map_motion(self, event):
+        if self.drag_start is None or not event.Dragging() or not event.LeftIsDown():
+            return
+        (start_x, start_y), start_view = self.drag_start
+        if start_view is None:
+            return
+        mouse_x, mouse_y = event.GetPosition()
+        zoom = start_view[0]
+        size = DyncCFrame.window_image_size
+        map_size = GfxHelper.tile_size * 2 ** zoom
+        left, top = DyncCFrame.get_view_corner(start_view)
+        left -= mouse_x - start_x
+        top -= mouse_y - start_y
+        self.set_view((zoom, (left + size / 2) / map_size, (top + size / 2) / map_size))
+
+    def on_map_double_click(self, _):
+        self.drag_start = None
+        self.set_view(None)
+
     def erase_window(self):
-        self.map.SetBitmap(wx.NullBitmap)
-        if self.old_image_buffer is not None:
-            self.old_image_buffer.close()
+        wx.CallAfter(self.clear_window)
+
+    def clear_window(self):
+        self.view = None
+        self.map_bitmap = None
+        self.map.Refresh()
+        self.rendered_map = None
         self.score.Clear()
         self.panel.Layout()
 
@@ -94,6 +208,9 @@ class DyncCFrame(wx.Frame):
         if score is None or score[0] is None or score[1] is None:
             logger.warning("update_score got invalid score dict: %s" % repr(score))
             return
+        wx.CallAfter(self.show_score, score)
+
+    def show_score(self, score):
         self.score.Clear()
         self.score.SetDefaultStyle(wx.TextAttr(wx.RED))
         self.score.write("%d" % score[0])
@@ -120,6 +237,7 @@ class DyncCFrame(wx.Frame):
         self.bg_vis_menuitem = file_menu.Append(-1, "Background &visible\tCtrl-V", "Background image visible",
                                                 kind=wx.ITEM_CHECK)
         img_item = file_menu.Append(-1, "&Save png\tCtrl-S", "Save the current map as .png")
+        forecast_item = file_menu.Append(-1, "&Forecast\tCtrl-F", "Show where the front is likely to be in a few turns")
 
         stat_item = file_menu.Append(-1, "Save statistics &text\tCtrl-T",
                                      "Save the battle statistics as human-readable text")
@@ -153,6 +271,7 @@ class DyncCFrame(wx.Frame):
         self.Bind(wx.EVT_MENU, self.on_background_visible, self.bg_vis_menuitem)
         self.bg_vis_menuitem.Check()
         self.Bind(wx.EVT_MENU, self.on_save, img_item)
+        self.Bind(wx.EVT_MENU, self.on_forecast, forecast_item)
         self.Bind(wx.EVT_MENU, self.on_save_statistics, stat_item)
         self.Bind(wx.EVT_MENU, self.on_reset_campaign, resetcampaign_item)
         self.Bind(wx.EVT_MENU, self.on_exit, exit_item)
@@ -166,12 +285,25 @@ class DyncCFrame(wx.Frame):
                                          wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
 
         open_file_dialog.ShowModal()
-        self.server.read_config(open_file_dialog.GetPath())
+        with self.server.campaign_lock:
+            self.server.read_config(open_file_dialog.GetPath())
+            self.server.publish_snapshot()
         open_file_dialog.Destroy()
 
     def on_save(self, _):
         self.server.save_image()
 
+    def on_forecast(self, _):
+        # The forecast is drawn over the whole map, not in the tiles
+        self.set_view(None)
+        # Can take a few seconds, so we don't block the window while it runs.
+        self.SetStatusText("Forecasting...")
+        Thread(target=self.forecast_thread, daemon=True).start()
+
+    def forecast_thread(self):
+        self.server.show_forecast()
+        wx.CallAfter(self.SetStatusText, "Server is running")
+
     def on_save_statistics(self, _):
         self.server.save_statistics_text_file()
 
@@ -188,7 +320,9 @@ class DyncCFrame(wx.Frame):
 
     def on_paths(self, _):
         self.server.display_map_paths = self.paths_menuitem.IsChecked()
-        self.server.campaign_changed()
+        with self.server.campaign_lock:
+            self.server.campaign_changed()
+            self.server.publish_snapshot()
 
     def on_background(self, _):
         open_file_dialog = wx.FileDialog(self, "Open", "", "", "Png/Jpg images|*.png;*.jpg;*.jpeg",
@@ -199,12 +333,17 @@ class DyncCFrame(wx.Frame):
             return
         open_file_dialog.Destroy()
         shutil.copy2(file_path, self.server.mapbg)
-        self.server.campaign_changed()
+        self.server.prepare_map_background()
+        with self.server.campaign_lock:
+            self.server.campaign_changed()
+            self.server.publish_snapshot()
 
     def on_background_visible(self, _):
         if self.server.display_map_background != self.bg_vis_menuitem.IsChecked():
             self.server.display_map_background = self.bg_vis_menuitem.IsChecked()
-            self.server.campaign_changed()
+            with self.server.campaign_lock:
+                self.server.campaign_changed()
+                self.server.publish_snapshot()
 
     @staticmethod
     def on_about(_):
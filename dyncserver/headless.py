@@ -0,0 +1,33 @@
+import logging
+
+logger = logging.getLogger('general')
+
+
+class HeadlessWindow:
+
+    # Stands in for DyncCFrame when the server runs without a display, so that the rest of the server doesn't have to
+    # care. If map_file is given, every map that would have been shown in the window is written there instead.
+
+    def __init__(self, map_file=None):
+        self.map_file = map_file
+        self.rendered_map = None
+
+    def update_map(self, rendered_map):
+        if rendered_map is None:
+            return
+        self.rendered_map = rendered_map
+        if self.map_file is not None:
+            try:
+                with open(self.map_file, 'wb') as f:
+                    f.write(rendered_map.get_png())
+            except OSError:
+                logger.warning("Could not write the map to %s" % self.map_file, exc_info=True)
+
+    def update_score(self, scores):
+        pass
+
+    def update_log(self, msg):
+        pass
+
+    def erase_window(self):
+        self.rendered_map = None
@@ -0,0 +1,248 @@
+import logging
+import multiprocessing
+import random
+import time
+from threading import Lock
+import numpy as np
+from ai import *
+from combat import CombatModel
+from simulation import simulate
+
+logger = logging.getLogger('general')
+
+# Monte Carlo lookahead for the moves of one coalition. We come up with a few alternative sets of moves for its groups,
+# play each of them a few turns into the future a number of times with different random numbers, and pick the set that
+# did best on average. The simulations are independent of each other, so they run in a pool of worker processes, which
+# is the only way to get more than one core working in CPython. Every worker receives the static part of the campaign
+# (the graph and everything derived from it) once, when it starts, and after that only the small mutable part of the
+# campaign for each simulation. See Campaign.fork. The combat model is refitted after every mission, so its weights
+# come with each simulation too. They are small, and a refit then never needs new workers.
+
+worker_campaign = None
+worker_combat_model = None
+
+victory_score = 1000.0
+
+
+def init_worker(campaign):
+    global worker_campaign
+    global worker_combat_model
+
+    # The server's handlers write to a file and to a window that belong to the main process.
+    worker_logger = logging.getLogger('general')
+    worker_logger.handlers = []
+    worker_logger.addHandler(logging.NullHandler())
+    worker_logger.propagate = False
+
+    worker_campaign = campaign
+    worker_combat_model = None
+
+
+def get_worker_combat_model(log_weights):
+    # The weights are the same for every simulation until the next refit, so the model is only made again when they
+    # change.
+    global worker_combat_model
+    if worker_combat_model is None or not np.array_equal(worker_combat_model.log_weights, log_weights):
+        worker_combat_model = CombatModel(log_weights)
+    return worker_combat_model
+
+
+def score_result(campaign, coalition, result, turns_played):
+    # Units still alive on our side minus those on the enemy side, plus a big bonus or penalty if someone won. Winning
+    # sooner is better than winning later.
+    if result == coalition:
+        return victory_score - turns_played
+    if result is not None and result != "draw":
+        return -victory_score + turns_played
+    enemy_coalition = "blue" if coalition == "red" else "red"
+    groups = campaign.map.groups()
+    score = 0.0
+    for group_name in groups:
+        group = groups[group_name]
+        if group.category != "vehicle":
+            continue
+        if group.coalition == coalition:
+            score += group.num_units()
+        elif group.coalition == enemy_coalition:
+            score -= group.num_units()
+    return score
+
+
+def run_rollout(mutable_state, log_weights, coalition, moves, num_turns, seed, deadline):
+    # Runs in a worker. Returns None if the budget was already spent when the worker got to this task.
+    if time.time() >= deadline:
+        return None
+    random.seed(seed)
+    np.random.seed(seed)
+    rng = np.random.default_rng(seed)
+    campaign = worker_campaign.fork(mutable_state)
+    result, turns_played = simulate(campaign, get_worker_combat_model(log_weights), num_turns, rng, moves=moves)
+    return score_result(campaign, coalition, result, turns_played)
+
+
+class SimulationPool:
+
+    # The worker processes, shared by everything that runs simulations: the lookahead and forecasts. Those run on
+    # different threads, and a forecast doesn't hold the campaign lock, so whoever submits work gets the pool with
+    # acquire, and gives it back with release. A pool that someone still uses is never terminated under them: if it has
+    # to be replaced or closed meanwhile, the last one to release it terminates it.
+
+    def __init__(self, num_processes=0):
+        if num_processes <= 0:
+            num_processes = multiprocessing.cpu_count()
+        self.num_processes = num_processes
+        self.lock = Lock()
+        self.pool = None
+        self.pool_graph = None
+        # From pool to the number of those who have acquired it and not yet released it
+        self.users = {}
+
+    def acquire(self, campaign):
+        with self.lock:
+            self.prepare_locked(campaign)
+            self.users[self.pool] = self.users.get(self.pool, 0) + 1
+            return self.pool
+
+    def release(self, pool):
+        with self.lock:
+            self.users[pool] -= 1
+            if self.users[pool] > 0:
+                return
+            del self.users[pool]
+            if pool is not self.pool:
+                SimulationPool.terminate(pool)
+
+    def prepare(self, campaign):
+        # Starts the pool ahead of time, so that the next acquire doesn't have to wait for it
+        with self.lock:
+            self.prepare_locked(campaign)
+
+    def prepare_locked(self, campaign):
+        # The pool has to be restarted when the static part of the campaign changes, which only happens with a new
+        # campaign. A new graph object means exactly that.
+        if self.pool is not None and self.pool_graph is campaign.map.graph:
+            return
+        self.close_locked()
+        template = campaign.fork()
+        template.map.groups_in_nodes = {}
+        self.pool = multiprocessing.Pool(processes=self.num_processes, initializer=init_worker, initargs=(template, ))
+        self.pool_graph = campaign.map.graph
+        logger.info("Started %d simulation worker processes" % self.num_processes)
+
+    def close(self):
+        with self.lock:
+            self.close_locked()
+
+    def close_locked(self):
+        if self.pool is not None:
+            if self.pool not in self.users:
+                SimulationPool.terminate(self.pool)
+            self.pool = None
+            self.pool_graph = None
+
+    @staticmethod
+    def terminate(pool):
+        pool.terminate()
+        pool.join()
+
+
+class LookaheadPlanner:
+
+    def __init__(self, simulation_pool, num_turns=3, num_candidates=8, num_rollouts=4):
+        self.simulation_pool = simulation_pool
+        self.num_turns = num_turns
+        self.num_candidates = num_candidates
+        self.num_rollouts = num_rollouts
+
+    def make_candidates(self, game_map, coalition_groups, moves, rng):
+        # The first candidate is always the moves that we already have. The others change a random subset of the groups
+        # to another move that the basic rules also consider sensible.
+        choices = {}
+        for group in coalition_groups:
+            node_id = game_map.find_group_node(group)
+            group_choices, node_is_backtrack = get_move_choices(node_id, game_map.get_coalition_goal(group.coalition),
+                                                                game_map)
+            if node_is_backtrack is not None and len(group_choices) > 1:
+                choices[group.name] = [int(choice) for choice in group_choices]
+
+        candidates = [dict((group.name, moves[group.name]) for group in coalition_groups)]
+        if len(choices) == 0:
+            return candidates
+
+        group_names = sorted(choices)
+        attempts = 0
+        while len(candidates) < self.num_candidates and attempts < self.num_candidates * 4:
+            attempts += 1
+            candidate = dict(candidates[0])
+            for group_name in group_names:
+                if rng.random() < 0.5:
+                    candidate[group_name] = choices[group_name][rng.integers(len(choices[group_name]))]
+            if candidate not in candidates:
+                candidates.append(candidate)
+        return candidates
+
+    def play_candidates(self, pool, campaign, combat_model, coalition, candidates, moves, deadline, rng):
+        # Returns the scores of the rollouts of each candidate that were played before the deadline
+
+        # Workers can't see our perf_counter, so they get the deadline in wall-clock time.
+        wall_deadline = time.time() + (deadline - time.perf_counter())
+        mutable_state = campaign.get_mutable_state()
+        tasks = []
+        for rollout in range(self.num_rollouts):
+            # Every candidate plays with the same seeds, so that differences in luck don't drown the differences in
+            # moves.
+            seed = int(rng.integers(2 ** 32))
+            for i, candidate in enumerate(candidates):
+                all_moves = dict(moves)
+                all_moves.update(candidate)
+                args = (mutable_state, combat_model.log_weights, coalition, all_moves, self.num_turns, seed,
+                        wall_deadline)
+                tasks.append((i, pool.apply_async(run_rollout, args)))
+
+        scores = [[] for _ in candidates]
+        for i, task in tasks:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                score = task.get(timeout=remaining)
+            except multiprocessing.TimeoutError:
+                break
+            if score is not None:
+                scores[i].append(score)
+        return scores
+
+    def improve(self, campaign, combat_model, coalition, coalition_groups, moves, deadline):
+        # deadline is in time.perf_counter() seconds, like in TurnPlanner. Returns the moves of the best candidate, or
+        # the given moves if no candidate was clearly better, or if we ran out of time before every candidate had been
+        # played at least once.
+        if len(coalition_groups) == 0:
+            return moves
+
+        # A generator of our own, so that the lookahead doesn't change what the game's random numbers would have been.
+        rng = np.random.default_rng()
+        candidates = self.make_candidates(campaign.map, coalition_groups, moves, rng)
+        if len(candidates) < 2:
+            return moves
+
+        pool = self.simulation_pool.acquire(campaign)
+        try:
+            scores = self.play_candidates(pool, campaign, combat_model, coalition, candidates, moves, deadline, rng)
+        finally:
+            self.simulation_pool.release(pool)
+
+        num_rollouts = sum(len(candidate_scores) for candidate_scores in scores)
+        if any(len(candidate_scores) == 0 for candidate_scores in scores):
+            logger.info("Lookahead for %s ran out of time after %d rollouts" % (coalition, num_rollouts))
+            return moves
+
+        means = [np.mean(candidate_scores) for candidate_scores in scores]
+        best = int(np.argmax(means))
+        logger.info("Lookahead for %s played %d rollouts of %d candidates. Best mean score %.2f, current moves %.2f" %
+                    (coalition, num_rollouts, len(candidates), means[best], means[0]))
+        if means[best] <= means[0]:
+            return moves
+
+        new_moves = dict(moves)
+        new_moves.update(candidates[best])
+        return new_moves
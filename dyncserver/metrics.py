@@ -0,0 +1,198 @@
+import math
+import time
+from threading import Lock, local
+from jsonrpc import JSONRPCResponseManager
+
+# Counters, gauges and histograms for /metrics, in the Prometheus text format. It's simple enough that we don't need
+# the prometheus_client library for it. Every metric can have labels, like the name of the RPC method, and is safe to
+# update from any thread.
+
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+size_buckets = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for name, value in pairs)
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return "%d" % value
+    return repr(float(value))
+
+
+class Metric:
+
+    metric_type = None
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.lock = Lock()
+        # Key is the tuple of label values
+        self.values = {}
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s %s" % (self.name, self.metric_type)]
+        with self.lock:
+            for label_values in sorted(self.values):
+                lines.extend(self.render_values(label_values, self.values[label_values]))
+        return lines
+
+    def render_values(self, label_values, value):
+        return ["%s%s %s" % (self.name, format_labels(self.label_names, label_values), format_value(value))]
+
+
+class Counter(Metric):
+
+    metric_type = "counter"
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+
+    metric_type = "gauge"
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Histogram(Metric):
+
+    metric_type = "histogram"
+
+    def __init__(self, name, description, label_names=(), buckets=latency_buckets):
+        Metric.__init__(self, name, description, label_names)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            if label_values not in self.values:
+                self.values[label_values] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0, "max": 0.0}
+            data = self.values[label_values]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data["counts"][i] += 1
+                    break
+            data["sum"] += value
+            data["count"] += 1
+            data["max"] = max(data["max"], value)
+
+    def render_values(self, label_values, data):
+        # Prometheus buckets are cumulative
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, data["counts"]):
+            cumulative += count
+            lines.append("%s_bucket%s %d" % (self.name, format_labels(self.label_names, label_values,
+                                                                       ("le", format_value(bound))), cumulative))
+        lines.append("%s_sum%s %s" % (self.name, format_labels(self.label_names, label_values),
+                                      format_value(data["sum"])))
+        lines.append("%s_count%s %d" % (self.name, format_labels(self.label_names, label_values), data["count"]))
+        return lines
+
+    def take_totals(self):
+        # {label values: (count, sum, max)}, for the summary in the log. The max is since the last call.
+        with self.lock:
+            totals = dict((label_values, (data["count"], data["sum"], data["max"]))
+                          for label_values, data in self.values.items())
+            for data in self.values.values():
+                data["max"] = 0.0
+            return totals
+
+
+class ServerMetrics:
+
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self.rpc_requests = Counter("dync_rpc_requests_total", "RPC calls by method.", ["method"])
+        self.rpc_exceptions = Counter("dync_rpc_exceptions_total", "RPC calls that raised an exception.", ["method"])
+        self.rpc_duration = Histogram("dync_rpc_duration_seconds", "Time spent in RPC methods, including waiting for "
+                                      "the campaign lock.", ["method"])
+        self.rpc_request_bytes = Histogram("dync_rpc_request_bytes", "Size of RPC requests, after decompression.",
+                                           ["method"], buckets=size_buckets)
+        self.rpc_response_bytes = Histogram("dync_rpc_response_bytes", "Size of RPC responses, before compression.",
+                                            ["method"], buckets=size_buckets)
+        self.save_duration = Histogram("dync_campaign_save_duration_seconds", "Time spent saving campaign.json.")
+        self.save_bytes = Gauge("dync_campaign_save_bytes", "Size of campaign.json when last saved.")
+        self.render_duration = Histogram("dync_render_duration_seconds", "Time spent drawing the map.")
+        self.renders_dropped = Counter("dync_renders_dropped_total", "Redraws that were replaced by a newer one before "
+                                       "they were started.", ["kind"])
+        self.mission_end_duration = Histogram("dync_mission_end_duration_seconds", "Time spent resolving the end of a "
+                                              "mission in the background.")
+        self.mission_end_wait_duration = Histogram("dync_mission_end_wait_seconds", "Time that RPC calls waited for "
+                                                   "the end of the previous mission to be resolved.")
+        self.stage = Gauge("dync_campaign_stage", "Current stage of the campaign.")
+        self.groups = Gauge("dync_groups", "Vehicle groups by coalition.", ["coalition"])
+        self.units = Gauge("dync_units", "Vehicle units by coalition.", ["coalition"])
+        self.nodes = Gauge("dync_nodes", "Nodes in the campaign graph.")
+        self.all_metrics = [self.rpc_requests, self.rpc_exceptions, self.rpc_duration, self.rpc_request_bytes,
+                            self.rpc_response_bytes, self.save_duration, self.save_bytes, self.render_duration,
+                            self.renders_dropped, self.mission_end_duration, self.mission_end_wait_duration,
+                            self.stage, self.groups, self.units, self.nodes]
+
+        # The method that the current thread is in, so that the payload sizes, which are only known outside the
+        # dispatcher, can be attributed to it.
+        self.local = local()
+        self.last_summary_totals = {}
+
+    def instrument(self, method_name, function):
+        def instrumented_function(*args, **kwargs):
+            self.local.method = method_name
+            self.rpc_requests.inc(method_name)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                self.rpc_exceptions.inc(method_name)
+                raise
+            finally:
+                self.rpc_duration.observe(time.perf_counter() - start, method_name)
+        return instrumented_function
+
+    def handle_rpc(self, data, dispatcher):
+        # JSONRPCResponseManager.handle, plus the payload sizes. Returns the response as a string.
+        self.local.method = None
+        response_json = JSONRPCResponseManager.handle(data, dispatcher).json
+        if self.local.method is not None:
+            self.rpc_request_bytes.observe(len(data), self.local.method)
+            self.rpc_response_bytes.observe(len(response_json), self.local.method)
+        return response_json
+
+    def render(self):
+        lines = []
+        for metric in self.all_metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def summarize(self):
+        # One line for the log: calls, mean and max time per method since the last summary.
+        totals = self.rpc_duration.take_totals()
+        parts = []
+        for label_values in sorted(totals):
+            count, total, max_value = totals[label_values]
+            last_count, last_total = self.last_summary_totals.get(label_values, (0, 0.0))
+            if count == last_count:
+                continue
+            parts.append("%s %d calls, mean %.1f ms, max %.1f ms" %
+                         (label_values[0], count - last_count, 1000.0 * (total - last_total) / (count - last_count),
+                          1000.0 * max_value))
+        self.last_summary_totals = dict((label_values, (totals[label_values][0], totals[label_values][1]))
+                                        for label_values in totals)
+        if len(parts) == 0:
+            return "no calls"
+        return "; ".join(parts)
@@ -0,0 +1,69 @@
+import gzip
+import json
+import time
+from threading import Lock
+
+# Records the RPC traffic of a server to a file, so that a real campaign can be played again without DCS World; see
+# replay.py. The file has one JSON object per line: first a header with everything needed to start a server in the
+# same state, and then every call with its request, response and duration, in the order they finished. If the file
+# name ends with .gz, it's compressed.
+
+recording_version = 1
+
+
+def open_recording(path, mode):
+    if str(path).endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def read_recording(path):
+    # Returns the header and the list of calls
+    header = None
+    calls = []
+    with open_recording(path, "r") as f:
+        for line in f:
+            if len(line.strip()) == 0:
+                continue
+            entry = json.loads(line)
+            if entry["type"] == "header":
+                header = entry
+            elif entry["type"] == "call":
+                calls.append(entry)
+    return header, calls
+
+
+class RPCRecorder:
+
+    def __init__(self, path, header):
+        self.path = path
+        self.lock = Lock()
+        self.start = time.perf_counter()
+        self.num_calls = 0
+        self.file = open_recording(path, "w")
+        header = dict(header)
+        header["type"] = "header"
+        header["recording_version"] = recording_version
+        self.write(header)
+
+    def write(self, entry):
+        self.file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        # Every call goes to the disk right away, so that a crash, which is a good reason to look at a recording,
+        # doesn't lose the end of it.
+        self.file.flush()
+
+    def record(self, request, response, duration):
+        if isinstance(request, bytes):
+            request = request.decode("utf-8", errors="replace")
+        with self.lock:
+            if self.file is None:
+                return
+            self.write({"type": "call", "seq": self.num_calls, "t": round(time.perf_counter() - self.start, 6),
+                        "ms": round(duration * 1000.0, 3), "request": request, "response": response})
+            self.num_calls += 1
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,61 @@
+import logging
+import queue
+from threading import Lock, Thread
+
+logger = logging.getLogger('general')
+
+# Drawing the map takes longer than anything else that happens after a turn, and nobody in DCS is waiting for it. So
+# the RPC threads only put the work in this queue, and a thread of its own draws the maps and updates the window in the
+# order they were asked for, after the answer has already gone back to DCS.
+#
+# Work that is submitted with a key only matters until there's newer work with the same key: a map that is still
+# waiting when the campaign changes again would only be replaced on the screen right away. So the newer one takes its
+# place at the end of the queue, and the older one is dropped without being run. However many changes come in a burst,
+# the thread draws at most the one it is already drawing, and the latest one.
+
+
+class RenderQueue:
+
+    def __init__(self, dropped_counter=None):
+        self.queue = queue.Queue()
+        # From key to the work with that key that is waiting in the queue
+        self.pending = {}
+        self.pending_lock = Lock()
+        # Counts the work that was dropped, for /metrics
+        self.dropped_counter = dropped_counter
+        self.thread = Thread(target=self.run, name="render", daemon=True)
+        self.thread.start()
+
+    def submit(self, function, *args):
+        self.queue.put([function, args, None])
+
+    def submit_latest(self, key, function, *args):
+        work = [function, args, key]
+        with self.pending_lock:
+            older_work = self.pending.get(key)
+            if older_work is not None:
+                # The thread skips work that has no function
+                older_work[0] = None
+                if self.dropped_counter is not None:
+                    self.dropped_counter.inc(key)
+            self.pending[key] = work
+        self.queue.put(work)
+
+    def run(self):
+        while True:
+            work = self.queue.get()
+            with self.pending_lock:
+                function, args, key = work
+                if key is not None and self.pending.get(key) is work:
+                    del self.pending[key]
+            if function is not None:
+                # noinspection PyBroadException
+                try:
+                    function(*args)
+                except Exception:
+                    logger.exception("Exception while drawing the map", exc_info=True)
+            self.queue.task_done()
+
+    def wait(self):
+        # Returns when everything that has been submitted so far is done
+        self.queue.join()
@@ -0,0 +1,163 @@
+import argparse
+import json
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+from configparser import ConfigParser
+import numpy as np
+
+import dyncserver
+from dyncserver import DynCServer, fill_dispatcher
+from headless import HeadlessWindow
+from recorder import read_recording
+
+# Plays a recording made with RECORD_FILE (or --record) into a fresh headless server, and reports how long every call
+# took compared to the recording, and which responses differ from the recorded ones. For example:
+#
+#   python replay.py C:\dync-rpc.jsonl.gz
+#
+# The server starts from the campaign in the recording, with the recorded random seed, so as long as the recording was
+# made with RNG_SEED set and the code hasn't changed what it does, every response should be the same. A difference
+# means either a change in behaviour, or a recording made without a seed. Calls are replayed one after another, in the
+# order they finished when recorded.
+
+
+def get_percentile(values, percentile):
+    if len(values) == 0:
+        return 0.0
+    return float(np.percentile(values, percentile))
+
+
+def get_difference(recorded, replayed):
+    # A short description of how two JSON-RPC responses differ. Our results are JSON strings themselves, so we look
+    # inside those too.
+    try:
+        recorded_obj = json.loads(recorded)
+        replayed_obj = json.loads(replayed)
+        recorded_result = recorded_obj.get("result")
+        replayed_result = replayed_obj.get("result")
+        if isinstance(recorded_result, str) and isinstance(replayed_result, str):
+            recorded_result = json.loads(recorded_result)
+            replayed_result = json.loads(replayed_result)
+    except (ValueError, AttributeError):
+        return "response differs"
+    if isinstance(recorded_result, dict) and isinstance(replayed_result, dict):
+        keys = sorted(key for key in set(recorded_result) | set(replayed_result)
+                      if recorded_result.get(key) != replayed_result.get(key))
+        return "fields differ: %s" % ", ".join(keys)
+    return "result differs: %s vs %s" % (repr(recorded_result)[:60], repr(replayed_result)[:60])
+
+
+def make_config(conf_file, work_directory, rng_seed, source_config=None):
+    config = ConfigParser()
+    if source_config is not None:
+        config.read(source_config)
+    else:
+        config.read_string(DynCServer.cfg_default_content)
+    for section in ("logging", "server", "debug"):
+        if not config.has_section(section):
+            config.add_section(section)
+    config.set("logging", "LOG_FILE", os.path.join(work_directory, "dync.log"))
+    config.set("logging", "LOG_CONSOLE_LEVEL", "4")
+    config.set("server", "HEADLESS", "1")
+    config.remove_option("debug", "RECORD_FILE")
+    if rng_seed is not None:
+        config.set("debug", "RNG_SEED", "%d" % rng_seed)
+    with open(conf_file, 'w') as f:
+        config.write(f)
+
+
+def replay(recording_path, source_config=None, rng_seed=None, render=False, max_differences=10):
+    header, calls = read_recording(recording_path)
+    if header is None:
+        print("%s is not a recording: it has no header" % recording_path)
+        return 1
+    if rng_seed is None:
+        rng_seed = header.get("rng_seed")
+    if rng_seed is None:
+        print("The recording was made without RNG_SEED, so responses that depend on the AI will differ.")
+
+    work_directory = tempfile.mkdtemp(prefix="dync-replay-")
+    try:
+        campaign_json = os.path.join(work_directory, "campaign.json")
+        if header.get("campaign") is not None:
+            with open(campaign_json, 'w') as f:
+                json.dump(header["campaign"], f)
+        conf_file = os.path.join(work_directory, "setup.cfg")
+        make_config(conf_file, work_directory, rng_seed, source_config)
+
+        server = DynCServer(campaign_json=campaign_json, conf_file=conf_file,
+                            mapbg=os.path.join(work_directory, "map-bg.dat"),
+                            sqlite_path=os.path.join(work_directory, "statistics.db"),
+                            stat_txt_path=os.path.join(work_directory, "statistics.txt"), headless=True)
+        if render:
+            # Draw the map after every turn, like the window would
+            server.map_file = os.path.join(work_directory, "map.png")
+        server.window = HeadlessWindow(server.map_file)
+        dyncserver.server_obj = server
+        rpc_dispatcher = fill_dispatcher(server)
+
+        timings = {}
+        differences = []
+        start = time.perf_counter()
+        for call in calls:
+            call_start = time.perf_counter()
+            response = server.handle_rpc(call["request"].encode("utf-8"), rpc_dispatcher)
+            duration_ms = 1000.0 * (time.perf_counter() - call_start)
+            try:
+                method = json.loads(call["request"]).get("method", "?")
+            except (ValueError, AttributeError):
+                method = "?"
+            if method not in timings:
+                timings[method] = {"recorded": [], "replayed": [], "differences": 0}
+            timings[method]["recorded"].append(call["ms"])
+            timings[method]["replayed"].append(duration_ms)
+            if response != call["response"]:
+                timings[method]["differences"] += 1
+                differences.append((call["seq"], method, get_difference(call["response"], response)))
+        total_ms = 1000.0 * (time.perf_counter() - start)
+
+        print("Replayed %d calls in %.1f ms (recorded with version %s, seed %s)" %
+              (len(calls), total_ms, header.get("app_version"), repr(rng_seed)))
+        print("%-18s %6s %12s %12s %12s %12s %6s" %
+              ("method", "calls", "rec mean ms", "rec p95 ms", "mean ms", "p95 ms", "diffs"))
+        for method in sorted(timings):
+            recorded = timings[method]["recorded"]
+            replayed = timings[method]["replayed"]
+            print("%-18s %6d %12.2f %12.2f %12.2f %12.2f %6d" %
+                  (method, len(replayed), np.mean(recorded), get_percentile(recorded, 95), np.mean(replayed),
+                   get_percentile(replayed, 95), timings[method]["differences"]))
+
+        if len(differences) > 0:
+            print("%d responses differ from the recording:" % len(differences))
+            for seq, method, description in differences[:max_differences]:
+                print("  call %d, %s: %s" % (seq, method, description))
+            if len(differences) > max_differences:
+                print("  ...")
+        else:
+            print("All responses are the same as in the recording.")
+
+        server.finish_mission_end()
+        if server.simulation_pool is not None:
+            server.simulation_pool.close()
+        return 1 if len(differences) > 0 else 0
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play a recording of DynC Server RPC calls into a fresh server.")
+    parser.add_argument("recording", help="File made with RECORD_FILE or dyncserver.py --record")
+    parser.add_argument("--config", help="setup.cfg to use instead of the defaults")
+    parser.add_argument("--seed", type=int, help="Random seed, instead of the one in the recording")
+    parser.add_argument("--render", action="store_true", help="Draw the map after every turn, like the window does")
+    parser.add_argument("--show", type=int, default=10, help="How many differing responses to describe")
+    args = parser.parse_args()
+    return replay(args.recording, source_config=args.config, rng_seed=args.seed, render=args.render,
+                  max_differences=args.show)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
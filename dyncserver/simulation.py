@@ -0,0 +1,193 @@
+import logging
+import random
+from ai import *
+from classes import *
+from combat import CombatModel
+
+logger = logging.getLogger('general')
+
+# Plays campaign turns without DCS World, for lookahead and what-if analysis. The rules are those of processjson and
+# missionend, minus everything that only matters for talking to DCS or for statistics: Groups move to the node they
+# decided on, unless two enemy groups swap nodes and meet halfway; groups of both coalitions in the same node fight;
+# the combat model decides who survives; vehicles wear down enemy infantry in their node; and a coalition wins when a
+# group reaches the enemy goal with no infantry in its way.
+#
+# Everything here changes the campaign that it is given, so always give it a fork.
+
+
+def get_enemy_coalition(coalition):
+    if coalition == "red":
+        return "blue"
+    return "red"
+
+
+def move_group(game_map, group, node_id):
+    old_node = game_map.find_group_node(group)
+    if old_node == node_id:
+        return
+    if old_node is not None:
+        del game_map.groups_in_nodes[old_node][group.name]
+        if len(game_map.groups_in_nodes[old_node]) == 0:
+            del game_map.groups_in_nodes[old_node]
+    if node_id not in game_map.groups_in_nodes:
+        game_map.groups_in_nodes[node_id] = {}
+    game_map.groups_in_nodes[node_id][group.name] = group
+
+
+def start_mission(campaign, moves=None):
+    # What processjson does: carry out the decisions of last turn, work out the battles that follow, and make the
+    # decisions for this turn. moves is an optional dictionary from group name to node, for groups whose decision for
+    # this turn has already been made by someone else. Returns the battles of this mission.
+    game_map = campaign.map
+    campaign.add_resources_generic("red", 1)
+    campaign.add_resources_generic("blue", 1)
+
+    decisions = campaign.get_movement_decisions()
+    decided_moves = {}
+    for group_name in decisions:
+        if decisions[group_name] not in decided_moves:
+            decided_moves[decisions[group_name]] = []
+        decided_moves[decisions[group_name]].append(group_name)
+
+    battles = []
+    groups_engaged_in_battle = set()
+    for potential_battle in campaign.find_potential_battles():
+        the_nodes = list(potential_battle.keys())
+        if the_nodes[0] in decided_moves and the_nodes[1] in decided_moves and \
+                potential_battle[the_nodes[0]] in decided_moves[the_nodes[0]] and \
+                potential_battle[the_nodes[1]] in decided_moves[the_nodes[1]] and \
+                potential_battle[the_nodes[0]] not in groups_engaged_in_battle and \
+                potential_battle[the_nodes[1]] not in groups_engaged_in_battle:
+            battles.append(potential_battle)
+            groups_engaged_in_battle.add(potential_battle[the_nodes[0]])
+            groups_engaged_in_battle.add(potential_battle[the_nodes[1]])
+
+    for decided_node_id in decided_moves:
+        for group_name in decided_moves[decided_node_id]:
+            if group_name in groups_engaged_in_battle:
+                continue
+            group = game_map.find_group_by_name(group_name)
+            if group is not None:
+                move_group(game_map, group, int(decided_node_id))
+
+    battles.extend(campaign.get_battles_due_to_same_node(previously_scheduled=groups_engaged_in_battle))
+    decide_turn(campaign, moves)
+    return battles
+
+
+def decide_turn(campaign, moves=None):
+    game_map = campaign.map
+    groups = game_map.groups()
+
+    for group_name in groups:
+        group = groups[group_name]
+        if group.category != "vehicle" or "__sg__" in group_name or "__spaa__" in group_name:
+            continue
+        origin_node = game_map.find_group_node(group)
+        if game_map.get_num_coalition_infantry_in_node(get_enemy_coalition(group.coalition), origin_node) > 0:
+            campaign.set_movement_decision(group, origin_node)
+            continue
+        if moves is not None and group_name in moves:
+            node_id = moves[group_name]
+        else:
+            node_id = decide_move(group, game_map)
+        if node_id is not None:
+            campaign.set_movement_decision(group, node_id)
+
+    coalitions = ["red", "blue"]
+    random.shuffle(coalitions)
+
+    for coalition in coalitions:
+        if game_map.get_num_support_units(coalition) <= 2:
+            campaign.decrease_resources_generic(coalition, 1)
+            game_map.set_num_support_units(coalition, game_map.max_support_units_in_group)
+            game_map.set_support_unit_node(coalition, game_map.get_coalition_goal(get_enemy_coalition(coalition)))
+            continue
+        current_node = game_map.get_support_unit_node(coalition)
+        move = decide_support_move(current_node, coalition, game_map, campaign.max_infantry_in_node)
+        if move is None:
+            continue
+        game_map.set_infantry_in_node(coalition, move, campaign.max_infantry_in_node)
+        game_map.set_support_unit_node(coalition, move)
+
+    for coalition in coalitions:
+        if campaign.get_resources_generic(coalition) >= 2 and len(campaign.allowed_aa_units[coalition]) > 0:
+            new_dynamic_group = Group(name="Anti-aircraft %s %d (dyn) __spaa__" %
+                                           (coalition, campaign.aa_unit_id_counter),
+                                      group_category="vehicle", coalition=coalition, units=None, dynamic=True)
+            new_dynamic_group.add_unit(Unit(name="Anti-aircraft unit %s %d (dyn)" %
+                                                 (coalition, campaign.aa_unit_id_counter),
+                                            unit_type=np.random.choice(campaign.allowed_aa_units[coalition]),
+                                            skill="Good"))
+            campaign.aa_unit_id_counter += 1
+            game_map.add_group(new_dynamic_group, game_map.get_coalition_goal(get_enemy_coalition(coalition)))
+            campaign.decrease_resources_generic(coalition, 2)
+
+    groups = game_map.groups()
+    game_map.update_frontlines()
+    for group_name in groups:
+        group = groups[group_name]
+        if group.category != "vehicle" or "__spaa__" not in group_name:
+            continue
+        node_id = decide_aa_move(group, game_map)
+        if node_id is not None:
+            campaign.set_movement_decision(group, node_id)
+    game_map.clear_frontlines()
+
+
+def end_mission(campaign, battles, combat_model, rng):
+    # What happens during the mission and in missionend. Returns the winning coalition, "draw", or None if the campaign
+    # goes on.
+    game_map = campaign.map
+    CombatModel.apply_outcomes(campaign, combat_model.resolve_battles(campaign, battles, rng=rng))
+
+    groups = game_map.groups()
+    if len(groups) == 0:
+        return "draw"
+
+    victory = {"red": False, "blue": False}
+    for group_name in groups:
+        group = groups[group_name]
+        if group.category != "vehicle" or group.coalition not in victory or "__sg__" in group_name:
+            continue
+        node_id = game_map.find_group_node(group)
+        enemy_coalition = get_enemy_coalition(group.coalition)
+        num_enemy_infantry = game_map.get_num_coalition_infantry_in_node(enemy_coalition, node_id)
+        if num_enemy_infantry > 0:
+            num_enemy_infantry = max(num_enemy_infantry - group.num_units(), 0)
+            game_map.set_infantry_in_node(enemy_coalition, node_id, num_enemy_infantry)
+        if num_enemy_infantry == 0:
+            shortest_path = game_map.get_shortest_path(node_id, game_map.get_coalition_goal(group.coalition))
+            if shortest_path is not None and len(shortest_path) < 3:
+                victory[group.coalition] = True
+
+    campaign.stage += 1
+    if victory["red"] and victory["blue"]:
+        return "draw"
+    if victory["red"]:
+        return "red"
+    if victory["blue"]:
+        return "blue"
+    return None
+
+
+def simulate(campaign, combat_model, num_turns, rng, moves=None, play_current_mission=True):
+    # Plays the mission that is about to start, with the battles already scheduled for it, and then num_turns more.
+    # Between missionend and the next processjson the current mission has already been played in DCS, and
+    # play_current_mission must be False. moves overrides the decisions for the first of the turns after it. Returns
+    # the result of end_mission and the number of turns played.
+    if play_current_mission:
+        result = end_mission(campaign, list(campaign.early_battles), combat_model, rng)
+        if result is not None:
+            return result, 0
+    for turn in range(num_turns):
+        if turn == 0 and moves is not None:
+            for group_name in moves:
+                group = campaign.map.find_group_by_name(group_name)
+                if group is not None and moves[group_name] is not None:
+                    campaign.set_movement_decision(group, moves[group_name])
+        battles = start_mission(campaign)
+        result = end_mission(campaign, battles, combat_model, rng)
+        if result is not None:
+            return result, turn + 1
+    return None, num_turns
@@ -0,0 +1,82 @@
+import hashlib
+import json
+from threading import Lock
+from types import MappingProxyType
+
+# Everything that only reads the campaign, like web pages polling the state of the war, is served from a snapshot
+# instead of the live Campaign objects. The server builds a new snapshot while it still holds the campaign lock after
+# every change, and then just replaces the old one. Replacing a reference is atomic, so readers never need the lock,
+# and a snapshot never changes after it has been built, so readers never see half of a change either.
+#
+# Every document is serialized once, when the snapshot is built, and gets an ETag from its contents. A document that
+# did not change keeps its ETag from one snapshot to the next, so a poller that sends If-None-Match gets a 304 without
+# us doing anything but comparing two strings.
+#
+# The map is the exception. Encoding it as PNG takes longer than everything else together, and only matters if someone
+# asks for it, so it is encoded the first time it is asked for, and then kept like the other documents.
+
+
+def get_etag(body):
+    return hashlib.sha1(body).hexdigest()[:16]
+
+
+class CampaignSnapshot:
+
+    def __init__(self, version, documents, rendered_map=None):
+        # documents is a dictionary from name to anything that json can serialize. rendered_map is the RenderedMap of
+        # the last map that was drawn, or None.
+        self.version = version
+        serialized = {}
+        for name in documents:
+            body = json.dumps(documents[name], sort_keys=True).encode("utf-8")
+            serialized[name] = (body, get_etag(body))
+        self.documents = MappingProxyType(serialized)
+        self.rendered_map = rendered_map
+        self.map_document = None
+        self.map_lock = Lock()
+
+    def with_map(self, rendered_map):
+        # The same snapshot with a newly drawn map. The documents are not serialized again.
+        new_snapshot = CampaignSnapshot(self.version + 1, {}, rendered_map)
+        new_snapshot.documents = self.documents
+        return new_snapshot
+
+    def get_map_document(self):
+        if self.rendered_map is None:
+            return None, None
+        with self.map_lock:
+            if self.map_document is None:
+                map_png = self.rendered_map.get_png()
+                self.map_document = (map_png, get_etag(map_png))
+            return self.map_document
+
+    def get_document(self, name):
+        # Returns the serialized document and its ETag, or None, None if there is no such document.
+        if name == "map.png":
+            return self.get_map_document()
+        if name not in self.documents:
+            return None, None
+        return self.documents[name]
+
+    def get_document_for_path(self, path):
+        # For plain HTTP GET: /status, /groups, /scores and /map.png. The first three may also end in .json. Returns the
+        # document, its ETag and its MIME type, or None, None, None.
+        name = path.strip("/")
+        if name.endswith(".json"):
+            name = name[:-len(".json")]
+        body, etag = self.get_document(name)
+        if body is None:
+            return None, None, None
+        if name == "map.png":
+            return body, etag, "image/png"
+        return body, etag, "application/json"
+
+    def get_json(self, name):
+        body, etag = self.get_document(name)
+        if body is None:
+            return None
+        return body.decode("utf-8")
+
+
+# Before the first campaign has been loaded
+empty_snapshot = CampaignSnapshot(0, {"status": {"campaign": False}})
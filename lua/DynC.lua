@@ -11,6 +11,16 @@ do
 
 	local http = require("dync_httpfix")
 	local ltn12 = require('ltn12')
+	if http.cancompress() then
+		env.info("DynC: lua-zlib found, large requests are compressed", false)
+	else
+		env.info("DynC: lua-zlib not found, requests are sent uncompressed", false)
+	end
+
+	-- This file is run before MissionScripting.lua takes io and lfs away from mission scripts, so we keep our own
+	-- references. They are only used for the delta cache of processjson.
+	local io = io
+	local lfs = lfs
 
 	-----------------------------------------------------------------------------
 	-- Module declaration
@@ -481,13 +491,24 @@ do
 	  -- is needed to Xavante to make it work with text/plain)
 
 	  local resultChunks = {}
+	  local responseHeaders
 
-	  httpResponse, code = http.request(
+	  -- If we have zlib, large requests go compressed, and we tell the server that it may compress its answer.
+	  local requestBody, contentEncoding = http.encodebody(jsonRequest)
+	  local requestHeaders = { ['content-type']='application/json-rpc', ['content-length']=string.len(requestBody) }
+	  if contentEncoding then
+		requestHeaders['content-encoding'] = contentEncoding
+	  end
+	  if http.cancompress() then
+		requestHeaders['accept-encoding'] = 'gzip, deflate'
+	  end
+
+	  httpResponse, code, responseHeaders = http.request(
 		{ ['url'] = url,
 		  sink = ltn12.sink.table(resultChunks),
 		  method = 'POST',
-		  headers = { ['content-type']='application/json-rpc', ['content-length']=string.len(jsonRequest) },
-		  source = ltn12.source.string(jsonRequest)
+		  headers = requestHeaders,
+		  source = ltn12.source.string(requestBody)
 		}
 	  )
 
@@ -504,6 +525,11 @@ do
 	  if (code~=200) then
 		return nil, "HTTP ERROR: " .. code
 	  end
+	  local decodeError
+	  httpResponse, decodeError = http.decodebody(httpResponse, responseHeaders)
+	  if httpResponse == nil then
+		return nil, "HTTP ERROR: " .. decodeError
+	  end
 	  -- And decode the httpResponse and check the JSON RPC result code
 	  result = json.decode( httpResponse )
 	  if result.result then
@@ -519,8 +545,99 @@ do
 	local delayed_routes = {}
 	local scored_planes = {}
 	local groups_shot_by_group = {}
+	-- RPC methods that the server has told us it supports, beyond the ones every server version has. Filled in from processjson.
+	local server_capabilities = {}
 	server = json.rpc.proxy(dync_socket)
 
+	-- Delta protocol for processjson. After the server has seen a full mission, it gives us a hash of it. Every mission
+	-- starts with a fresh Lua state, so we keep that hash and the units that we sent in a file. Next time we send only
+	-- the hash and the units that changed. If the server doesn't know the hash any more, it answers with code 2 and we
+	-- send everything. If anything but the units has changed, it's a different mission, and we send everything too.
+	local delta_map_fields = {"routes", "goals", "bullseye", "mapmarkers", "cornermarkers"}
+	local delta_cache_path = nil
+	if lfs ~= nil and io ~= nil then
+		delta_cache_path = lfs.writedir() .. "DynC-delta-cache.json"
+	end
+
+	local function read_delta_cache()
+		if delta_cache_path == nil then
+			return nil
+		end
+		local f = io.open(delta_cache_path, "r")
+		if f == nil then
+			return nil
+		end
+		local content = f:read("*a")
+		f:close()
+		local ok, cache = pcall(json.decode, content)
+		if not ok or type(cache) ~= "table" or cache["maphash"] == nil or type(cache["units"]) ~= "table" or
+				type(cache["map"]) ~= "table" then
+			return nil
+		end
+		return cache
+	end
+
+	local function get_delta_map(jsonobj)
+		local map = {}
+		for i,field in ipairs(delta_map_fields) do
+			map[field] = jsonobj[field]
+		end
+		return map
+	end
+
+	local function write_delta_cache(maphash, jsonobj)
+		if delta_cache_path == nil then
+			return
+		end
+		local f = io.open(delta_cache_path, "w")
+		if f == nil then
+			return
+		end
+		f:write(json.encode({maphash = maphash, units = jsonobj["units"], map = get_delta_map(jsonobj)}))
+		f:close()
+	end
+
+	local function data_differs(a, b)
+		if type(a) ~= "table" or type(b) ~= "table" then
+			return a ~= b
+		end
+		for k,v in pairs(a) do
+			if data_differs(v, b[k]) then
+				return true
+			end
+		end
+		for k,v in pairs(b) do
+			if a[k] == nil then
+				return true
+			end
+		end
+		return false
+	end
+
+	-- Returns nil if the mission is not the one in the cache
+	local function make_delta_request(jsonobj, cache)
+		local map = get_delta_map(jsonobj)
+		for i,field in ipairs(delta_map_fields) do
+			-- Empty tables come back from the file as empty lists, and so compare equal
+			if data_differs(map[field] or {}, cache["map"][field] or {}) then
+				return nil
+			end
+		end
+		local changed_units = {}
+		local removed_units = {}
+		for k,v in pairs(jsonobj["units"]) do
+			if cache["units"][k] == nil or data_differs(v, cache["units"][k]) then
+				changed_units[k] = v
+			end
+		end
+		for k,v in pairs(cache["units"]) do
+			if jsonobj["units"][k] == nil then
+				table.insert(removed_units, k)
+			end
+		end
+		return {protocol = 2, maphash = cache["maphash"], units = changed_units, removedunits = removed_units}
+	end
+
 
 
 	-- Configurable parameters
@@ -731,6 +848,7 @@ do
 			param["shot"] = groups_shot_by_group
 			param["time"] = timer.getAbsTime()
 			param["starttime"] = timer.getTime0()
+			local destroyed_units = {}
 
 			for k,v in pairs(live_units) do
 
@@ -746,7 +864,18 @@ do
 						-- Somehow we didn't get EVENT_DEAD for this unit. We report it destroyed now.
 
 						env.info("Reported destroyed unit at mission end: "..v["unitname"]..", group: "..v["groupname"], false)
-						local result, error = server.unitdestroyed({v["unitname"], v["groupname"], timer.getAbsTime(), timer.getTime0()})
+						table.insert(destroyed_units, {v["unitname"], v["groupname"], timer.getAbsTime(), timer.getTime0()})
+					end
+				end
+			end
+
+			if #destroyed_units > 0 then
+				if server_capabilities["unitsdestroyed"] then
+					-- One request for all of them, instead of one per unit
+					local result, error = server.unitsdestroyed({destroyed_units,})
+				else
+					for i,unitdata in ipairs(destroyed_units) do
+						local result, error = server.unitdestroyed(unitdata)
 					end
 				end
 			end
@@ -1113,14 +1242,46 @@ do
 				table.insert(live_units, {unitname = k, groupname = v["group"]})
 			end
 		end
-		local result, error = server.processjson({json.encode(jsonobj),})
-		local resultobj = json.decode(result)
+		local delta_cache = read_delta_cache()
+		local result, error
+		local resultobj = nil
+		local delta_request = nil
+		if delta_cache ~= nil then
+			delta_request = make_delta_request(jsonobj, delta_cache)
+		end
+		if delta_request ~= nil then
+			result, error = server.processjson({json.encode(delta_request),})
+			if result ~= nil then
+				resultobj = json.decode(result)
+			end
+		end
+		if resultobj == nil or resultobj["code"] == "2" then
+			-- No cache, an older server, or a server that doesn't know our map
+			result, error = server.processjson({json.encode(jsonobj),})
+			resultobj = json.decode(result)
+		end
 
 		if (resultobj["code"] ~= "0") then
 			env.info(resultobj["error"], true)
 			return
 		end
 
+		server_capabilities = {}
+		if resultobj["capabilities"] ~= nil then
+			for i,capability in ipairs(resultobj["capabilities"]) do
+				server_capabilities[capability] = true
+			end
+		end
+
+		if resultobj["maphash"] ~= nil then
+			write_delta_cache(resultobj["maphash"], jsonobj)
+		end
+
+		if resultobj["campaignended"] ~= nil then
+			-- The previous mission ended the campaign, which the server only worked out after that mission had closed
+			env.info(string.format("Campaign ended: %s", resultobj["campaignended"]), true)
+		end
+
 		local destroyed = resultobj["destroyed"]
 
 		for k,v in pairs(destroyed) do
@@ -356,3 +356,47 @@ request = socket.protect(function(reqt, body)
     if base.type(reqt) == "string" then return srequest(reqt, body)
     else return trequest(reqt) end
 end)
+
+-----------------------------------------------------------------------------
+-- DynC addition: optional compression of request and response bodies. DCS
+-- doesn't come with a zlib module, but if lua-zlib has been put next to
+-- LuaSocket, we use it. Without it, everything is sent and received as is.
+-----------------------------------------------------------------------------
+local havezlib, zlib = base.pcall(base.require, "zlib")
+if not havezlib then zlib = nil end
+
+-- bodies smaller than this are not worth compressing
+COMPRESSMINSIZE = 1024
+
+function cancompress()
+    return zlib ~= nil
+end
+
+-- returns the body to send, and the value of the content-encoding header,
+-- or nil if the body goes as it is
+function encodebody(body)
+    if zlib == nil or string.len(body) < COMPRESSMINSIZE then
+        return body, nil
+    end
+    local ok, compressed = base.pcall(function()
+        return zlib.deflate()(body, "finish")
+    end)
+    if not ok then return body, nil end
+    return compressed, "deflate"
+end
+
+-- decodes a body received with the given response headers. Returns nil and
+-- an error message if it can't be done.
+function decodebody(body, headers)
+    local encoding = headers and headers["content-encoding"]
+    if encoding == nil or encoding == "identity" then return body end
+    if zlib == nil then
+        return nil, "cannot decode content-encoding " .. encoding
+    end
+    -- inflate detects the zlib and gzip formats by itself
+    local ok, inflated = base.pcall(function()
+        return zlib.inflate()(body)
+    end)
+    if not ok then return nil, "could not decode " .. encoding .. " body" end
+    return inflated
+end